@@ -7,8 +7,10 @@ from typing import ClassVar, Sequence
 import torch
 from torchtyping import TensorType as TT
 
+from gfn.utils.common import FlagsCacheMixin
 
-class Actions(ABC):
+
+class Actions(FlagsCacheMixin, ABC):
     """Base class for actions for all GFlowNet environments.
 
     Each environment needs to subclass this class. A generic subclass for discrete
@@ -18,6 +20,8 @@ class Actions(ABC):
     Attributes:
         tensor: a batch of actions with shape (*batch_shape, *actions_ndims).
         batch_shape: the batch_shape from the input tensor.
+        _flags_cache: Stores the lazily computed `is_dummy` and `is_exit` flags (see
+            `FlagsCacheMixin`).
     """
 
     # The following class variable represents the shape of a single action.
@@ -40,6 +44,7 @@ class Actions(ABC):
             # Ensure the tensor has all action dimensions.
         )
         self.batch_shape = tuple(self.tensor.shape)[: -len(self.action_shape)]
+        self._flags_cache = {}
 
     @classmethod
     def make_dummy_actions(cls, batch_shape: tuple[int]) -> Actions:
@@ -155,15 +160,9 @@ class Actions(ABC):
     @property
     def is_dummy(self) -> TT["batch_shape", torch.bool]:
         """Returns a boolean tensor indicating whether the actions are dummy actions."""
-        dummy_actions_tensor = self.__class__.dummy_action.repeat(
-            *self.batch_shape, *((1,) * len(self.__class__.action_shape))
-        )
-        return self.compare(dummy_actions_tensor)
+        return self._cached_compare("is_dummy", self.__class__.dummy_action)
 
     @property
     def is_exit(self) -> TT["batch_shape", torch.bool]:
         """Returns a boolean tensor indicating whether the actions are exit actions."""
-        exit_actions_tensor = self.__class__.exit_action.repeat(
-            *self.batch_shape, *((1,) * len(self.__class__.action_shape))
-        )
-        return self.compare(exit_actions_tensor)
+        return self._cached_compare("is_exit", self.__class__.exit_action)
@@ -1,3 +1,8 @@
-from .replay_buffer import ReplayBuffer
+from .prefetch import Prefetcher
+from .replay_buffer import (
+    DeduplicatedReplayBuffer,
+    PrioritizedReplayBuffer,
+    ReplayBuffer,
+)
 from .trajectories import Trajectories
 from .transitions import Transitions
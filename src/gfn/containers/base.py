@@ -1,13 +1,19 @@
 from __future__ import annotations
 
+import json
 import os
 from abc import ABC, abstractmethod
-from typing import TYPE_CHECKING, Sequence
+from math import prod
+from typing import TYPE_CHECKING, Any, Sequence
+
+import torch
 
 if TYPE_CHECKING:
     from gfn.env import Env
 
-import torch
+from gfn.states import DiscreteStates, States
+
+HEADER_FILENAME = "header.json"
 
 
 class Container(ABC):
@@ -18,7 +24,7 @@ class Container(ABC):
         """Returns the number of elements in the container."""
 
     @abstractmethod
-    def __getitem__(self, index: int | Sequence[int]) -> Container:
+    def __getitem__(self, index: int | Sequence[int] | torch.Tensor) -> Container:
         """Subsets the container."""
 
     @abstractmethod
@@ -29,26 +35,233 @@ class Container(ABC):
         """Samples a subset of the container."""
         return self[torch.randperm(len(self))[:n_samples]]
 
-    def save(self, path: str) -> None:
-        """Saves the container to a file."""
-        for key, val in self.__dict__.items():
-            if isinstance(val, Env):
-                continue
-            elif isinstance(val, Container):
-                val.save(os.path.join(path, key))
-            elif isinstance(val, torch.Tensor):
-                torch.save(val, os.path.join(path, key + ".pt"))
-            else:
-                raise ValueError(f"Unexpected {key} of type {type(val)}")
-
-    def load(self, path: str) -> None:
-        """Loads the container from a file, overwriting the current container."""
-        for key, val in self.__dict__.items():
-            if isinstance(val, Env):
-                continue
-            elif isinstance(val, Container):
-                val.load(os.path.join(path, key))
-            elif isinstance(val, torch.Tensor):
-                self.__dict__[key] = torch.load(os.path.join(path, key + ".pt"))
-            else:
-                raise ValueError(f"Unexpected {key} of type {type(val)}")
+    def get_columns(self) -> dict[str, torch.Tensor]:
+        """Returns the tensors of the container, with the elements along dimension 0.
+
+        This is the representation used by `save`. Absent optional attributes are
+        left out of the returned dictionary.
+        """
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not support saving to disk."
+        )
+
+    def set_columns(self, columns: dict[str, torch.Tensor]) -> None:
+        """Sets the tensors of the container from columns returned by `get_columns`."""
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not support loading from disk."
+        )
+
+    def get_attributes(self) -> dict[str, Any]:
+        """Returns the scalar attributes of the container, e.g. `is_backward`."""
+        return {
+            key: val
+            for key, val in self.__dict__.items()
+            if isinstance(val, (bool, int, float))
+        }
+
+    def share_memory_(self) -> Container:
+        """Moves the tensors of the container to shared memory, in place.
+
+        This is a no-op for tensors already in shared memory, and for CUDA tensors.
+        """
+        for tensor in self.get_columns().values():
+            tensor.share_memory_()
+        return self
+
+    def to_shared(self) -> tuple[dict[str, torch.Tensor], dict[str, Any]]:
+        """Returns an env-free representation of the container, in shared memory.
+
+        The returned columns and attributes do not reference the environment, and can
+        be sent to other processes, e.g. through a `torch.multiprocessing` queue, which
+        then only sends handles to the shared memory rather than copies of the
+        tensors. Use `from_shared` to rebuild the container.
+        """
+        self.share_memory_()
+        columns = {key: val.detach() for key, val in self.get_columns().items()}
+        return columns, self.get_attributes()
+
+    @classmethod
+    def from_shared(
+        cls, env: Env, shared: tuple[dict[str, torch.Tensor], dict[str, Any]]
+    ) -> Container:
+        """Rebuilds a container from the output of `to_shared`, without copies.
+
+        Args:
+            env: the local environment to attach the container to.
+            shared: the columns and attributes returned by `to_shared`.
+        """
+        columns, attributes = shared
+        container = cls(env)
+        container.__dict__.update(attributes)
+        container.set_columns(columns)
+        return container
+
+    def save(self, path: str, append: bool = False) -> None:
+        """Saves the container to a directory, in a columnar format.
+
+        See `save_columns` for a description of the format.
+
+        Args:
+            path: the directory in which the container is saved.
+            append: whether to append the elements to those already saved in `path`,
+                rather than overwriting them.
+        """
+        save_columns(path, self.get_columns(), self.get_attributes(), append=append)
+
+    def load(self, path: str, mmap: bool = False) -> None:
+        """Loads the container from a directory, overwriting the current container.
+
+        Args:
+            path: the directory in which the container was saved.
+            mmap: whether to memory-map the saved arrays, rather than reading them.
+                As long as the files hold a single chunk, the loaded container is then
+                a copy-on-write view of the files, opened in constant time.
+        """
+        chunks = load_columns(path, mmap=mmap)
+        for i, (columns, attributes) in enumerate(chunks):
+            container = self if i == 0 else self.__class__(self.env)
+            container.__dict__.update(attributes)
+            container.set_columns(columns)
+            if i > 0:
+                self.extend(container)
+
+
+def states_to_columns(states: States, name: str) -> dict[str, torch.Tensor]:
+    """Returns the tensors representing a batch of states, keyed by column names."""
+    columns = {name: states.tensor}
+    if isinstance(states, DiscreteStates):
+        columns[f"{name}.forward_masks"] = states.forward_masks
+        columns[f"{name}.backward_masks"] = states.backward_masks
+    return columns
+
+
+def states_from_columns(
+    states_class: type[States], columns: dict[str, torch.Tensor], name: str
+) -> States:
+    """Builds a batch of states from the columns returned by `states_to_columns`."""
+    if issubclass(states_class, DiscreteStates):
+        return states_class(
+            columns[name],
+            forward_masks=columns[f"{name}.forward_masks"],
+            backward_masks=columns[f"{name}.backward_masks"],
+        )
+    return states_class(columns[name])
+
+
+def save_columns(
+    path: str,
+    columns: dict[str, torch.Tensor],
+    attributes: dict[str, Any] | None = None,
+    append: bool = False,
+) -> None:
+    """Saves tensors sharing their first dimension, in a columnar format.
+
+    Each tensor is written as a raw, contiguous array of fixed dtype, with one file
+    per column. A small JSON header holds the dtypes, the shapes of the rows, the
+    number of rows, and the `attributes`. Appending rows whose columns have the same
+    dtypes and row shapes as the last saved ones only writes the new rows at the end
+    of the existing files; otherwise a new chunk (i.e. a new set of files) is started.
+    Saving without appending writes new chunks, and the files of the previous ones
+    are only deleted once the new header is written. The header is replaced
+    atomically after the arrays are written, so that an interrupted save leaves the
+    previously saved rows readable.
+
+    Args:
+        path: the directory in which the columns are saved.
+        columns: the tensors to save, with the rows along their first dimension.
+        attributes: JSON-serializable attributes saved alongside the columns.
+        append: whether to append the rows to those already saved in `path`.
+
+    Raises:
+        ValueError: if the columns do not have the same number of rows, or if the
+            attributes differ from the saved ones when appending.
+    """
+    lengths = {len(tensor) for tensor in columns.values()}
+    if len(lengths) > 1:
+        raise ValueError(f"Columns have different numbers of rows: {lengths}.")
+    length = lengths.pop() if lengths else 0
+    attributes = attributes if attributes is not None else {}
+    specs = {
+        key: {"dtype": str(tensor.dtype), "shape": list(tensor.shape[1:])}
+        for key, tensor in columns.items()
+    }
+
+    header_path = os.path.join(path, HEADER_FILENAME)
+    previous_header = None
+    if os.path.exists(header_path):
+        with open(header_path) as f:
+            previous_header = json.load(f)
+    if append and previous_header is not None:
+        header = previous_header
+        if header["attributes"] != attributes:
+            raise ValueError(
+                f"Cannot append rows with attributes {attributes} to rows with "
+                f"attributes {header['attributes']}."
+            )
+    else:
+        # The chunks of the previous header keep their files until it is replaced.
+        next_id = previous_header["next_id"] if previous_header is not None else 0
+        header = {"attributes": attributes, "chunks": [], "next_id": next_id}
+    os.makedirs(path, exist_ok=True)
+
+    chunks = header["chunks"]
+    if not chunks or chunks[-1]["columns"] != specs:
+        chunks.append({"id": header["next_id"], "length": 0, "columns": specs})
+        header["next_id"] += 1
+    chunk = chunks[-1]
+    for key, tensor in columns.items():
+        data = tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8)
+        row_size = prod(tensor.shape[1:]) * tensor.element_size()
+        filename = os.path.join(path, f"{key}.{chunk['id']}.bin")
+        with open(filename, "ab" if chunk["length"] > 0 else "wb") as f:
+            # Drops the rows of an interrupted save, that the header does not know of.
+            f.truncate(chunk["length"] * row_size)
+            f.seek(0, os.SEEK_END)
+            f.write(data.numpy().tobytes())
+    chunk["length"] += length
+
+    with open(header_path + ".tmp", "w") as f:
+        json.dump(header, f)
+    os.replace(header_path + ".tmp", header_path)
+
+    if not append and previous_header is not None:
+        for previous_chunk in previous_header["chunks"]:
+            for key in previous_chunk["columns"]:
+                filename = os.path.join(path, f"{key}.{previous_chunk['id']}.bin")
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+
+def load_columns(
+    path: str, mmap: bool = False
+) -> list[tuple[dict[str, torch.Tensor], dict[str, Any]]]:
+    """Loads columns saved with `save_columns`.
+
+    Args:
+        path: the directory in which the columns were saved.
+        mmap: whether to memory-map the files rather than reading them, in which case
+            opening the columns takes constant time, and rows are only read from disk
+            when accessed. Memory-mapped tensors are copy-on-write: modifying them
+            does not modify the files.
+
+    Returns:
+        A list with, for each chunk, the dictionary of columns and the attributes.
+    """
+    with open(os.path.join(path, HEADER_FILENAME)) as f:
+        header = json.load(f)
+
+    chunks = []
+    for chunk in header["chunks"]:
+        columns = {}
+        for key, spec in chunk["columns"].items():
+            dtype = getattr(torch, spec["dtype"].removeprefix("torch."))
+            shape = (chunk["length"], *spec["shape"])
+            tensor = torch.from_file(
+                os.path.join(path, f"{key}.{chunk['id']}.bin"),
+                shared=False,
+                size=torch.Size(shape).numel(),
+                dtype=dtype,
+            ).view(shape)
+            columns[key] = tensor if mmap else tensor.clone()
+        chunks.append((columns, header["attributes"]))
+    return chunks
@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any, Callable
+
+import torch
+
+from gfn.containers.base import Container
+
+if TYPE_CHECKING:
+    from gfn.env import Env
+
+
+class Prefetcher:
+    """Stages batches sampled on the host onto the device of an environment.
+
+    Replay buffers can be kept in host memory, e.g. to hold more objects than fit on
+    the accelerator, by attaching them to a copy of the environment on the CPU. The
+    prefetcher then samples the next batch (e.g. `lambda: buffer.sample(n)`) while
+    the current one is used for training: its columns are copied into pinned host
+    buffers, and from there to the device asynchronously, on a side CUDA stream. The
+    batches are rebuilt on the device without copies, and attached to `env`.
+
+    On the CPU, no copy is made: batches are only attached to `env` if they are not
+    already, and the prefetcher reduces to calling `sample_fn`.
+
+    Attributes:
+        sample_fn: the function returning the next batch, on the host.
+        env: the environment to which the returned batches are attached, whose device
+            they are copied to.
+    """
+
+    def __init__(self, sample_fn: Callable[[], Container], env: Env):
+        """Initializes the prefetcher. Sampling starts with the first `get`.
+
+        Args:
+            sample_fn: returns a batch of trajectories or transitions, e.g. sampled
+                from a replay buffer.
+            env: the environment of the training loop.
+        """
+        self.sample_fn = sample_fn
+        self.env = env
+        self.device = torch.device(env.device)
+        self._use_cuda = self.device.type == "cuda" and torch.cuda.is_available()
+        self._stream = torch.cuda.Stream(self.device) if self._use_cuda else None
+        # Two sets of pinned buffers, used in turn, so that a set is only overwritten
+        # once the copy of the batch before the previous one has completed.
+        self._pinned: list[dict[str, torch.Tensor]] = [{}, {}]
+        self._events: list[Any] = [None, None]
+        self._slot = 0
+        self._next: Container | None = None
+
+    def _pin(self, columns: dict[str, torch.Tensor]) -> dict[str, torch.Tensor]:
+        """Copies the columns into the current set of pinned buffers."""
+        pinned = self._pinned[self._slot]
+        if self._events[self._slot] is not None:
+            self._events[self._slot].synchronize()
+        for key, column in columns.items():
+            buffer = pinned.get(key)
+            if (
+                buffer is None
+                or buffer.shape != column.shape
+                or buffer.dtype != column.dtype
+            ):
+                buffer = torch.empty(column.shape, dtype=column.dtype, pin_memory=True)
+                pinned[key] = buffer
+            buffer.copy_(column)
+        return {key: pinned[key] for key in columns}
+
+    def _stage(self) -> Container:
+        """Samples the next batch and starts its transfer to the device."""
+        batch = self.sample_fn()
+        if not isinstance(batch, Container):
+            raise TypeError(f"Cannot prefetch batches of type {type(batch).__name__}.")
+        if not self._use_cuda:
+            if batch.env is self.env:
+                return batch
+            return type(batch).from_shared(
+                self.env, (batch.get_columns(), batch.get_attributes())
+            )
+
+        columns = self._pin(batch.get_columns())
+        with torch.cuda.stream(self._stream):
+            columns = {
+                key: val.to(self.device, non_blocking=True)
+                for key, val in columns.items()
+            }
+            event = torch.cuda.Event()
+            event.record(self._stream)
+        self._events[self._slot] = event
+        self._slot = 1 - self._slot
+        return type(batch).from_shared(self.env, (columns, batch.get_attributes()))
+
+    def _wait(self, batch: Container) -> None:
+        """Makes the current stream wait for the transfer of the batch."""
+        if not self._use_cuda:
+            return
+        stream = torch.cuda.current_stream(self.device)
+        stream.wait_stream(self._stream)
+        # The tensors were allocated on the side stream, but are used on this one.
+        for column in batch.get_columns().values():
+            column.record_stream(stream)
+
+    def get(self) -> Container:
+        """Returns the next batch, and starts staging the one after it."""
+        batch = self._next if self._next is not None else self._stage()
+        self._wait(batch)
+        self._next = self._stage()
+        return batch
+
+    def __iter__(self) -> Prefetcher:
+        return self
+
+    def __next__(self) -> Container:
+        return self.get()
@@ -3,21 +3,85 @@ from __future__ import annotations
 import os
 from typing import TYPE_CHECKING, Literal
 
+import torch
+from torchtyping import TensorType as TT
+
+from gfn.containers.base import (
+    HEADER_FILENAME,
+    load_columns,
+    save_columns,
+    states_from_columns,
+    states_to_columns,
+)
 from gfn.containers.trajectories import Trajectories
 from gfn.containers.transitions import Transitions
+from gfn.states import States
 
 if TYPE_CHECKING:
     from gfn.env import Env
-    from gfn.states import States
+
+
+def _get_device(objects: Trajectories | Transitions | States) -> torch.device:
+    """Returns the device on which the objects are stored."""
+    return objects.device if isinstance(objects, States) else objects.states.device
+
+
+def _set_objects(
+    storage: Trajectories | Transitions | States,
+    index: TT["n_objects", torch.long],
+    objects: Trajectories | Transitions | States,
+) -> None:
+    """Overwrites the objects of `storage` at `index` with objects of the same type."""
+    if isinstance(storage, Trajectories):
+        assert isinstance(objects, Trajectories)
+        storage[index] = objects
+    elif isinstance(storage, Transitions):
+        assert isinstance(objects, Transitions)
+        storage[index] = objects
+    else:
+        assert isinstance(objects, States)
+        storage[index] = objects
+
+
+def sample_distinct_indices(
+    size: int, n_samples: int, device: torch.device | str | None = None
+) -> TT["n_samples", torch.long]:
+    """Samples `min(n_samples, size)` distinct indices of `[0, size)`, in random order.
+
+    When few indices are sampled, they are drawn with replacement, and duplicates are
+    rejected (keeping the first draws), at a cost that grows with `n_samples` rather
+    than with `size`, as a random permutation of `[0, size)` would.
+    """
+    n_samples = min(n_samples, size)
+    if 4 * n_samples > size:
+        return torch.randperm(size, device=device)[:n_samples]
+    index = torch.empty(0, dtype=torch.long, device=device)
+    while len(index) < n_samples:
+        candidates = torch.randint(size, (2 * (n_samples - len(index)),), device=device)
+        candidates = torch.cat([index, candidates])
+        unique, inverse = torch.unique(candidates, return_inverse=True)
+        first_draws = torch.full_like(unique, len(candidates)).scatter_reduce_(
+            0, inverse, torch.arange(len(candidates), device=device), "amin"
+        )
+        index = candidates[first_draws.sort().values]
+    return index[:n_samples]
 
 
 class ReplayBuffer:
     """A replay buffer of trajectories or transitions.
 
+    The buffer is backed by preallocated storage of fixed capacity, used as a
+    circular buffer: new objects are written in place at a head pointer, overwriting
+    the oldest ones once the buffer is full, and sampling only gathers the requested
+    objects. Trajectories are stored padded to a common maximum length; the storage
+    is reallocated (with a geometrically increasing length) if longer trajectories
+    are added.
+
     Attributes:
         env: the Environment instance.
         loss_fn: the Loss instance
         capacity: the size of the buffer.
+        max_length: the length to which trajectories are padded in the storage.
         training_objects: the buffer of objects used for training.
         terminating_states: a States class representation of $s_f$.
         objects_type: the type of buffer (transitions, trajectories, or states).
@@ -28,6 +92,7 @@ class ReplayBuffer:
         env: Env,
         objects_type: Literal["transitions", "trajectories", "states"],
         capacity: int = 1000,
+        max_length: int | None = None,
     ):
         """Instantiates a replay buffer.
         Args:
@@ -35,10 +100,15 @@ class ReplayBuffer:
             loss_fn: the Loss instance.
             capacity: the size of the buffer.
             objects_type: the type of buffer (transitions, trajectories, or states).
+            max_length: the length to which trajectories are padded in the storage.
+                If None, the length of the longest trajectories added so far is used.
+                Only used when `objects_type` is "trajectories".
         """
         self.env = env
         self.capacity = capacity
-        self.terminating_states = None
+        self.max_length = max_length
+        self.training_objects: Trajectories | Transitions | States
+        self.terminating_states: States | None = None
         if objects_type == "trajectories":
             self.training_objects = Trajectories(env)
             self.objects_type = "trajectories"
@@ -52,53 +122,787 @@ class ReplayBuffer:
         else:
             raise ValueError(f"Unknown objects_type: {objects_type}")
 
-        self._is_full = False
+        # The storage is only allocated when the first objects are added. `_index` is
+        # the position of the next write, and `_size` the number of stored objects.
         self._index = 0
+        self._size = 0
+        self._terminating_index = 0
+        self._terminating_size = 0
+        # Checkpointing state: the directory of the last save, and for each storage,
+        # the number of rows saved there and the number of objects written since, in
+        # the order of the circular buffer. None means that the next save rewrites
+        # all the objects.
+        self._save_directory: str | None = None
+        self._n_saved_rows = {"training_objects": 0, "terminating_states": 0}
+        self._n_unsaved: dict[str, int | None] = {
+            "training_objects": None,
+            "terminating_states": None,
+        }
 
     def __repr__(self):
         return f"ReplayBuffer(capacity={self.capacity}, containing {len(self)} {self.objects_type})"
 
     def __len__(self):
-        return self.capacity if self._is_full else self._index
+        return self._size
+
+    def _allocate(
+        self,
+        storage: Trajectories | Transitions | States,
+        size: int,
+        prototype: Trajectories | Transitions | States,
+    ) -> Trajectories | Transitions | States:
+        """Allocates a storage of `capacity` objects, shaped after `prototype`.
+
+        The `size` first objects of the current `storage` are copied to the new one.
+        """
+        device = _get_device(prototype)
+        if isinstance(prototype, Trajectories):
+            assert isinstance(storage, Trajectories)
+            stored_length = storage.actions.batch_shape[0]
+            if prototype.max_length > stored_length > 0:
+                # Grow geometrically, so that repeated reallocations are amortized.
+                stored_length *= 2
+            max_length = max(self.max_length or 0, prototype.max_length, stored_length)
+            estimator_outputs = prototype.estimator_outputs
+            if estimator_outputs is not None:
+                estimator_outputs = torch.full(
+                    (max_length, self.capacity, *estimator_outputs.shape[2:]),
+                    fill_value=-float("inf"),
+                    dtype=estimator_outputs.dtype,
+                    device=device,
+                )
+            new_storage = Trajectories(
+                env=self.env,
+                states=self.env.states_from_batch_shape(
+                    (max_length + 1, self.capacity)
+                ),
+                actions=self.env.actions_from_batch_shape((max_length, self.capacity)),
+                when_is_done=torch.zeros(
+                    self.capacity, dtype=torch.long, device=device
+                ),
+                is_backward=prototype.is_backward,
+                log_rewards=(
+                    torch.full((self.capacity,), -float("inf"), device=device)
+                    if prototype._log_rewards is not None
+                    else None
+                ),
+                log_probs=(
+                    torch.zeros((max_length, self.capacity), device=device)
+                    if prototype.log_probs.shape != (0, 0)
+                    else None
+                ),
+                estimator_outputs=estimator_outputs,
+            )
+        elif isinstance(prototype, Transitions):
+            estimator_outputs = prototype.estimator_outputs
+            if estimator_outputs is not None:
+                estimator_outputs = torch.full(
+                    (self.capacity, *estimator_outputs.shape[1:]),
+                    fill_value=-float("inf"),
+                    dtype=estimator_outputs.dtype,
+                    device=device,
+                )
+            new_storage = Transitions(
+                env=self.env,
+                states=self.env.states_from_batch_shape((self.capacity,)),
+                actions=self.env.actions_from_batch_shape((self.capacity,)),
+                is_done=torch.zeros(self.capacity, dtype=torch.bool, device=device),
+                next_states=self.env.states_from_batch_shape((self.capacity,)),
+                is_backward=prototype.is_backward,
+                log_rewards=(
+                    torch.full((self.capacity,), -float("inf"), device=device)
+                    if prototype._log_rewards is not None
+                    else None
+                ),
+                log_probs=(
+                    torch.zeros(self.capacity, device=device)
+                    if prototype.log_probs.shape == (len(prototype),)
+                    else None
+                ),
+                estimator_outputs=estimator_outputs,
+            )
+        else:
+            new_storage = self.env.states_from_batch_shape((self.capacity,))
+
+        if size > 0:
+            index = torch.arange(size, device=device)
+            _set_objects(new_storage, index, storage[index])
+        return new_storage
+
+    def _write_at(
+        self,
+        storage: Trajectories | Transitions | States,
+        size: int,
+        objects: Trajectories | Transitions | States,
+        positions: TT["n_objects", torch.long],
+    ) -> Trajectories | Transitions | States:
+        """Writes `objects` in place in `storage`, at the given positions.
+
+        Returns:
+            The storage, reallocated if it was too small for `objects`.
+        """
+        if len(storage) < self.capacity or (
+            isinstance(objects, Trajectories)
+            and isinstance(storage, Trajectories)
+            and objects.max_length > storage.actions.batch_shape[0]
+        ):
+            storage = self._allocate(storage, size, objects)
+        _set_objects(storage, positions.to(_get_device(storage)), objects)
+        return storage
+
+    def _write(
+        self,
+        storage: Trajectories | Transitions | States,
+        index: int,
+        size: int,
+        objects: Trajectories | Transitions | States,
+    ) -> tuple[Trajectories | Transitions | States, int, int]:
+        """Writes `objects` in place in the circular `storage`.
 
-    def add(self, training_objects: Transitions | Trajectories | tuple[States]):
+        Returns:
+            The storage (reallocated if needed), and the updated write index and size.
+        """
+        n_objects = len(objects)
+        if n_objects == 0:
+            return storage, index, size
+        if n_objects > self.capacity:
+            # Only the most recent objects would remain in the buffer.
+            objects = objects[torch.arange(n_objects - self.capacity, n_objects)]
+            n_objects = self.capacity
+
+        positions = (index + torch.arange(n_objects)) % self.capacity
+        storage = self._write_at(storage, size, objects, positions)
+        return (
+            storage,
+            (index + n_objects) % self.capacity,
+            min(size + n_objects, self.capacity),
+        )
+
+    def _record_writes(self, name: str, n_objects: int | None) -> None:
+        """Records that `n_objects` were written at the head of a storage since the
+        last save, or, if None, that objects were written elsewhere."""
+        n_unsaved = self._n_unsaved[name]
+        self._n_unsaved[name] = (
+            None if n_unsaved is None or n_objects is None else n_unsaved + n_objects
+        )
+
+    def add(self, training_objects: Transitions | Trajectories | tuple[States, States]):
         """Adds a training object to the buffer."""
-        terminating_states = None
         if isinstance(training_objects, tuple):
             assert self.objects_type == "states" and self.terminating_states is not None
-            training_objects, terminating_states = training_objects
-
-        to_add = len(training_objects)
-
-        self._is_full |= self._index + to_add >= self.capacity
-        self._index = (self._index + to_add) % self.capacity
+            objects, terminating_states = training_objects
+        else:
+            objects, terminating_states = training_objects, None
 
-        self.training_objects.extend(training_objects)
-        self.training_objects = self.training_objects[-self.capacity :]
+        self.training_objects, self._index, self._size = self._write(
+            self.training_objects, self._index, self._size, objects
+        )
+        self._record_writes("training_objects", len(objects))
 
         if self.terminating_states is not None:
             assert terminating_states is not None
-            self.terminating_states.extend(terminating_states)
-            self.terminating_states = self.terminating_states[-self.capacity :]
+            self._record_writes("terminating_states", len(terminating_states))
+            (
+                terminating_storage,
+                self._terminating_index,
+                self._terminating_size,
+            ) = self._write(
+                self.terminating_states,
+                self._terminating_index,
+                self._terminating_size,
+                terminating_states,
+            )
+            assert isinstance(terminating_storage, States)
+            self.terminating_states = terminating_storage
 
-    def sample(self, n_trajectories: int) -> Transitions | Trajectories | tuple[States]:
+    @staticmethod
+    def _sample(
+        storage: Trajectories | Transitions | States, size: int, n_samples: int
+    ) -> Trajectories | Transitions | States:
+        """Samples `n_samples` of the `size` stored objects, without replacement."""
+        return storage[sample_distinct_indices(size, n_samples, _get_device(storage))]
+
+    def sample(
+        self, n_trajectories: int
+    ) -> Transitions | Trajectories | tuple[States, States]:
         """Samples `n_trajectories` training objects from the buffer."""
-        if self.terminating_states is not None:
-            return (
-                self.training_objects.sample(n_trajectories),
-                self.terminating_states.sample(n_trajectories),
-            )
-        return self.training_objects.sample(n_trajectories)
+        training_objects = self._sample(
+            self.training_objects, self._size, n_trajectories
+        )
+        if self.terminating_states is None:
+            assert not isinstance(training_objects, States)
+            return training_objects
+        terminating_states = self._sample(
+            self.terminating_states, self._terminating_size, n_trajectories
+        )
+        assert isinstance(training_objects, States)
+        assert isinstance(terminating_states, States)
+        return training_objects, terminating_states
+
+    def _save(
+        self,
+        name: str,
+        storage: Trajectories | Transitions | States,
+        index: int,
+        size: int,
+        directory: str,
+    ) -> None:
+        """Saves the stored objects, from the oldest to the most recent.
+
+        If the buffer was last saved to (or loaded from) the same directory, only the
+        objects written since are appended to the saved ones, unless the saved rows
+        would then exceed twice the capacity, in which case all the stored objects
+        are saved again.
+        """
+        path = os.path.join(directory, name)
+        n_unsaved = self._n_unsaved[name]
+        append = (
+            directory == self._save_directory
+            and os.path.exists(os.path.join(path, HEADER_FILENAME))
+            and n_unsaved is not None
+            and self._n_saved_rows[name] + min(n_unsaved, size) <= 2 * self.capacity
+        )
+        n_objects = min(n_unsaved, size) if append and n_unsaved is not None else size
+        objects = storage[(index - n_objects + torch.arange(n_objects)) % self.capacity]
+        if isinstance(objects, States):
+            save_columns(path, states_to_columns(objects, "states"), append=append)
+        else:
+            objects.save(path, append=append)
+        self._n_saved_rows[name] = (
+            self._n_saved_rows[name] + n_objects if append else n_objects
+        )
+        self._n_unsaved[name] = 0
+
+    def _load(
+        self,
+        name: str,
+        storage: Trajectories | Transitions | States,
+        directory: str,
+        mmap: bool,
+    ) -> tuple[Trajectories | Transitions | States, int]:
+        """Loads objects saved with `_save`, keeping the `capacity` most recent ones.
+
+        Returns:
+            The loaded objects, and their number.
+        """
+        path = os.path.join(directory, name)
+        if isinstance(storage, States):
+            chunks = load_columns(path, mmap=mmap)
+            storage = states_from_columns(self.env.States, chunks[0][0], "states")
+            for columns, _ in chunks[1:]:
+                storage.extend(states_from_columns(self.env.States, columns, "states"))
+        else:
+            storage.load(path, mmap=mmap)
+        self._n_saved_rows[name] = len(storage)
+        self._n_unsaved[name] = 0
+        if len(storage) > self.capacity:
+            storage = storage[torch.arange(len(storage) - self.capacity, len(storage))]
+        return storage, len(storage)
 
     def save(self, directory: str):
-        """Saves the buffer to disk."""
-        self.training_objects.save(os.path.join(directory, "training_objects"))
+        """Saves the buffer to disk.
+
+        The objects are saved in the columnar format described in `save_columns`.
+        Checkpointing a buffer repeatedly to the same directory only writes the
+        objects added since the previous save.
+        """
+        self._save(
+            "training_objects",
+            self.training_objects,
+            self._index,
+            self._size,
+            directory,
+        )
         if self.terminating_states is not None:
-            self.terminating_states.save(os.path.join(directory, "terminating_states"))
+            self._save(
+                "terminating_states",
+                self.terminating_states,
+                self._terminating_index,
+                self._terminating_size,
+                directory,
+            )
+        self._save_directory = directory
 
-    def load(self, directory: str):
-        """Loads the buffer from disk."""
-        self.training_objects.load(os.path.join(directory, "training_objects"))
-        self._index = len(self.training_objects)
+    def load(self, directory: str, mmap: bool = False):
+        """Loads the buffer from disk.
+
+        Args:
+            directory: the directory in which the buffer was saved.
+            mmap: whether to memory-map the saved objects rather than reading them,
+                in which case they are only read from disk when sampled, until the
+                storage is reallocated (e.g. when new objects are added to a buffer
+                that is not full).
+        """
+        self.training_objects, self._size = self._load(
+            "training_objects", self.training_objects, directory, mmap
+        )
+        self._index = self._size % self.capacity
         if self.terminating_states is not None:
-            self.terminating_states.load(os.path.join(directory, "terminating_states"))
+            terminating_storage, self._terminating_size = self._load(
+                "terminating_states", self.terminating_states, directory, mmap
+            )
+            assert isinstance(terminating_storage, States)
+            self.terminating_states = terminating_storage
+            self._terminating_index = self._terminating_size % self.capacity
+        self._save_directory = directory
+
+
+class SumTree:
+    """A binary tree whose leaves hold priorities, and inner nodes the sums of the
+    priorities of their children.
+
+    The tree is stored as a flat tensor: the root is at index 1, and the children of
+    node `i` are at indices `2 * i` and `2 * i + 1`. Both updates and sampling are
+    batched, and cost O(k log N) for k leaves out of N.
+
+    Attributes:
+        capacity: the number of leaves.
+        depth: the depth of the tree.
+        tree: the flat tensor of node values.
+    """
+
+    def __init__(self, capacity: int, device: torch.device | None = None):
+        """Instantiates a tree with `capacity` leaves of priority zero.
+
+        Args:
+            capacity: the number of leaves.
+            device: the device on which the tree is stored.
+        """
+        self.capacity = capacity
+        self.depth = max(capacity - 1, 0).bit_length()
+        self._first_leaf = 1 << self.depth
+        self.tree = torch.zeros(
+            2 * self._first_leaf, dtype=torch.float64, device=device
+        )
+
+    @property
+    def total(self) -> torch.Tensor:
+        """The sum of all priorities."""
+        return self.tree[1]
+
+    def __getitem__(self, index: TT["n_leaves", torch.long]) -> TT["n_leaves"]:
+        """Returns the priorities of the given leaves."""
+        return self.tree[index + self._first_leaf]
+
+    def update(
+        self, index: TT["n_leaves", torch.long], priorities: TT["n_leaves"]
+    ) -> None:
+        """Sets the priorities of the given leaves, and updates their ancestors."""
+        nodes = index.to(self.tree.device) + self._first_leaf
+        self.tree[nodes] = priorities.to(self.tree)
+        for _ in range(self.depth):
+            nodes = torch.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def sample(self, n_samples: int) -> TT["n_samples", torch.long]:
+        """Samples leaves, with replacement, proportionally to their priorities.
+
+        Raises:
+            ValueError: if all priorities are zero.
+        """
+        if self.total <= 0:
+            raise ValueError("Cannot sample from a tree whose priorities are all zero.")
+        values = torch.rand(n_samples, dtype=torch.float64, device=self.tree.device)
+        values = values * self.total
+        nodes = torch.ones(n_samples, dtype=torch.long, device=self.tree.device)
+        for _ in range(self.depth):
+            left = self.tree[2 * nodes]
+            # Never descend into a subtree of zero priority, which rounding errors
+            # could otherwise lead to.
+            go_right = (values >= left) & (self.tree[2 * nodes + 1] > 0)
+            values = torch.where(go_right, values - left, values)
+            nodes = 2 * nodes + go_right.long()
+        return nodes - self._first_leaf
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """A replay buffer sampling objects proportionally to their priority.
+
+    Priorities either derive from the log-rewards of the trajectories
+    (`priority="reward"`), or from per-sample losses reported after each training
+    step through `update_priorities` (`priority="loss"`), in which case newly added
+    objects get the highest priority seen so far. With $v$ the reward or the loss of
+    an object, its priority is $(v + \\epsilon)^\\alpha$.
+
+    The priorities are held in a `SumTree`, so that sampling $k$ objects out of $N$
+    (with replacement) costs O(k log N).
+
+    Attributes:
+        priority: where the priorities come from ("reward" or "loss").
+        alpha: the exponent applied to the priorities.
+        epsilon: the offset added to the rewards or losses.
+        last_sampled_index: the storage indices of the last sampled objects.
+    """
+
+    def __init__(
+        self,
+        env: Env,
+        objects_type: Literal["transitions", "trajectories"],
+        capacity: int = 1000,
+        max_length: int | None = None,
+        priority: Literal["reward", "loss"] = "reward",
+        alpha: float = 1.0,
+        epsilon: float = 1e-6,
+    ):
+        """Instantiates a prioritized replay buffer.
+        Args:
+            env: the Environment instance.
+            objects_type: the type of buffer (transitions or trajectories).
+            capacity: the size of the buffer.
+            max_length: the length to which trajectories are padded in the storage.
+            priority: where the priorities come from ("reward" or "loss").
+            alpha: the exponent applied to the priorities; 0 means uniform sampling.
+            epsilon: the offset added to the rewards or losses, so that all objects
+                can be sampled.
+
+        Raises:
+            ValueError: if `objects_type` is "states", or if `priority` is "reward"
+                and `objects_type` is not "trajectories".
+        """
+        if objects_type == "states":
+            raise ValueError("Prioritized replay is not supported for states.")
+        if priority not in ("reward", "loss"):
+            raise ValueError(f"Unknown priority: {priority}")
+        if priority == "reward" and objects_type != "trajectories":
+            raise ValueError("Reward-based priorities require trajectories.")
+        super().__init__(env, objects_type, capacity=capacity, max_length=max_length)
+        self.priority = priority
+        self.alpha = alpha
+        self.epsilon = epsilon
+        self.last_sampled_index = None
+        self._sum_tree = SumTree(capacity, device=env.device)
+        self._max_priority = 1.0
+
+    def _priorities(self, values: TT["n_objects"]) -> TT["n_objects"]:
+        """Returns the priorities corresponding to rewards or losses."""
+        return (values.detach().double() + self.epsilon).pow(self.alpha)
+
+    def add(self, training_objects: Transitions | Trajectories):
+        """Adds training objects to the buffer, and sets their priorities."""
+        n_objects = min(len(training_objects), self.capacity)
+        index = (self._index + torch.arange(n_objects)) % self.capacity
+        super().add(training_objects)
+        if n_objects == 0:
+            return
+
+        if self.priority == "reward":
+            log_rewards = training_objects.log_rewards
+            assert log_rewards is not None
+            log_rewards = log_rewards[len(training_objects) - n_objects :]
+            priorities = self._priorities(log_rewards.double().exp())
+        else:
+            priorities = torch.full((n_objects,), self._max_priority)
+        self._sum_tree.update(index, priorities)
+
+    def sample(self, n_trajectories: int) -> Transitions | Trajectories:
+        """Samples `n_trajectories` training objects, with replacement."""
+        index = self._sum_tree.sample(n_trajectories)
+        self.last_sampled_index = index
+        training_objects = self.training_objects[
+            index.to(_get_device(self.training_objects))
+        ]
+        assert not isinstance(training_objects, States)
+        return training_objects
+
+    def update_priorities(
+        self,
+        losses: TT["n_objects"],
+        index: TT["n_objects", torch.long] | None = None,
+    ) -> None:
+        """Updates the priorities of stored objects from their per-sample losses.
+
+        Per-sample losses can be obtained, e.g., as the squared scores returned by
+        the `get_scores` method of the GFlowNets.
+
+        Args:
+            losses: the per-sample losses.
+            index: the storage indices of the objects. Defaults to the indices of the
+                last sampled objects.
+
+        Raises:
+            ValueError: if the priorities are derived from the rewards.
+        """
+        if self.priority != "loss":
+            raise ValueError("Only loss-based priorities can be updated.")
+        if index is None:
+            index = self.last_sampled_index
+        assert index is not None and len(index) == len(losses)
+        priorities = self._priorities(losses)
+        self._max_priority = max(self._max_priority, priorities.max().item())
+        self._sum_tree.update(index, priorities)
+
+    def load(self, directory: str, mmap: bool = False):
+        """Loads the buffer from disk, and resets the priorities.
+
+        Loss-based priorities are reset to the highest priority seen so far.
+        """
+        super().load(directory, mmap=mmap)
+        self._sum_tree = SumTree(self.capacity, device=self.env.device)
+        if self.priority == "reward":
+            assert isinstance(self.training_objects, Trajectories)
+            log_rewards = self.training_objects.log_rewards
+            assert log_rewards is not None
+            log_rewards = log_rewards[: self._size]
+            priorities = self._priorities(log_rewards.double().exp())
+        else:
+            priorities = torch.full((self._size,), self._max_priority)
+        self._sum_tree.update(torch.arange(self._size), priorities)
+
+
+# Largest number of terminating states for which `DeduplicatedReplayBuffer` uses a
+# dense lookup table, rather than a search among the stored keys.
+MAX_DENSE_INDEX_SIZE = 2**24
+
+
+class DeduplicatedReplayBuffer(ReplayBuffer):
+    """A replay buffer storing at most one object per terminating state.
+
+    The buffer keeps an index of the terminating states of the stored trajectories
+    (or of the stored terminating states, for the "states" type), and rejects added
+    objects whose terminating state is already stored or repeated within the batch.
+
+    For environments that enumerate their terminating states (through
+    `get_terminating_states_indices`), the index maps these integer keys to storage
+    slots through a dense lookup table, so that duplicates are found in O(batch) per
+    `add`. Other states are keyed by a 64-bit hash of their tensors, which is looked
+    up among the sorted keys of the stored objects.
+
+    Once full, the buffer either overwrites its oldest objects (`eviction="fifo"`),
+    or only keeps the objects with the highest log-rewards (`eviction="reward"`).
+
+    Attributes:
+        eviction: which objects are evicted once the buffer is full.
+    """
+
+    def __init__(
+        self,
+        env: Env,
+        objects_type: Literal["trajectories", "states"],
+        capacity: int = 1000,
+        max_length: int | None = None,
+        eviction: Literal["fifo", "reward"] = "fifo",
+    ):
+        """Instantiates a deduplicated replay buffer.
+        Args:
+            env: the Environment instance.
+            objects_type: the type of buffer (trajectories or states).
+            capacity: the size of the buffer.
+            max_length: the length to which trajectories are padded in the storage.
+            eviction: which objects are evicted once the buffer is full: the oldest
+                ones ("fifo"), or the ones with the lowest log-rewards ("reward").
+
+        Raises:
+            ValueError: if `objects_type` is "transitions", or `eviction` is unknown.
+        """
+        if objects_type == "transitions":
+            raise ValueError("Deduplication is not supported for transitions.")
+        if eviction not in ("fifo", "reward"):
+            raise ValueError(f"Unknown eviction: {eviction}")
+        super().__init__(env, objects_type, capacity=capacity, max_length=max_length)
+        self.eviction = eviction
+
+        n_terminating_states = getattr(env, "n_terminating_states", None)
+        self._slot_of_key = None
+        if (
+            isinstance(n_terminating_states, int)
+            and n_terminating_states <= MAX_DENSE_INDEX_SIZE
+        ):
+            self._slot_of_key = torch.full(
+                (n_terminating_states,), -1, dtype=torch.long, device=env.device
+            )
+        self._hash_multipliers = None
+        self._keys = torch.zeros(capacity, dtype=torch.long, device=env.device)
+        self._log_rewards = torch.full((capacity,), -float("inf"), device=env.device)
+
+    def _get_keys(self, states: States) -> TT["n_states", torch.long]:
+        """Returns the keys under which terminating states are indexed."""
+        if self._slot_of_key is not None:
+            return self.env.get_terminating_states_indices(states)
+
+        tensor = states.tensor.reshape(len(states), -1)
+        if tensor.is_floating_point():
+            # Hashes the bit patterns of the values, after identifying -0.0 and 0.0.
+            tensor = (tensor.double() + 0.0).view(torch.int64)
+        else:
+            tensor = tensor.long()
+        if self._hash_multipliers is None:
+            generator = torch.Generator().manual_seed(0)
+            self._hash_multipliers = torch.randint(
+                -(2**62), 2**62, (tensor.shape[-1],), generator=generator
+            ).bitwise_or(1)
+        # Integer overflows wrap around, which is all a hash needs.
+        return (tensor * self._hash_multipliers.to(tensor.device)).sum(-1)
+
+    def _find_slots(
+        self, keys: TT["n_keys", torch.long], size: int
+    ) -> TT["n_keys", torch.long]:
+        """Returns the storage slots of the given keys, or -1 for unknown keys."""
+        if self._slot_of_key is not None:
+            return self._slot_of_key[keys]
+        if size == 0:
+            return torch.full_like(keys, -1)
+        sorted_keys, order = torch.sort(self._keys[:size])
+        position = torch.searchsorted(sorted_keys, keys).clamp(max=size - 1)
+        return torch.where(sorted_keys[position] == keys, order[position], -1)
+
+    def _get_terminating_states_and_log_rewards(
+        self, objects: Trajectories | States
+    ) -> tuple[States, TT["n_objects", torch.float]]:
+        """Returns the terminating states of the objects, and their log-rewards."""
+        if isinstance(objects, Trajectories):
+            states = objects.states[0] if objects.is_backward else objects.last_states
+            assert objects.log_rewards is not None
+            return states, objects.log_rewards
+        if objects.log_rewards is not None:
+            return objects, objects.log_rewards
+        try:
+            return objects, self.env.log_reward(objects)
+        except NotImplementedError:
+            return objects, torch.log(self.env.reward(objects))
+
+    def _add_unique(
+        self,
+        storage: Trajectories | States,
+        index: int,
+        size: int,
+        objects: Trajectories | States,
+    ) -> tuple[Trajectories | States, int, int, int | None]:
+        """Writes the objects with new terminating states in the storage.
+
+        Returns:
+            The storage (reallocated if needed), the updated write index and size, and
+            the number of objects written at the head of the storage, or None if
+            objects were written elsewhere.
+        """
+        if len(objects) == 0:
+            return storage, index, size, 0
+        states, log_rewards = self._get_terminating_states_and_log_rewards(objects)
+        keys = self._get_keys(states).to(self._keys.device)
+        log_rewards = log_rewards.to(self._log_rewards)
+
+        # Keeps the first occurrence of each key that is not already stored.
+        unique_keys, inverse = torch.unique(keys, return_inverse=True)
+        first = torch.full_like(unique_keys, len(keys)).scatter_reduce(
+            0, inverse, torch.arange(len(keys), device=keys.device), reduce="amin"
+        )
+        first = first[self._find_slots(unique_keys, size) < 0].sort().values
+        if len(first) == 0:
+            return storage, index, size, 0
+
+        if self.eviction == "fifo":
+            selected = first[-self.capacity :]
+            positions = (index + torch.arange(len(selected))) % self.capacity
+            index = (index + len(selected)) % self.capacity
+        else:
+            # Fills the free slots with the best new objects, then replaces the
+            # worst stored objects with the remaining new ones, as long as the
+            # latter are better.
+            order = first[torch.argsort(log_rewards[first], descending=True)]
+            n_free = min(self.capacity - size, len(order))
+            selected = order[:n_free]
+            positions = torch.arange(size, size + n_free)
+            self._log_rewards[positions] = log_rewards[selected]
+            remaining = order[n_free:][: self.capacity]
+            if len(remaining) > 0:
+                lowest = torch.topk(self._log_rewards, len(remaining), largest=False)
+                is_better = log_rewards[remaining] > lowest.values
+                selected = torch.cat((selected, remaining[is_better]))
+                positions = torch.cat((positions, lowest.indices[is_better].cpu()))
+
+        positions = positions.to(self._keys.device)
+        if self._slot_of_key is not None:
+            evicted = positions[positions < size]
+            self._slot_of_key[self._keys[evicted]] = -1
+            self._slot_of_key[keys[selected]] = positions
+        self._keys[positions] = keys[selected]
+        self._log_rewards[positions] = log_rewards[selected]
+
+        new_storage = self._write_at(storage, size, objects[selected], positions)
+        assert not isinstance(new_storage, Transitions)
+        return (
+            new_storage,
+            index,
+            min(size + len(selected), self.capacity),
+            len(selected) if self.eviction == "fifo" else None,
+        )
+
+    def add(self, training_objects: Trajectories | tuple[States, States]):
+        """Adds the objects with new terminating states to the buffer."""
+        if self.objects_type == "trajectories":
+            assert not isinstance(self.training_objects, Transitions)
+            assert not isinstance(training_objects, tuple)
+            (
+                self.training_objects,
+                self._index,
+                self._size,
+                n_written,
+            ) = self._add_unique(
+                self.training_objects, self._index, self._size, training_objects
+            )
+            self._record_writes("training_objects", n_written)
+            return
+
+        assert isinstance(training_objects, tuple)
+        assert self.terminating_states is not None
+        intermediary_states, terminating_states = training_objects
+        self.training_objects, self._index, self._size = self._write(
+            self.training_objects, self._index, self._size, intermediary_states
+        )
+        self._record_writes("training_objects", len(intermediary_states))
+        (
+            terminating_storage,
+            self._terminating_index,
+            self._terminating_size,
+            n_written,
+        ) = self._add_unique(
+            self.terminating_states,
+            self._terminating_index,
+            self._terminating_size,
+            terminating_states,
+        )
+        assert isinstance(terminating_storage, States)
+        self.terminating_states = terminating_storage
+        self._record_writes("terminating_states", n_written)
+
+    def sample(self, n_trajectories: int) -> Trajectories | tuple[States, States]:
+        """Samples `n_trajectories` training objects from the buffer.
+
+        Sampled terminating states carry their log-rewards.
+        """
+        if self.objects_type == "trajectories":
+            training_objects = super().sample(n_trajectories)
+            assert not isinstance(training_objects, Transitions)
+            return training_objects
+        assert self.terminating_states is not None
+        index = sample_distinct_indices(
+            self._terminating_size, n_trajectories, self._keys.device
+        )
+        terminating_states = self.terminating_states[
+            index.to(self.terminating_states.device)
+        ]
+        terminating_states.log_rewards = self._log_rewards[index]
+        training_objects = self._sample(
+            self.training_objects, self._size, n_trajectories
+        )
+        assert isinstance(training_objects, States)
+        return training_objects, terminating_states
+
+    def load(self, directory: str, mmap: bool = False):
+        """Loads the buffer from disk, and rebuilds the index of terminating states."""
+        super().load(directory, mmap=mmap)
+        if self.objects_type == "trajectories":
+            storage, size = self.training_objects, self._size
+        else:
+            storage, size = self.terminating_states, self._terminating_size
+        assert storage is not None and not isinstance(storage, Transitions)
+
+        states, log_rewards = self._get_terminating_states_and_log_rewards(
+            storage[torch.arange(size)]
+        )
+        keys = self._get_keys(states).to(self._keys.device)
+        self._keys[:size] = keys
+        self._log_rewards.fill_(-float("inf"))
+        self._log_rewards[:size] = log_rewards.to(self._log_rewards)
+        if self._slot_of_key is not None:
+            self._slot_of_key.fill_(-1)
+            self._slot_of_key[keys] = torch.arange(size, device=keys.device)
@@ -12,7 +12,7 @@ import torch
 from torch import Tensor
 from torchtyping import TensorType as TT
 
-from gfn.containers.base import Container
+from gfn.containers.base import Container, states_from_columns, states_to_columns
 from gfn.containers.transitions import Transitions
 
 
@@ -145,7 +145,7 @@ class Trajectories(Container):
         except NotImplementedError:
             return torch.log(self.env.reward(self.last_states))
 
-    def __getitem__(self, index: int | Sequence[int]) -> Trajectories:
+    def __getitem__(self, index: int | Sequence[int] | torch.Tensor) -> Trajectories:
         """Returns a subset of the `n_trajectories` trajectories."""
         if isinstance(index, int):
             index = [index]
@@ -190,6 +190,102 @@ class Trajectories(Container):
             estimator_outputs=estimator_outputs,
         )
 
+    def __setitem__(
+        self, index: int | Sequence[int] | torch.Tensor, other: Trajectories
+    ) -> None:
+        """Overwrites a subset of the trajectories, in place, with `other`.
+
+        `other` can be shorter than the current trajectories, in which case the
+        written trajectories are padded up to `self.max_length`. This allows, e.g.,
+        the replay buffer to write new trajectories into preallocated storage.
+
+        Args:
+            index: the indices of the trajectories to overwrite.
+            other: the trajectories to write, with `len(other)` matching `index`.
+
+        Raises:
+            ValueError: if `other` is longer than the current trajectories.
+        """
+        if isinstance(index, int):
+            index = [index]
+        if len(other) == 0:
+            return
+
+        max_length = self.actions.batch_shape[0]
+        other_max_length = other.actions.batch_shape[0]
+        if other_max_length > max_length:
+            raise ValueError(
+                f"Cannot write trajectories of length {other_max_length} into "
+                f"trajectories of length {max_length}."
+            )
+
+        # The last row of `other.states` only contains padding states ($s_f$, or $s_0$
+        # for backward trajectories), it is broadcast over the remaining time steps.
+        self.states[: other_max_length + 1, index] = other.states
+        self.states[other_max_length + 1 :, index] = other.states[-1:]
+        self.actions[:other_max_length, index] = other.actions
+        self.actions.tensor[other_max_length:, index] = self.actions.dummy_action
+        self.when_is_done[index] = other.when_is_done
+        if self._log_rewards is not None:
+            self._log_rewards[index] = other.log_rewards
+        if self.log_probs.shape != (0, 0):
+            self.log_probs[:other_max_length, index] = other.log_probs
+            self.log_probs[other_max_length:, index] = 0
+        if is_tensor(self.estimator_outputs):
+            assert is_tensor(other.estimator_outputs)
+            self.estimator_outputs[:other_max_length, index] = (
+                other.estimator_outputs.to(dtype=self.estimator_outputs.dtype)
+            )
+            self.estimator_outputs[other_max_length:, index] = -float("inf")
+
+    def get_columns(self) -> dict[str, torch.Tensor]:
+        """Returns the tensors of the trajectories, keyed by column names.
+
+        The tensors indexed by time step are transposed, so that the trajectories are
+        along their first dimension.
+        """
+        columns = {
+            key: val.transpose(0, 1)
+            for key, val in states_to_columns(self.states, "states").items()
+        }
+        columns["actions"] = self.actions.tensor.transpose(0, 1)
+        columns["when_is_done"] = self.when_is_done
+        if self._log_rewards is not None:
+            columns["log_rewards"] = self._log_rewards
+        if self.log_probs.shape != (0, 0):
+            columns["log_probs"] = self.log_probs.transpose(0, 1)
+        if is_tensor(self.estimator_outputs):
+            columns["estimator_outputs"] = self.estimator_outputs.transpose(0, 1)
+        return columns
+
+    def set_columns(self, columns: dict[str, Tensor]) -> None:
+        """Sets the tensors of the trajectories from columns returned by `get_columns`.
+
+        The tensors are transposed back, without copies.
+        """
+        self.states = states_from_columns(
+            self.env.States,
+            {
+                key: val.transpose(0, 1)
+                for key, val in columns.items()
+                if key.startswith("states")
+            },
+            "states",
+        )
+        self.actions = self.env.Actions(columns["actions"].transpose(0, 1))
+        self.when_is_done = columns["when_is_done"]
+        self._log_rewards = columns.get("log_rewards")
+        self.log_probs = (
+            columns["log_probs"].transpose(0, 1)
+            if "log_probs" in columns
+            else torch.full(size=(0, 0), fill_value=0, dtype=torch.float)
+        )
+        self.estimator_outputs = (
+            columns["estimator_outputs"].transpose(0, 1)
+            if "estimator_outputs" in columns
+            else None
+        )
+
     @staticmethod
     def extend_log_probs(
         log_probs: TT["max_length", "n_trajectories", torch.float], new_max_length: int
@@ -326,6 +422,11 @@ class Trajectories(Container):
                 dim=0,
             )
         log_probs = self.log_probs[~self.actions.is_dummy]
+        estimator_outputs = (
+            self.estimator_outputs[~self.actions.is_dummy]
+            if is_tensor(self.estimator_outputs)
+            else None
+        )
         return Transitions(
             env=self.env,
             states=states,
@@ -335,6 +436,7 @@ class Trajectories(Container):
             is_backward=self.is_backward,
             log_rewards=log_rewards,
             log_probs=log_probs,
+            estimator_outputs=estimator_outputs,
         )
 
     def to_states(self) -> States:
@@ -10,7 +10,7 @@ if TYPE_CHECKING:
     from gfn.env import Env
     from gfn.states import States
 
-from gfn.containers.base import Container
+from gfn.containers.base import Container, states_from_columns, states_to_columns
 
 
 class Transitions(Container):
@@ -27,6 +27,8 @@ class Transitions(Container):
         next_states: States object with uni-dimensional `batch_shape`, representing
             the children of the transitions.
         log_probs: The log-probabilities of the actions.
+        estimator_outputs: The outputs of the estimator at the states, if they were
+            stored when sampling the actions.
     """
 
     def __init__(
@@ -39,6 +41,7 @@ class Transitions(Container):
         is_backward: bool = False,
         log_rewards: TT["n_transitions", torch.float] | None = None,
         log_probs: TT["n_transitions", torch.float] | None = None,
+        estimator_outputs: torch.Tensor | None = None,
     ):
         """Instantiates a container for transitions.
 
@@ -58,6 +61,10 @@ class Transitions(Container):
             log_rewards: The log-rewards of the transitions (using a default value like
                 `-float('inf')` for non-terminating transitions).
             log_probs: The log-probabilities of the actions.
+            estimator_outputs: The outputs of the estimator at the states, of shape
+                `(n_transitions, ...)`, e.g. stored when sampling off policy, so that
+                the log-probabilities of the actions can be evaluated without another
+                forward pass.
 
         Raises:
             AssertionError: If states and next_states do not have matching
@@ -91,6 +98,7 @@ class Transitions(Container):
         )
         self._log_rewards = log_rewards
         self.log_probs = log_probs if log_probs is not None else torch.zeros(0)
+        self.estimator_outputs = estimator_outputs
 
     @property
     def n_transitions(self) -> int:
@@ -175,7 +183,7 @@ class Transitions(Container):
             )
         return log_rewards
 
-    def __getitem__(self, index: int | Sequence[int]) -> Transitions:
+    def __getitem__(self, index: int | Sequence[int] | torch.Tensor) -> Transitions:
         """Access particular transitions of the batch."""
         if isinstance(index, int):
             index = [index]
@@ -187,6 +195,11 @@ class Transitions(Container):
             self._log_rewards[index] if self._log_rewards is not None else None
         )
         log_probs = self.log_probs[index]
+        estimator_outputs = (
+            self.estimator_outputs[index]
+            if self.estimator_outputs is not None
+            else None
+        )
         return Transitions(
             env=self.env,
             states=states,
@@ -196,10 +209,70 @@ class Transitions(Container):
             is_backward=self.is_backward,
             log_rewards=log_rewards,
             log_probs=log_probs,
+            estimator_outputs=estimator_outputs,
         )
 
+    def __setitem__(
+        self, index: int | Sequence[int] | torch.Tensor, other: Transitions
+    ) -> None:
+        """Overwrites particular transitions of the batch, in place, with `other`."""
+        if isinstance(index, int):
+            index = [index]
+        self.states[index] = other.states
+        self.actions[index] = other.actions
+        self.is_done[index] = other.is_done
+        self.next_states[index] = other.next_states
+        if self._log_rewards is not None:
+            self._log_rewards[index] = other.log_rewards
+        if self.log_probs.shape == (self.n_transitions,):
+            self.log_probs[index] = other.log_probs
+        if self.estimator_outputs is not None:
+            assert other.estimator_outputs is not None
+            self.estimator_outputs[index] = other.estimator_outputs.to(
+                dtype=self.estimator_outputs.dtype
+            )
+
+    def get_columns(self) -> dict[str, torch.Tensor]:
+        """Returns the tensors of the transitions, keyed by column names."""
+        columns = {
+            **states_to_columns(self.states, "states"),
+            **states_to_columns(self.next_states, "next_states"),
+            "actions": self.actions.tensor,
+            "is_done": self.is_done,
+        }
+        if self._log_rewards is not None:
+            columns["log_rewards"] = self._log_rewards
+        if self.log_probs.shape == (self.n_transitions,):
+            columns["log_probs"] = self.log_probs
+        if self.estimator_outputs is not None:
+            columns["estimator_outputs"] = self.estimator_outputs
+        return columns
+
+    def set_columns(self, columns: dict[str, torch.Tensor]) -> None:
+        """Sets the tensors of the transitions from columns returned by `get_columns`."""
+        self.states = states_from_columns(self.env.States, columns, "states")
+        self.next_states = states_from_columns(self.env.States, columns, "next_states")
+        self.actions = self.env.Actions(columns["actions"])
+        self.is_done = columns["is_done"]
+        self._log_rewards = columns.get("log_rewards")
+        self.log_probs = columns.get("log_probs", torch.zeros(0))
+        self.estimator_outputs = columns.get("estimator_outputs")
+
     def extend(self, other: Transitions) -> None:
         """Extend the Transitions object with another Transitions object."""
+        # Estimator outputs are only kept if all the transitions have them.
+        if self.estimator_outputs is not None and other.estimator_outputs is not None:
+            self.estimator_outputs = torch.cat(
+                (
+                    self.estimator_outputs,
+                    other.estimator_outputs.to(dtype=self.estimator_outputs.dtype),
+                ),
+                dim=0,
+            )
+        elif self.n_transitions == 0:
+            self.estimator_outputs = other.estimator_outputs
+        else:
+            self.estimator_outputs = None
         self.states.extend(other.states)
         self.actions.extend(other.actions)
         self.is_done = torch.cat((self.is_done, other.is_done), dim=0)
@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
-from typing import Optional, Tuple, Union
+from math import ceil
+from typing import ClassVar, Optional, Tuple, Union
 
 import torch
 from torch import Tensor
@@ -20,7 +21,16 @@ def get_device(device_str, default_device):
 
 class Env(ABC):
     """Base class for all environments. Environments require that individual states be represented as a unique tensor of
-    arbitrary shape."""
+    arbitrary shape.
+
+    Attributes:
+        reward_parameters: names of the attributes parametrizing the reward. The
+            reward must broadcast these parameters when they are given as tensors with
+            one value per state, which allows `VectorizedEnv` to evaluate the rewards
+            of several configurations of the environment at once.
+    """
+
+    reward_parameters: ClassVar[Tuple[str, ...]] = ()
 
     def __init__(
         self,
@@ -73,6 +83,54 @@ class Env(ABC):
 
         self.preprocessor = preprocessor
         self.is_discrete = False
+        self.set_action_validation()
+
+    def set_action_validation(
+        self, policy: str = "always", every_n_steps: int = 1, fraction: float = 1.0
+    ) -> None:
+        """Sets the policy used by `_step` and `_backward_step` to validate actions.
+
+        Validating actions requires reading the result on the host, which forces a
+        device synchronization at every step. Actions sampled from masked
+        distributions are valid by construction, and their validation can be skipped,
+        or only sampled to audit the rollouts.
+
+        Args:
+            policy: "always" to validate all the actions at every step (the default),
+                "never" to skip validation, or "sampled" to validate the actions of a
+                random `fraction` of the batch, every `every_n_steps` steps.
+            every_n_steps: with the "sampled" policy, the number of calls to `_step`
+                and `_backward_step` between two validations.
+            fraction: with the "sampled" policy, the fraction of the batch whose
+                actions are validated.
+
+        Raises:
+            ValueError: if the policy is unknown, or the other arguments are invalid.
+        """
+        if policy not in ("always", "never", "sampled"):
+            raise ValueError(f"Unknown action validation policy: {policy}.")
+        if every_n_steps < 1:
+            raise ValueError(f"every_n_steps must be positive, got {every_n_steps}.")
+        if not 0 < fraction <= 1:
+            raise ValueError(f"fraction must be in (0, 1], got {fraction}.")
+        self.action_validation = policy
+        self.validation_every_n_steps = every_n_steps
+        self.validation_fraction = fraction
+        self._n_validation_calls = 0
+
+    def _should_validate_actions(self) -> bool:
+        """Returns whether the actions of the current step are validated."""
+        if self.action_validation != "sampled":
+            return self.action_validation == "always"
+        self._n_validation_calls += 1
+        return (self._n_validation_calls - 1) % self.validation_every_n_steps == 0
+
+    def _get_validation_index(self, batch_size: int) -> Union[slice, Tensor]:
+        """Returns the indices of the elements of a flat batch to validate."""
+        if self.action_validation != "sampled" or self.validation_fraction == 1:
+            return slice(None)
+        n_samples = ceil(self.validation_fraction * batch_size)
+        return torch.randperm(batch_size, device=self.device)[:n_samples]
 
     def states_from_tensor(self, tensor: Tensor):
         """Wraps the supplied Tensor in a States instance."""
@@ -203,13 +261,15 @@ class Env(ABC):
         """
         new_states = states.clone()  # TODO: Ensure this is efficient!
         valid_states_idx: TT["batch_shape", torch.bool] = ~states.is_sink_state
-        valid_actions = actions[valid_states_idx]
-        valid_states = states[valid_states_idx]
 
-        if not self.validate_actions(valid_states, valid_actions):
-            raise NonValidActionsError(
-                "Some actions are not valid in the given states. See `is_action_valid`."
-            )
+        if self._should_validate_actions():
+            valid_actions = actions[valid_states_idx]
+            valid_states = states[valid_states_idx]
+            index = self._get_validation_index(valid_actions.batch_shape[0])
+            if not self.validate_actions(valid_states[index], valid_actions[index]):
+                raise NonValidActionsError(
+                    "Some actions are not valid in the given states. See `is_action_valid`."
+                )
 
         new_sink_states_idx = actions.is_exit
         new_states.tensor[new_sink_states_idx] = self.sf
@@ -243,10 +303,14 @@ class Env(ABC):
         valid_actions = actions[valid_states_idx]
         valid_states = states[valid_states_idx]
 
-        if not self.validate_actions(valid_states, valid_actions, backward=True):
-            raise NonValidActionsError(
-                "Some actions are not valid in the given states. See `is_action_valid`."
-            )
+        if self._should_validate_actions():
+            index = self._get_validation_index(valid_actions.batch_shape[0])
+            if not self.validate_actions(
+                valid_states[index], valid_actions[index], backward=True
+            ):
+                raise NonValidActionsError(
+                    "Some actions are not valid in the given states. See `is_action_valid`."
+                )
 
         # Calculate the backward step, and update only the states which are not Done.
         new_not_done_states_tensor = self.backward_step(valid_states, valid_actions)
@@ -335,6 +399,9 @@ class DiscreteEnv(Env, ABC):
 
         self.is_discrete = True  # After init, else it will be overwritten.
 
+        # Opt-in fast path, for environments implementing `fused_step`.
+        self.use_fused_step = False
+
     def states_from_tensor(self, tensor: Tensor):
         """Wraps the supplied Tensor in a States instance & updates masks."""
         states_instance = self.make_states_class()(tensor)
@@ -400,6 +467,12 @@ class DiscreteEnv(Env, ABC):
             dummy_action = env.dummy_action.to(device=env.device)
             exit_action = env.exit_action.to(device=env.device)
 
+            def compare(
+                self, other: TT["batch_shape", "action_shape"]
+            ) -> TT["batch_shape", torch.bool]:
+                """Discrete actions are single indices: one comparison per action."""
+                return self.tensor[..., 0] == other[..., 0]
+
         return DiscreteEnvActions
 
     def is_action_valid(
@@ -409,8 +482,58 @@ class DiscreteEnv(Env, ABC):
         masks_tensor = states.backward_masks if backward else states.forward_masks
         return torch.gather(masks_tensor, 1, actions.tensor).all()
 
+    def fused_step(
+        self, states: DiscreteStates, actions: Actions
+    ) -> TT["batch_shape", "state_shape", torch.float]:
+        """Optionally implemented by the user: a vectorized step on the full batch.
+
+        Unlike `step`, this function receives all the states of the batch, including
+        sink states, and all the actions, including exit and dummy actions. It must
+        return the tensor of the next states, in which sink states and states whose
+        action is the exit action are $s_f$. It is used by `_step` in place of `step`
+        when `use_fused_step` is True.
+        """
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not implement a fused step."
+        )
+
+    def _fused_step(self, states: DiscreteStates, actions: Actions) -> DiscreteStates:
+        """Steps the full batch with `fused_step`, then computes the masks in place.
+
+        No intermediate subset of the states is built. When actions are validated (see
+        `set_action_validation`), a single check is made for the (sampled) batch.
+        """
+        if self._should_validate_actions():
+            forward_masks = states.forward_masks.reshape(-1, self.n_actions)
+            actions_tensor = actions.tensor.reshape(-1, 1)
+            is_sink_state = states.is_sink_state.reshape(-1)
+            index = self._get_validation_index(len(is_sink_state))
+            # The actions of sink states are dummy actions, which are not checked.
+            is_valid = torch.gather(
+                forward_masks[index], -1, actions_tensor[index].clamp(min=0)
+            ).squeeze(-1)
+            if not torch.all(is_valid | is_sink_state[index]):
+                raise NonValidActionsError(
+                    "Some actions are not valid in the given states. See `is_action_valid`."
+                )
+
+        # As in the non-fused step, the masks start from copies of the parent masks,
+        # so that `update_masks` may only update part of them.
+        new_states = self.States(
+            self.fused_step(states, actions),
+            forward_masks=states.forward_masks.clone(),
+            backward_masks=states.backward_masks.clone(),
+        )
+        self.update_masks(new_states)
+        return new_states
+
     def _step(self, states: DiscreteStates, actions: Actions) -> States:
-        """Calls the core self._step method of the parent class, and updates masks."""
+        """Calls the core self._step method of the parent class, and updates masks.
+
+        If `use_fused_step` is True, the environment's `fused_step` is used instead.
+        """
+        if self.use_fused_step:
+            return self._fused_step(states, actions)
         new_states = super()._step(states, actions)
         self.update_masks(
             new_states
@@ -1,6 +1,6 @@
 import math
 from abc import ABC, abstractmethod
-from typing import Generic, Tuple, TypeVar, Union
+from typing import Generic, Optional, Tuple, TypeVar, Union
 
 import torch
 import torch.nn as nn
@@ -10,9 +10,10 @@ from torchtyping import TensorType as TT
 from gfn.containers import Trajectories
 from gfn.containers.base import Container
 from gfn.env import Env
-from gfn.modules import GFNModule
+from gfn.modules import GFNModule, is_uniform_policy
 from gfn.samplers import Sampler
 from gfn.states import States
+from gfn.utils import distributed as dist_utils
 
 TrainingSampleType = TypeVar(
     "TrainingSampleType", bound=Union[Container, tuple[States, ...]]
@@ -26,6 +27,42 @@ class GFlowNet(ABC, nn.Module, Generic[TrainingSampleType]):
     """
 
     log_reward_clip_min = float("-inf")  # Default off.
+    distributed = False  # Set by `distribute`.
+    process_group = None
+
+    def distribute(self, process_group=None, src: int = 0) -> None:
+        """Switches the GFlowNet to distributed data-parallel mode.
+
+        Each rank then samples its shard of the requested number of trajectories,
+        and the losses reduce their batch-level statistics (e.g. means, or the
+        normalization of sub-trajectory weights) over all ranks. The losses are scaled
+        such that averaging their gradients over ranks, as `DistributedDataParallel`
+        or `gfn.utils.distributed.average_gradients` do, yields the gradients of the
+        loss of the global batch. The parameters, including logZ, are copied from
+        rank `src` to all ranks. Ranks should be seeded differently.
+
+        Args:
+            process_group: the `torch.distributed` process group. Defaults to the
+                default group, which must be initialized.
+            src: the rank whose parameters are copied to the others.
+        """
+        if not dist_utils.is_distributed():
+            raise RuntimeError("torch.distributed is not initialized.")
+        self.distributed = True
+        self.process_group = process_group
+        dist_utils.broadcast_parameters(self, src=src, group=process_group)
+
+    def get_shard_size(self, n_samples: int) -> int:
+        """Returns the number of the `n_samples` samples drawn by this rank."""
+        if not self.distributed:
+            return n_samples
+        return dist_utils.get_shard_size(n_samples, self.process_group)
+
+    def batch_mean(self, values: Tensor) -> Tensor:
+        """Returns the mean of the values, over all ranks in distributed mode."""
+        if not self.distributed:
+            return values.mean()
+        return dist_utils.mean(values, self.process_group)
 
     @abstractmethod
     def sample_trajectories(
@@ -89,13 +126,31 @@ class PFBasedGFlowNet(GFlowNet[TrainingSampleType]):
         sampler = Sampler(estimator=self.pf)
         trajectories = sampler.sample_trajectories(
             env,
-            n_trajectories=n_samples,
+            n_trajectories=self.get_shard_size(n_samples),
             off_policy=sample_off_policy,
             **policy_kwargs,
         )
 
         return trajectories
 
+    def recompute_estimator_outputs(self, trajectories: Trajectories) -> None:
+        """Evaluates $P_F$ on the states of the trajectories, in place.
+
+        This is needed to compute off policy losses, with gradients, from trajectories
+        whose estimator outputs are missing or detached, e.g. sampled by other
+        processes.
+        """
+        is_valid = ~trajectories.actions.is_dummy
+        valid_outputs = self.pf(trajectories.states[:-1][is_valid])
+        estimator_outputs = torch.full(
+            is_valid.shape + valid_outputs.shape[1:],
+            fill_value=-float("inf"),
+            dtype=valid_outputs.dtype,
+            device=valid_outputs.device,
+        )
+        estimator_outputs[is_valid] = valid_outputs
+        trajectories.estimator_outputs = estimator_outputs
+
     def pf_pb_named_parameters(self):
         return {k: v for k, v in self.named_parameters() if "pb" in k or "pf" in k}
 
@@ -108,6 +163,7 @@ class TrajectoryBasedGFlowNet(PFBasedGFlowNet[Trajectories]):
         self,
         trajectories: Trajectories,
         fill_value: float = 0.0,
+        pb_outputs: Optional[TT["n_states", "output_dim", float]] = None,
     ) -> Tuple[
         TT["max_length", "n_trajectories", torch.float],
         TT["max_length", "n_trajectories", torch.float],
@@ -130,6 +186,8 @@ class TrajectoryBasedGFlowNet(PFBasedGFlowNet[Trajectories]):
                 sampling (encountered, for example, when sampling off policy).
             fill_value: Value to use for invalid states (i.e. $s_f$ that is added to
                 shorter trajectories).
+            pb_outputs: Optional outputs of $P_B$ at the valid non-initial states,
+                e.g. evaluated along with other estimators sharing its trunk.
 
         Returns: A tuple of float tensors of shape (max_length, n_trajectories) containing
             the log_pf and log_pb for each action in each trajectory. The first one can be None.
@@ -182,11 +240,21 @@ class TrajectoryBasedGFlowNet(PFBasedGFlowNet[Trajectories]):
         non_exit_valid_actions = valid_actions[~valid_actions.is_exit]
 
         # Using all non-initial states, calculate the backward policy, and the logprobs
-        # of those actions.
-        estimator_outputs = self.pb(non_initial_valid_states)
-        valid_log_pb_actions = self.pb.to_probability_distribution(
-            non_initial_valid_states, estimator_outputs
-        ).log_prob(non_exit_valid_actions.tensor)
+        # of those actions. There are none if all trajectories exit from $s_0$. Those of
+        # a uniform policy only depend on the number of parents of the states.
+        if is_uniform_policy(self.pb):
+            valid_log_pb_actions = self.pb.uniform_log_probs(non_initial_valid_states)
+        elif non_initial_valid_states.batch_shape[0] > 0:
+            estimator_outputs = (
+                pb_outputs
+                if pb_outputs is not None
+                else self.pb(non_initial_valid_states)
+            )
+            valid_log_pb_actions = self.pb.to_probability_distribution(
+                non_initial_valid_states, estimator_outputs
+            ).log_prob(non_exit_valid_actions.tensor)
+        else:
+            valid_log_pb_actions = torch.zeros(0, device=valid_actions.device)
 
         log_pb_trajectories = torch.full_like(
             trajectories.actions.tensor[..., 0],
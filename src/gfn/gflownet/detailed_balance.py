@@ -7,7 +7,76 @@ from torchtyping import TensorType as TT
 from gfn.containers import Trajectories, Transitions
 from gfn.env import Env
 from gfn.gflownet.base import PFBasedGFlowNet
-from gfn.modules import GFNModule, ScalarEstimator
+from gfn.modules import (
+    GFNModule,
+    ScalarEstimator,
+    evaluate_estimators,
+    is_uniform_policy,
+    shares_trunk,
+)
+from gfn.states import States
+
+
+def get_stored_pf_outputs(
+    training_objects: Transitions | Trajectories,
+) -> torch.Tensor | None:
+    """Returns the stored outputs of $P_F$ at the states from which actions are taken.
+
+    These are the states of transitions, or, for trajectories, the states of their
+    non-dummy actions, i.e. `trajectories.states[:-1][~trajectories.actions.is_dummy]`.
+
+    The estimator outputs stored in the objects when sampling off policy are reused,
+    unless they were detached from the graph (e.g. by a replay buffer filled under
+    `torch.no_grad()`) while gradients are required, in which case None is returned,
+    so that $P_F$ is evaluated again and trained.
+    """
+    estimator_outputs = training_objects.estimator_outputs
+    if estimator_outputs is None or (
+        torch.is_grad_enabled() and not estimator_outputs.requires_grad
+    ):
+        return None
+    if isinstance(training_objects, Trajectories):
+        return estimator_outputs[~training_objects.actions.is_dummy]
+    return estimator_outputs
+
+
+def get_pf_outputs(
+    pf: GFNModule, training_objects: Transitions | Trajectories
+) -> torch.Tensor:
+    """Returns the outputs of $P_F$ at the states from which actions are taken.
+
+    The stored estimator outputs are reused when possible (see
+    `get_stored_pf_outputs`), and $P_F$ is evaluated otherwise.
+    """
+    estimator_outputs = get_stored_pf_outputs(training_objects)
+    if estimator_outputs is not None:
+        return estimator_outputs
+    if isinstance(training_objects, Trajectories):
+        return pf(training_objects.states[:-1][~training_objects.actions.is_dummy])
+    return pf(training_objects.states)
+
+
+def get_valid_state_rows(
+    is_valid_state: TT["max_length + 1", "n_trajectories", torch.bool]
+) -> TT["max_length + 1", "n_trajectories", torch.long]:
+    """Returns the row of each state of trajectories among their valid states.
+
+    This maps the states of the trajectories to the outputs of an estimator evaluated
+    on `trajectories.states[is_valid_state]`. Sink states are mapped to -1.
+    """
+    rows = torch.full_like(is_valid_state, -1, dtype=torch.long)
+    rows[is_valid_state] = torch.arange(
+        int(is_valid_state.sum()), device=is_valid_state.device
+    )
+    return rows
+
+
+def get_log_rewards(env: Env, states: States) -> torch.Tensor:
+    """Evaluates the log rewards of states, from their rewards if need be."""
+    try:
+        return env.log_reward(states)
+    except NotImplementedError:
+        return torch.log(env.reward(states))
 
 
 class DBGFlowNet(PFBasedGFlowNet[Transitions]):
@@ -26,6 +95,8 @@ class DBGFlowNet(PFBasedGFlowNet[Transitions]):
         off_policy: If true, we need to reevaluate the log probs.
         forward_looking: whether to implement the forward looking GFN loss.
         log_reward_clip_min: If finite, clips log rewards to this value.
+        trajectory_layout: whether the training samples are the trajectories
+            themselves rather than their transitions (see `get_trajectories_scores`).
     """
 
     def __init__(
@@ -36,11 +107,13 @@ class DBGFlowNet(PFBasedGFlowNet[Transitions]):
         off_policy: bool,
         forward_looking: bool = False,
         log_reward_clip_min: float = -float("inf"),
+        trajectory_layout: bool = False,
     ):
         super().__init__(pf, pb, off_policy=off_policy)
         self.logF = logF
         self.forward_looking = forward_looking
         self.log_reward_clip_min = log_reward_clip_min
+        self.trajectory_layout = trajectory_layout
 
     def get_scores(self, env: Env, transitions: Transitions) -> Tuple[
         TT["n_transitions", float],
@@ -66,21 +139,29 @@ class DBGFlowNet(PFBasedGFlowNet[Transitions]):
 
         if states.batch_shape != tuple(actions.batch_shape):
             raise ValueError("Something wrong happening with log_pf evaluations")
+        # $P_F$ is evaluated along with $\log F$ when sampling off policy, unless the
+        # estimator outputs of the sampler can be reused.
+        stored_pf_outputs = (
+            get_stored_pf_outputs(transitions) if self.off_policy else None
+        )
+        pf_output, log_F_output = evaluate_estimators(
+            states,
+            self.pf if self.off_policy and stored_pf_outputs is None else None,
+            self.logF,
+        )
         if not self.off_policy:
             valid_log_pf_actions = transitions.log_probs
         else:
-            # Evaluate the log PF of the actions sampled off policy.
-            # I suppose the Transitions container should then have some
-            # estimator_outputs attribute as well, to avoid duplication here ?
-            # See (#156).
-            module_output = self.pf(states)  # TODO: Inefficient duplication.
+            module_output = (
+                stored_pf_outputs if stored_pf_outputs is not None else pf_output
+            )
             valid_log_pf_actions = self.pf.to_probability_distribution(
                 states, module_output
             ).log_prob(
                 actions.tensor
             )  # Actions sampled off policy.
 
-        valid_log_F_s = self.logF(states).squeeze(-1)
+        valid_log_F_s = log_F_output.squeeze(-1)
         if self.forward_looking:
             log_rewards = env.log_reward(states)  # TODO: RM unsqueeze(-1) ?
             if math.isfinite(self.log_reward_clip_min):
@@ -97,16 +178,22 @@ class DBGFlowNet(PFBasedGFlowNet[Transitions]):
         valid_next_states = transitions.next_states[~transitions.is_done]
         non_exit_actions = actions[~actions.is_exit]
 
-        module_output = self.pb(valid_next_states)
-        valid_log_pb_actions = self.pb.to_probability_distribution(
-            valid_next_states, module_output
-        ).log_prob(non_exit_actions.tensor)
+        uniform_pb = is_uniform_policy(self.pb)
+        module_output, log_F_next_output = evaluate_estimators(
+            valid_next_states, None if uniform_pb else self.pb, self.logF
+        )
+        if uniform_pb:
+            valid_log_pb_actions = self.pb.uniform_log_probs(valid_next_states)
+        else:
+            valid_log_pb_actions = self.pb.to_probability_distribution(
+                valid_next_states, module_output
+            ).log_prob(non_exit_actions.tensor)
 
         valid_transitions_is_done = transitions.is_done[
             ~transitions.states.is_sink_state
         ]
 
-        valid_log_F_s_next = self.logF(valid_next_states).squeeze(-1)
+        valid_log_F_s_next = log_F_next_output.squeeze(-1)
         targets[~valid_transitions_is_done] = valid_log_pb_actions
         log_pb_actions = targets.clone()
         targets[~valid_transitions_is_done] += valid_log_F_s_next
@@ -122,20 +209,119 @@ class DBGFlowNet(PFBasedGFlowNet[Transitions]):
 
         return (valid_log_pf_actions, log_pb_actions, scores)
 
-    def loss(self, env: Env, transitions: Transitions) -> TT[0, float]:
+    def get_trajectories_scores(self, env: Env, trajectories: Trajectories) -> Tuple[
+        TT["n_transitions", float],
+        TT["n_transitions", float],
+        TT["n_transitions", float],
+    ]:
+        """Calculates the scores of the transitions of a batch of trajectories.
+
+        The estimators are evaluated on the `(max_length + 1, n_trajectories)` grid of
+        states of the trajectories, once per state, whereas the interior states of
+        trajectories would be evaluated twice by `get_scores`, as the states of some
+        transitions and the next states of others. The flows at the two ends of each
+        transition are then read by shifting the grid along the time axis.
+
+        Returns: the same outputs as `get_scores` on `trajectories.to_transitions()`,
+            in the same order.
+
+        Raises:
+            ValueError: when supplied with backward trajectories.
+        """
+        if trajectories.is_backward:
+            raise ValueError("Backward trajectories are not supported")
+        states = trajectories.states
+        actions = trajectories.actions
+        is_valid = ~actions.is_dummy
+        is_exit = actions.is_exit & is_valid
+        is_inner = is_valid & ~actions.is_exit
+        valid_actions = actions[is_valid]
+
+        # The flows of all the states, and $P_B$ at the next states of the non-exit
+        # actions, which all are non-initial states. Forward trajectories end with the
+        # exit action, so the states of the valid actions are the valid states, in the
+        # same order, and $P_F$ is evaluated along with them when it needs to be. So
+        # is $P_B$, if it shares a trunk with $\log F$.
+        is_valid_state = ~states.is_sink_state
+        valid_states = states[is_valid_state]
+        stored_pf_outputs = (
+            get_stored_pf_outputs(trajectories) if self.off_policy else None
+        )
+        pb_with_log_F = shares_trunk(self.pb, self.logF)
+        pf_output, pb_output, log_F_output = evaluate_estimators(
+            valid_states,
+            self.pf if self.off_policy and stored_pf_outputs is None else None,
+            self.pb if pb_with_log_F else None,
+            self.logF,
+        )
+        if not self.off_policy:
+            valid_log_pf_actions = trajectories.log_probs[is_valid]
+        else:
+            module_output = (
+                stored_pf_outputs if stored_pf_outputs is not None else pf_output
+            )
+            valid_log_pf_actions = self.pf.to_probability_distribution(
+                states[:-1][is_valid], module_output
+            ).log_prob(valid_actions.tensor)
+
+        log_F = torch.zeros(states.batch_shape, device=states.device)
+        log_F[is_valid_state] = log_F_output.squeeze(-1)
+        log_F_s = log_F[:-1]
+        if self.forward_looking:
+            log_rewards = torch.zeros_like(log_F)
+            log_rewards[is_valid_state] = env.log_reward(valid_states)
+            if math.isfinite(self.log_reward_clip_min):
+                log_rewards = log_rewards.clamp_min(self.log_reward_clip_min)
+            log_F_s = log_F_s + log_rewards[:-1]
+
+        next_states = states[1:][is_inner]
+        log_pb_actions = torch.zeros(actions.batch_shape, device=states.device)
+        if is_uniform_policy(self.pb):
+            log_pb_actions[is_inner] = self.pb.uniform_log_probs(next_states)
+        else:
+            if pb_with_log_F:
+                module_output = pb_output[
+                    get_valid_state_rows(is_valid_state)[1:][is_inner]
+                ]
+            else:
+                module_output = self.pb(next_states)
+            log_pb_actions[is_inner] = self.pb.to_probability_distribution(
+                next_states, module_output
+            ).log_prob(actions[is_inner].tensor)
+
+        assert trajectories.log_rewards is not None
+        targets = torch.where(
+            is_exit,
+            trajectories.log_rewards.unsqueeze(0),
+            log_pb_actions + log_F[1:],
+        )
+        scores = valid_log_pf_actions + log_F_s[is_valid] - targets[is_valid]
+
+        return (valid_log_pf_actions, log_pb_actions[is_valid], scores)
+
+    def loss(
+        self, env: Env, training_objects: Transitions | Trajectories
+    ) -> TT[0, float]:
         """Detailed balance loss.
 
         The detailed balance loss is described in section
         3.2 of [GFlowNet Foundations](https://arxiv.org/abs/2111.09266)."""
-        _, _, scores = self.get_scores(env, transitions)
-        loss = torch.mean(scores**2)
+        if isinstance(training_objects, Trajectories):
+            _, _, scores = self.get_trajectories_scores(env, training_objects)
+        else:
+            _, _, scores = self.get_scores(env, training_objects)
+        loss = self.batch_mean(scores**2)
 
         if torch.isnan(loss):
             raise ValueError("loss is nan")
 
         return loss
 
-    def to_training_samples(self, trajectories: Trajectories) -> Transitions:
+    def to_training_samples(
+        self, trajectories: Trajectories
+    ) -> Transitions | Trajectories:
+        if self.trajectory_layout:
+            return trajectories
         return trajectories.to_transitions()
 
 
@@ -145,8 +331,22 @@ class ModifiedDBGFlowNet(PFBasedGFlowNet[Transitions]):
 
     See Bayesian Structure Learning with Generative Flow Networks
     https://arxiv.org/abs/2202.13903 for more details.
+
+    Attributes:
+        trajectory_layout: whether the training samples are the trajectories
+            themselves rather than their transitions (see `get_trajectories_scores`).
     """
 
+    def __init__(
+        self,
+        pf: GFNModule,
+        pb: GFNModule,
+        off_policy: bool,
+        trajectory_layout: bool = False,
+    ):
+        super().__init__(pf, pb, off_policy=off_policy)
+        self.trajectory_layout = trajectory_layout
+
     def get_scores(self, transitions: Transitions) -> TT["n_trajectories", torch.float]:
         """DAG-GFN-style detailed balance, when all states are connected to the sink.
 
@@ -162,7 +362,7 @@ class ModifiedDBGFlowNet(PFBasedGFlowNet[Transitions]):
         valid_next_states = transitions.next_states[mask]
         actions = transitions.actions[mask]
         all_log_rewards = transitions.all_log_rewards[mask]
-        module_output = self.pf(states)
+        module_output = get_pf_outputs(self.pf, transitions[mask])
         pf_dist = self.pf.to_probability_distribution(states, module_output)
         if not self.off_policy:
             valid_log_pf_actions = transitions[mask].log_probs
@@ -173,18 +373,23 @@ class ModifiedDBGFlowNet(PFBasedGFlowNet[Transitions]):
             torch.full_like(actions.tensor, actions.__class__.exit_action[0])
         )
 
-        # The following two lines are slightly inefficient, given that most
+        # The following evaluation is slightly inefficient, given that most
         # next_states are also states, for which we already did a forward pass.
-        module_output = self.pf(valid_next_states)
+        uniform_pb = is_uniform_policy(self.pb)
+        module_output, pb_output = evaluate_estimators(
+            valid_next_states, self.pf, None if uniform_pb else self.pb
+        )
         valid_log_pf_s_prime_exit = self.pf.to_probability_distribution(
             valid_next_states, module_output
         ).log_prob(torch.full_like(actions.tensor, actions.__class__.exit_action[0]))
 
         non_exit_actions = actions[~actions.is_exit]
-        module_output = self.pb(valid_next_states)
-        valid_log_pb_actions = self.pb.to_probability_distribution(
-            valid_next_states, module_output
-        ).log_prob(non_exit_actions.tensor)
+        if uniform_pb:
+            valid_log_pb_actions = self.pb.uniform_log_probs(valid_next_states)
+        else:
+            valid_log_pb_actions = self.pb.to_probability_distribution(
+                valid_next_states, pb_output
+            ).log_prob(non_exit_actions.tensor)
 
         preds = all_log_rewards[:, 0] + valid_log_pf_actions + valid_log_pf_s_prime_exit
         targets = all_log_rewards[:, 1] + valid_log_pb_actions + valid_log_pf_s_exit
@@ -195,10 +400,96 @@ class ModifiedDBGFlowNet(PFBasedGFlowNet[Transitions]):
 
         return scores
 
-    def loss(self, env: Env, transitions: Transitions) -> TT[0, float]:
-        """Calculates the modified detailed balance loss."""
-        scores = self.get_scores(transitions)
-        return torch.mean(scores**2)
+    def get_trajectories_scores(
+        self, trajectories: Trajectories
+    ) -> TT["n_transitions", torch.float]:
+        """Calculates the scores of the transitions of a batch of trajectories.
+
+        The rewards, and $P_F$, whose probability of exiting is needed at both ends of
+        each transition, are evaluated once per state of the trajectories, rather
+        than once for the states and once for the next states of the transitions.
+
+        Returns: the same scores as `get_scores` on `trajectories.to_transitions()`,
+            in the same order.
 
-    def to_training_samples(self, trajectories: Trajectories) -> Transitions:
+        Raises:
+            ValueError: when backward trajectories are supplied (not supported).
+            ValueError: when the computed scores contain `inf`.
+        """
+        if trajectories.is_backward:
+            raise ValueError("Backward trajectories are not supported")
+        states = trajectories.states
+        actions = trajectories.actions
+        is_valid = ~actions.is_dummy
+        is_inner = is_valid & ~actions.is_exit
+
+        # Forward trajectories end with the exit action, so the states of the valid
+        # actions are all the states of the trajectories but $s_f$.
+        valid_states = states[:-1][is_valid]
+        valid_actions = actions[is_valid]
+        # $P_B$ is evaluated on all these states along with $P_F$ only if they share
+        # a trunk, and the outputs of the next states are then selected.
+        stored_pf_outputs = get_stored_pf_outputs(trajectories)
+        pb_with_pf = stored_pf_outputs is None and shares_trunk(self.pf, self.pb)
+        pf_output, pb_output = evaluate_estimators(
+            valid_states,
+            self.pf if stored_pf_outputs is None else None,
+            self.pb if pb_with_pf else None,
+        )
+        pf_dist = self.pf.to_probability_distribution(
+            valid_states,
+            stored_pf_outputs if stored_pf_outputs is not None else pf_output,
+        )
+        log_pf_exit = torch.zeros(states.batch_shape, device=states.device)
+        log_pf_exit[:-1][is_valid] = pf_dist.log_prob(
+            torch.full_like(valid_actions.tensor, actions.__class__.exit_action[0])
+        )
+        if not self.off_policy:
+            log_pf_actions = trajectories.log_probs
+        else:
+            log_pf_actions = torch.zeros(actions.batch_shape, device=states.device)
+            log_pf_actions[is_valid] = pf_dist.log_prob(valid_actions.tensor)
+
+        log_rewards = torch.zeros(states.batch_shape, device=states.device)
+        log_rewards[:-1][is_valid] = get_log_rewards(trajectories.env, valid_states).to(
+            torch.float
+        )
+
+        next_states = states[1:][is_inner]
+        if is_uniform_policy(self.pb):
+            log_pb_actions = self.pb.uniform_log_probs(next_states)
+        else:
+            if pb_with_pf:
+                rows = get_valid_state_rows(~states.is_sink_state)
+                module_output = pb_output[rows[1:][is_inner]]
+            else:
+                module_output = self.pb(next_states)
+            log_pb_actions = self.pb.to_probability_distribution(
+                next_states, module_output
+            ).log_prob(actions[is_inner].tensor)
+
+        preds = (log_rewards[:-1] + log_pf_actions + log_pf_exit[1:])[is_inner]
+        targets = (log_rewards[1:] + log_pf_exit[:-1])[is_inner] + log_pb_actions
+
+        scores = preds - targets
+        if torch.any(torch.isinf(scores)):
+            raise ValueError("scores contains inf")
+
+        return scores
+
+    def loss(
+        self, env: Env, training_objects: Transitions | Trajectories
+    ) -> TT[0, float]:
+        """Calculates the modified detailed balance loss."""
+        if isinstance(training_objects, Trajectories):
+            scores = self.get_trajectories_scores(training_objects)
+        else:
+            scores = self.get_scores(training_objects)
+        return self.batch_mean(scores**2)
+
+    def to_training_samples(
+        self, trajectories: Trajectories
+    ) -> Transitions | Trajectories:
+        if self.trajectory_layout:
+            return trajectories
         return trajectories.to_transitions()
@@ -48,7 +48,7 @@ class FMGFlowNet(GFlowNet[Tuple[DiscreteStates, DiscreteStates]]):
         sampler = Sampler(estimator=self.logF)
         trajectories = sampler.sample_trajectories(
             env,
-            n_trajectories=n_samples,
+            n_trajectories=self.get_shard_size(n_samples),
             off_policy=off_policy,
             **policy_kwargs,
         )
@@ -65,6 +65,11 @@ class FMGFlowNet(GFlowNet[Tuple[DiscreteStates, DiscreteStates]]):
         outgoing flows. The states should not include $s_0$. The batch shape should be
         `(n_states,)`. As of now, only discrete environments are handled.
 
+        The parents of the states through all their valid backward actions are built
+        with a single backward step, and the edge flow estimator is evaluated once, on
+        the unique states among the states and their parents. The incoming and
+        outgoing edge flows are then gathered from its outputs.
+
         Raises:
             AssertionError: If the batch shape is not linear.
             AssertionError: If any state is at $s_0$.
@@ -72,47 +77,36 @@ class FMGFlowNet(GFlowNet[Tuple[DiscreteStates, DiscreteStates]]):
 
         assert len(states.batch_shape) == 1
         assert not torch.any(states.is_initial_state)
+        n_states = states.batch_shape[0]
 
-        incoming_log_flows = torch.full_like(
-            states.backward_masks, -float("inf"), dtype=torch.float
+        # One parent per valid (state, backward action) pair.
+        parent_state_idx, parent_action_idx = torch.nonzero(
+            states.backward_masks, as_tuple=True
         )
-        outgoing_log_flows = torch.full_like(
-            states.forward_masks, -float("inf"), dtype=torch.float
+        parents = env._backward_step(
+            states[parent_state_idx],
+            env.actions_from_tensor(parent_action_idx.unsqueeze(-1)),
         )
 
-        for action_idx in range(env.n_actions - 1):
-            valid_backward_mask = states.backward_masks[:, action_idx]
-            valid_forward_mask = states.forward_masks[:, action_idx]
-            valid_backward_states = states[valid_backward_mask]
-            valid_forward_states = states[valid_forward_mask]
-
-            backward_actions = torch.full_like(
-                valid_backward_states.backward_masks[:, 0], action_idx, dtype=torch.long
-            ).unsqueeze(-1)
-            backward_actions = env.actions_from_tensor(backward_actions)
-
-            valid_backward_states_parents = env._backward_step(
-                valid_backward_states, backward_actions
-            )
-
-            incoming_log_flows[valid_backward_mask, action_idx] = self.logF(
-                valid_backward_states_parents
-            )[:, action_idx]
-
-            outgoing_log_flows[valid_forward_mask, action_idx] = self.logF(
-                valid_forward_states
-            )[:, action_idx]
+        unique_states_tensor, inverse = torch.unique(
+            torch.cat((states.tensor, parents.tensor)), dim=0, return_inverse=True
+        )
+        log_edge_flows = self.logF(env.States(unique_states_tensor))
 
-        # Now the exit action
-        valid_forward_mask = states.forward_masks[:, -1]
-        outgoing_log_flows[valid_forward_mask, -1] = self.logF(
-            states[valid_forward_mask]
-        )[:, -1]
+        outgoing_log_flows = log_edge_flows[inverse[:n_states]].masked_fill(
+            ~states.forward_masks, -float("inf")
+        )
+        incoming_log_flows = torch.full_like(
+            states.backward_masks, -float("inf"), dtype=torch.float
+        )
+        incoming_log_flows[parent_state_idx, parent_action_idx] = log_edge_flows[
+            inverse[n_states:], parent_action_idx
+        ]
 
         log_incoming_flows = torch.logsumexp(incoming_log_flows, dim=-1)
         log_outgoing_flows = torch.logsumexp(outgoing_log_flows, dim=-1)
 
-        return (log_incoming_flows - log_outgoing_flows).pow(2).mean()
+        return self.batch_mean((log_incoming_flows - log_outgoing_flows).pow(2))
 
     def reward_matching_loss(
         self, env: Env, terminating_states: DiscreteStates
@@ -125,7 +119,7 @@ class FMGFlowNet(GFlowNet[Tuple[DiscreteStates, DiscreteStates]]):
         # Handle the boundary condition (for all x, F(X->S_f) = R(x)).
         terminating_log_edge_flows = log_edge_flows[:, -1]
         log_rewards = terminating_states.log_rewards
-        return (terminating_log_edge_flows - log_rewards).pow(2).mean()
+        return self.batch_mean((terminating_log_edge_flows - log_rewards).pow(2))
 
     def loss(
         self, env: Env, states_tuple: Tuple[DiscreteStates, DiscreteStates]
@@ -1,21 +1,23 @@
 import math
-from typing import List, Literal, Tuple
+from typing import Any, Dict, List, Literal, Optional, Tuple
 
 import torch
+from torch.utils.checkpoint import checkpoint
 from torchtyping import TensorType as TT
 
 from gfn.containers import Trajectories
 from gfn.env import Env
 from gfn.gflownet.base import TrajectoryBasedGFlowNet
-from gfn.modules import GFNModule, ScalarEstimator
+from gfn.modules import GFNModule, ScalarEstimator, evaluate_estimators, shares_trunk
+from gfn.utils import distributed as dist_utils
 
-ContributionsTensor = TT["max_len * (1 + max_len) / 2", "n_trajectories"]
+ContributionsTensor = TT["n_sub_trajectories", "n_trajectories"]
 CumulativeLogProbsTensor = TT["max_length + 1", "n_trajectories"]
 LogStateFlowsTensor = TT["max_length", "n_trajectories"]
 LogTrajectoriesTensor = TT["max_length", "n_trajectories", torch.float]
-MaskTensor = TT["max_length", "n_trajectories"]
-PredictionsTensor = TT["max_length + 1 - i", "n_trajectories"]
-TargetsTensor = TT["max_length + 1 - i", "n_trajectories"]
+MaskTensor = TT["n_sub_trajectories", "n_trajectories"]
+ScoresTensor = TT["n_sub_trajectories", "n_trajectories"]
+SubTrajectoriesIndexTensor = TT["n_sub_trajectories", torch.long]
 
 
 class SubTBGFlowNet(TrajectoryBasedGFlowNet):
@@ -49,6 +51,12 @@ class SubTBGFlowNet(TrajectoryBasedGFlowNet):
                 all sub-trajectories.
         lamda: discount factor for longer trajectories.
         log_reward_clip_min: If finite, clips log rewards to this value.
+        chunk_size: If given, the loss is accumulated over chunks of `chunk_size`
+            sub-trajectory lengths at a time, and the intermediate tensors of each
+            chunk are recomputed during the backward pass. The memory used then grows
+            linearly, instead of quadratically, with the trajectory length, at the
+            cost of a second evaluation of the (cheap) scores. Defaults to None, in
+            which case all sub-trajectories are scored at once.
     """
 
     def __init__(
@@ -69,13 +77,16 @@ class SubTBGFlowNet(TrajectoryBasedGFlowNet):
         lamda: float = 0.9,
         log_reward_clip_min: float = -float("inf"),
         forward_looking: bool = False,
+        chunk_size: int | None = None,
     ):
         super().__init__(pf, pb, off_policy=off_policy)
+        assert chunk_size is None or chunk_size > 0, "chunk_size must be positive"
         self.logF = logF
         self.weighting = weighting
         self.lamda = lamda
         self.log_reward_clip_min = log_reward_clip_min
         self.forward_looking = forward_looking
+        self.chunk_size = chunk_size
 
     def cumulative_logprobs(
         self,
@@ -100,70 +111,12 @@ class SubTBGFlowNet(TrajectoryBasedGFlowNet):
             dim=0,
         )
 
-    def calculate_preds(
-        self,
-        log_pf_trajectories_cum: CumulativeLogProbsTensor,
-        log_state_flows: LogStateFlowsTensor,
-        i: int,
-    ) -> PredictionsTensor:
-        """
-        Calculate the predictions tensor for the current sub-trajectory length.
-        """
-        current_log_state_flows = (
-            log_state_flows if i == 1 else log_state_flows[: -(i - 1)]
-        )
-
-        preds = (
-            log_pf_trajectories_cum[i:]
-            - log_pf_trajectories_cum[:-i]
-            + current_log_state_flows
-        )
-
-        return preds
-
-    def calculate_targets(
-        self,
-        trajectories: Trajectories,
-        preds: PredictionsTensor,
-        log_pb_trajectories_cum: CumulativeLogProbsTensor,
-        log_state_flows: LogStateFlowsTensor,
-        is_terminal_mask: MaskTensor,
-        sink_states_mask: MaskTensor,
-        full_mask: MaskTensor,
-        i: int,
-    ) -> TargetsTensor:
-        """
-        Calculate the targets tensor for the current sub-trajectory length.
-        """
-        targets = torch.full_like(preds, fill_value=-float("inf"))
-        assert trajectories.log_rewards is not None
-        log_rewards = trajectories.log_rewards[trajectories.when_is_done >= i]
-
-        if math.isfinite(self.log_reward_clip_min):
-            log_rewards.clamp_min(self.log_reward_clip_min)
-
-        targets.T[is_terminal_mask[i - 1 :].T] = log_rewards
-
-        # For now, the targets contain the log-rewards of the ending sub trajectories
-        # We need to add to that the log-probabilities of the backward actions up-to
-        # the sub-trajectory's terminating state
-        if i > 1:
-            targets[is_terminal_mask[i - 1 :]] += (
-                log_pb_trajectories_cum[i - 1 :] - log_pb_trajectories_cum[: -i + 1]
-            )[:-1][is_terminal_mask[i - 1 :]]
-
-        # The following creates the targets for the non-finishing sub-trajectories
-        targets[~full_mask[i - 1 :]] = (
-            log_pb_trajectories_cum[i:] - log_pb_trajectories_cum[:-i]
-        )[:-1][~full_mask[i - 1 : -1]] + log_state_flows[i:][~sink_states_mask[i:]]
-
-        return targets
-
     def calculate_log_state_flows(
         self,
         env: Env,
         trajectories: Trajectories,
         log_pf_trajectories: LogTrajectoriesTensor,
+        log_F: TT["n_states", torch.float] | None = None,
     ) -> LogStateFlowsTensor:
         """
         Calculate log state flows and masks for sink and terminal states.
@@ -171,6 +124,8 @@ class SubTBGFlowNet(TrajectoryBasedGFlowNet):
         Args:
             trajectories: The trajectories data.
             env: The environment object.
+            log_F: Optional log flows of the non-sink states, e.g. evaluated along
+                with $P_B$ when they share a trunk.
 
         Returns:
             log_state_flows: Log state flows.
@@ -181,7 +136,8 @@ class SubTBGFlowNet(TrajectoryBasedGFlowNet):
         mask = ~states.is_sink_state
         valid_states = states[mask]
 
-        log_F = self.logF(valid_states).squeeze(-1)
+        if log_F is None:
+            log_F = self.logF(valid_states).squeeze(-1)
         if self.forward_looking:
             log_rewards = env.log_reward(states).unsqueeze(-1)
             log_F = log_F + log_rewards
@@ -189,39 +145,70 @@ class SubTBGFlowNet(TrajectoryBasedGFlowNet):
         log_state_flows[mask[:-1]] = log_F
         return log_state_flows
 
-    def calculate_masks(
+    def get_sub_trajectories_indices(
         self,
-        log_state_flows: LogStateFlowsTensor,
-        trajectories: Trajectories,
-    ) -> Tuple[MaskTensor, MaskTensor, MaskTensor]:
-        """
-        Calculate masks for sink and terminal states.
-        """
-        sink_states_mask = log_state_flows == -float("inf")
-        is_terminal_mask = trajectories.actions.is_exit
-        full_mask = sink_states_mask | is_terminal_mask
+        max_length: int,
+        min_sub_length: int = 1,
+        max_sub_length: int | None = None,
+        device: torch.device | None = None,
+    ) -> Tuple[SubTrajectoriesIndexTensor, SubTrajectoriesIndexTensor]:
+        """Enumerates the sub-trajectories of trajectories padded to `max_length`.
+
+        There are `max_length - i + 1` sub-trajectories of length `i`, starting at
+        positions `0, ..., max_length - i`. They are ordered by length, then by
+        starting position, which is the order of the rows of all the
+        `(n_sub_trajectories, n_trajectories)` tensors used by this class.
 
-        return full_mask, sink_states_mask, is_terminal_mask
+        Args:
+            max_length: the length of the padded trajectories.
+            min_sub_length: the smallest sub-trajectory length to enumerate.
+            max_sub_length: the largest sub-trajectory length to enumerate. Defaults
+                to `max_length`.
+            device: the device of the returned tensors.
 
-    def get_scores(
+        Returns: the length and the starting position of each sub-trajectory.
+        """
+        if max_sub_length is None:
+            max_sub_length = max_length
+        lengths = torch.arange(min_sub_length, max_sub_length + 1, device=device)
+        counts = max_length + 1 - lengths
+        n_sub_trajectories = sum(
+            max_length + 1 - i for i in range(min_sub_length, max_sub_length + 1)
+        )
+        sub_lengths = lengths.repeat_interleave(counts, output_size=n_sub_trajectories)
+        offsets = (counts.cumsum(0) - counts).repeat_interleave(
+            counts, output_size=n_sub_trajectories
+        )
+        starts = torch.arange(n_sub_trajectories, device=device) - offsets
+        return sub_lengths, starts
+
+    def get_cumulative_logprobs_and_flows(
         self, env: Env, trajectories: Trajectories
-    ) -> Tuple[List[TT[0, float]], List[TT[0, float]]]:
-        """Scores all submitted trajectories.
+    ) -> Tuple[
+        CumulativeLogProbsTensor,
+        CumulativeLogProbsTensor,
+        LogStateFlowsTensor,
+        TT["n_trajectories", torch.float],
+    ]:
+        """Evaluates the per-trajectory quantities all sub-trajectory scores derive from.
 
         Returns:
-            - A list of tensors, each of which representing the scores of all
-                sub-trajectories of length k, for k in `[1, ...,
-                trajectories.max_length]`, where the score of a sub-trajectory tau is
-                $log P_F(tau) + log F(tau_0) - log P_B(tau) - log F(tau_{-1})$. The
-                shape of the k-th tensor is `(trajectories.max_length - k + 1,
-                trajectories.n_trajectories)`, k starting from 1.
-            - A list of tensors representing what should be masked out in the each
-                element of the first list, given that not all sub-trajectories
-                of length k exist for each trajectory. The entries of those tensors are
-                True if the corresponding sub-trajectory does not exist.
+            - the cumulative log P_F of the actions of each trajectory.
+            - the cumulative log P_B of the actions of each trajectory.
+            - the log state flows of the states of each trajectory.
+            - the (clipped) log rewards of the trajectories.
         """
+        # $P_B$ and $\log F$ are evaluated on the same states with a single pass
+        # through their trunk, if they share one.
+        pb_outputs, log_F = None, None
+        if shares_trunk(self.pb, self.logF):
+            valid_states = trajectories.states[~trajectories.states.is_sink_state]
+            pb_outputs, log_F = evaluate_estimators(valid_states, self.pb, self.logF)
+            pb_outputs = pb_outputs[~valid_states.is_initial_state]
+            log_F = log_F.squeeze(-1)
+
         log_pf_trajectories, log_pb_trajectories = self.get_pfs_and_pbs(
-            trajectories, fill_value=-float("inf")
+            trajectories, fill_value=-float("inf"), pb_outputs=pb_outputs
         )
 
         log_pf_trajectories_cum = self.cumulative_logprobs(
@@ -232,213 +219,342 @@ class SubTBGFlowNet(TrajectoryBasedGFlowNet):
         )
 
         log_state_flows = self.calculate_log_state_flows(
-            env, trajectories, log_pf_trajectories
-        )
-        full_mask, sink_states_mask, is_terminal_mask = self.calculate_masks(
-            log_state_flows, trajectories
+            env, trajectories, log_pf_trajectories, log_F
         )
 
-        flattening_masks = []
-        scores = []
-        for i in range(1, 1 + trajectories.max_length):
-            preds = self.calculate_preds(log_pf_trajectories_cum, log_state_flows, i)
-            targets = self.calculate_targets(
-                trajectories,
-                preds,
-                log_pb_trajectories_cum,
-                log_state_flows,
-                is_terminal_mask,
-                sink_states_mask,
-                full_mask,
-                i,
-            )
+        log_rewards = trajectories.log_rewards
+        assert log_rewards is not None
+        if math.isfinite(self.log_reward_clip_min):
+            log_rewards = log_rewards.clamp_min(self.log_reward_clip_min)
 
-            flattening_mask = trajectories.when_is_done.lt(
-                torch.arange(
-                    i,
-                    trajectories.max_length + 1,
-                    device=trajectories.when_is_done.device,
-                ).unsqueeze(-1)
-            )
+        return (
+            log_pf_trajectories_cum,
+            log_pb_trajectories_cum,
+            log_state_flows,
+            log_rewards,
+        )
 
-            flat_preds = preds[~flattening_mask]
-            if torch.any(torch.isnan(flat_preds)):
-                raise ValueError("NaN in preds")
+    def calculate_scores(
+        self,
+        trajectories: Trajectories,
+        log_pf_trajectories_cum: CumulativeLogProbsTensor,
+        log_pb_trajectories_cum: CumulativeLogProbsTensor,
+        log_state_flows: LogStateFlowsTensor,
+        log_rewards: TT["n_trajectories", torch.float],
+        sub_lengths: SubTrajectoriesIndexTensor,
+        starts: SubTrajectoriesIndexTensor,
+    ) -> Tuple[ScoresTensor, MaskTensor]:
+        """Calculates the scores of the given sub-trajectories, in a single pass.
 
-            flat_targets = targets[~flattening_mask]
-            if torch.any(torch.isnan(flat_targets)):
-                raise ValueError("NaN in targets")
+        The score of the sub-trajectory going from state $s_j$ to state $s_k$ is
+        $log F(s_j) + log P_F(s_j -> s_k) - log P_B(s_k -> s_j) - log F(s_k)$, where
+        $log F(s_k)$ is replaced by the log reward if $s_k$ is the sink state, in
+        which case the log P_B of the exit action is not counted.
 
-            flattening_masks.append(flattening_mask)
-            scores.append(preds - targets)
+        Args:
+            sub_lengths: the length of each sub-trajectory.
+            starts: the starting position of each sub-trajectory.
 
-        return (scores, flattening_masks)
+        Returns:
+            - the scores, of shape `(n_sub_trajectories, n_trajectories)`.
+            - a mask, True where the sub-trajectory does not exist (i.e. it ends
+                after the end of the trajectory). The scores are not meaningful there.
 
-    def get_equal_within_contributions(
-        self, trajectories: Trajectories
-    ) -> ContributionsTensor:
+        Raises:
+            ValueError: if the predictions or targets of existing sub-trajectories
+                contain NaNs.
         """
-        Calculates contributions for the 'equal_within' weighting method.
-        """
-        is_done = trajectories.when_is_done
-        max_len = trajectories.max_length
-        n_rows = int(max_len * (1 + max_len) / 2)
+        ends = starts + sub_lengths
+        # The last state of a trajectory of length max_length is always s_f, which
+        # has no log state flow.
+        log_state_flows = torch.cat(
+            (log_state_flows, torch.full_like(log_state_flows[:1], -float("inf"))),
+            dim=0,
+        )
 
-        # the following tensor represents the inverse of how many sub-trajectories there are in each trajectory
-        contributions = 2.0 / (is_done * (is_done + 1)) / len(trajectories)
+        preds = (
+            log_pf_trajectories_cum[ends]
+            - log_pf_trajectories_cum[starts]
+            + log_state_flows[starts]
+        )
 
-        # if we repeat the previous tensor, we get a tensor of shape
-        # (max_len * (max_len + 1) / 2, n_trajectories) that we can multiply with
-        # all_scores to get a loss where each sub-trajectory is weighted equally
-        # within each trajectory.
-        contributions = contributions.repeat(n_rows, 1)
+        when_is_done = trajectories.when_is_done.unsqueeze(0)
+        is_terminal_mask = ends.unsqueeze(-1) == when_is_done
+        is_intermediate_mask = ends.unsqueeze(-1) < when_is_done
+        flattening_mask = ~(is_terminal_mask | is_intermediate_mask)
 
-        return contributions
+        # Sub-trajectories ending in s_f are matched with the log reward, and the
+        # log P_B of their actions, excluding the exit action.
+        terminal_targets = log_rewards + (
+            log_pb_trajectories_cum[ends - 1] - log_pb_trajectories_cum[starts]
+        )
+        intermediate_targets = (
+            log_pb_trajectories_cum[ends] - log_pb_trajectories_cum[starts]
+        ) + log_state_flows[ends]
+        targets = torch.where(
+            is_terminal_mask,
+            terminal_targets,
+            torch.where(is_intermediate_mask, intermediate_targets, -float("inf")),
+        )
 
-    def get_equal_contributions(
-        self, trajectories: Trajectories
-    ) -> ContributionsTensor:
-        """
-        Calculates contributions for the 'equal' weighting method.
-        """
-        is_done = trajectories.when_is_done
-        max_len = trajectories.max_length
-        n_rows = int(max_len * (1 + max_len) / 2)
-        n_sub_trajectories = int((is_done * (is_done + 1) / 2).sum().item())
-        contributions = torch.ones(n_rows, len(trajectories)) / n_sub_trajectories
-        return contributions
+        if torch.any(torch.isnan(preds) & ~flattening_mask):
+            raise ValueError("NaN in preds")
+        if torch.any(torch.isnan(targets) & ~flattening_mask):
+            raise ValueError("NaN in targets")
 
-    def get_tb_contributions(
-        self, trajectories: Trajectories, all_scores: TT
-    ) -> ContributionsTensor:
-        """
-        Calculates contributions for the 'TB' weighting method.
+        return preds - targets, flattening_mask
+
+    def get_scores(
+        self, env: Env, trajectories: Trajectories
+    ) -> Tuple[List[TT[0, float]], List[TT[0, float]]]:
+        """Scores all submitted trajectories.
+
+        Returns:
+            - A list of tensors, each of which representing the scores of all
+                sub-trajectories of length k, for k in `[1, ...,
+                trajectories.max_length]`, where the score of a sub-trajectory tau is
+                $log P_F(tau) + log F(tau_0) - log P_B(tau) - log F(tau_{-1})$. The
+                shape of the k-th tensor is `(trajectories.max_length - k + 1,
+                trajectories.n_trajectories)`, k starting from 1.
+            - A list of tensors representing what should be masked out in the each
+                element of the first list, given that not all sub-trajectories
+                of length k exist for each trajectory. The entries of those tensors are
+                True if the corresponding sub-trajectory does not exist.
         """
-        max_len = trajectories.max_length
-        is_done = trajectories.when_is_done
+        max_length = trajectories.max_length
+        sub_lengths, starts = self.get_sub_trajectories_indices(
+            max_length, device=trajectories.when_is_done.device
+        )
+        scores, flattening_mask = self.calculate_scores(
+            trajectories,
+            *self.get_cumulative_logprobs_and_flows(env, trajectories),
+            sub_lengths,
+            starts,
+        )
 
-        # Each trajectory contributes one element to the loss, equally weighted
-        contributions = torch.zeros_like(all_scores)
-        indices = (max_len * (is_done - 1) - (is_done - 1) * (is_done - 2) / 2).long()
-        contributions.scatter_(0, indices.unsqueeze(0), 1)
-        contributions = contributions / len(trajectories)
+        # The rows are ordered by sub-trajectory length: splitting returns views.
+        split_sizes = list(range(max_length, 0, -1))
+        return (
+            list(scores.split(split_sizes)),
+            list(flattening_mask.split(split_sizes)),
+        )
 
-        return contributions
+    def get_batch_statistics(self, trajectories: Trajectories) -> Dict[str, Any]:
+        """Calculates the statistics of the batch that the weights depend on.
 
-    def get_modified_db_contributions(
-        self, trajectories: Trajectories
-    ) -> ContributionsTensor:
-        """
-        Calculates contributions for the 'ModifiedDB' weighting method.
+        In distributed mode, the statistics are those of the global batch, i.e. of
+        the trajectories of all ranks.
+
+        Returns: a dictionary with the maximum trajectory length, the numbers of
+            trajectories, of transitions, and of sub-trajectories, and the number of
+            sub-trajectories of each length.
         """
         is_done = trajectories.when_is_done
-        max_len = trajectories.max_length
-        n_rows = int(max_len * (1 + max_len) / 2)
-
-        # The following tensor represents the inverse of how many transitions
-        # there are in each trajectory.
-        contributions = (1.0 / is_done / len(trajectories)).repeat(max_len, 1)
-        contributions = torch.cat(
+        device = is_done.device
+        max_length = trajectories.max_length
+        if self.distributed:
+            max_length = int(
+                dist_utils.all_reduce(
+                    torch.tensor(max_length, device=device),
+                    op="max",
+                    group=self.process_group,
+                )
+            )
+        lengths = torch.arange(1, max_length + 1, device=device).unsqueeze(-1)
+        statistics = torch.cat(
             (
-                contributions,
-                torch.zeros(
-                    (n_rows - max_len, len(trajectories)),
-                    device=contributions.device,
+                torch.stack(
+                    (
+                        torch.tensor(len(trajectories), device=device),
+                        is_done.sum(),
+                        (is_done * (is_done + 1) // 2).sum(),
+                    )
                 ),
-            ),
-            0,
-        )
-        return contributions
-
-    def get_geometric_within_contributions(
-        self, trajectories: Trajectories
+                (is_done - lengths + 1).clamp_min(0).sum(dim=-1),
+            )
+        ).float()
+        if self.distributed:
+            statistics = dist_utils.all_reduce(statistics, group=self.process_group)
+        return {
+            "max_length": max_length,
+            "n_trajectories": statistics[0],
+            "n_transitions": statistics[1],
+            "n_sub_trajectories": statistics[2],
+            "n_sub_trajectories_per_length": statistics[3:],
+        }
+
+    def get_contributions(
+        self,
+        trajectories: Trajectories,
+        sub_lengths: SubTrajectoriesIndexTensor,
+        statistics: Optional[Dict[str, Any]] = None,
     ) -> ContributionsTensor:
-        """
-        Calculates contributions for the 'geometric_within' weighting method.
-        """
-        L = self.lamda
-        max_len = trajectories.max_length
-        is_done = trajectories.when_is_done
+        """Calculates the weight of each sub-trajectory in the loss.
 
-        # The following tensor represents the weights given to each possible
-        # sub-trajectory length.
-        contributions = (L ** torch.arange(max_len).double()).float()
-        contributions = contributions.unsqueeze(-1).repeat(1, len(trajectories))
-        contributions = contributions.repeat_interleave(
-            torch.arange(max_len, 0, -1),
-            dim=0,
-            output_size=int(max_len * (max_len + 1) / 2),
-        )
+        The weight of a sub-trajectory only depends on its length and on the length
+        of its trajectory, which makes it possible to compute the weights of any
+        subset of the sub-trajectories. The weights of all existing
+        sub-trajectories sum to 1.
 
-        # Now we need to divide each column by n + (n-1) lambda +...+ 1*lambda^{n-1}
-        # where n is the length of the trajectory corresponding to that column
-        # We can do it the ugly way, or using the cool identity:
-        # https://www.wolframalpha.com/input?i=sum%28%28n-i%29+*+lambda+%5Ei%2C+i%3D0..n%29
-        per_trajectory_denom = (
-            1.0
-            / (1 - L) ** 2
-            * (L * (L ** is_done.double() - 1) + (1 - L) * is_done.double())
-        ).float()
-        contributions = contributions / per_trajectory_denom / len(trajectories)
+        Args:
+            sub_lengths: the length of each sub-trajectory.
+            statistics: the statistics of the batch, as returned by
+                `get_batch_statistics`. Computed if not given.
 
-        return contributions
+        Returns: the weights, of shape `(n_sub_trajectories, n_trajectories)`. The
+            weights of sub-trajectories that do not exist are not meaningful.
 
-    def loss(self, env: Env, trajectories: Trajectories) -> TT[0, float]:
-        # Get all scores and masks from the trajectories.
-        scores, flattening_masks = self.get_scores(env, trajectories)
-        flattening_mask = torch.cat(flattening_masks)
-        all_scores = torch.cat(scores, 0)
+        Raises:
+            ValueError: if the weighting method is unknown.
+        """
+        if statistics is None:
+            statistics = self.get_batch_statistics(trajectories)
+        is_done = trajectories.when_is_done.unsqueeze(0)
+        n_trajectories = statistics["n_trajectories"]
+        lengths = sub_lengths.unsqueeze(-1)
 
         if self.weighting == "DB":
             # Longer trajectories contribute more to the loss
-            return scores[0][~flattening_masks[0]].pow(2).mean()
+            contributions = (lengths == 1) / statistics["n_transitions"]
 
-        elif self.weighting == "geometric":
-            # The position i of the following 1D tensor represents the number of sub-
-            # trajectories of length i in the batch.
-            # n_sub_trajectories = torch.maximum(
-            #     trajectories.when_is_done - torch.arange(3).unsqueeze(-1),
-            #     torch.tensor(0),
-            # ).sum(1)
-
-            # The following tensor's k-th entry represents the mean of all losses of
-            # sub-trajectories of length k.
-            per_length_losses = torch.stack(
-                [
-                    scores[~flattening_mask].pow(2).mean()
-                    for scores, flattening_mask in zip(scores, flattening_masks)
-                ]
-            )
-            max_len = trajectories.max_length
-            L = self.lamda
-            ratio = (1 - L) / (1 - L**max_len)
-            weights = ratio * (
-                L ** torch.arange(max_len, device=per_length_losses.device)
-            )
-            assert (weights.sum() - 1.0).abs() < 1e-5, f"{weights.sum()}"
-            return (per_length_losses * weights).sum()
+        elif self.weighting == "ModifiedDB":
+            # Each trajectory contributes equally, through its transitions.
+            contributions = (lengths == 1) / is_done / n_trajectories
+
+        elif self.weighting == "TB":
+            # Each trajectory contributes one element to the loss, equally weighted
+            contributions = (lengths == is_done) / n_trajectories
 
         elif self.weighting == "equal_within":
-            contributions = self.get_equal_within_contributions(trajectories)
+            # The inverse of how many sub-trajectories there are in each trajectory.
+            contributions = 2.0 / (is_done * (is_done + 1)) / n_trajectories
+            contributions = contributions.expand(len(sub_lengths), -1)
 
         elif self.weighting == "equal":
-            contributions = self.get_equal_contributions(trajectories)
-
-        elif self.weighting == "TB":
-            contributions = self.get_tb_contributions(trajectories, all_scores)
+            contributions = torch.ones_like(lengths, dtype=torch.float).expand(
+                -1, is_done.shape[-1]
+            )
+            contributions = contributions / statistics["n_sub_trajectories"]
 
-        elif self.weighting == "ModifiedDB":
-            contributions = self.get_modified_db_contributions(trajectories)
+        elif self.weighting == "geometric":
+            # Sub-trajectories of length k get a total weight proportional to
+            # lambda ** (k - 1), split equally among them.
+            L = self.lamda
+            max_len = statistics["max_length"]
+            ratio = (1 - L) / (1 - L**max_len)
+            n_sub_trajectories_per_length = statistics["n_sub_trajectories_per_length"][
+                lengths - 1
+            ]
+            contributions = (
+                ratio
+                * (L ** (lengths - 1).double()).float()
+                / n_sub_trajectories_per_length
+            ).expand(-1, is_done.shape[-1])
 
         elif self.weighting == "geometric_within":
-            contributions = self.get_geometric_within_contributions(trajectories)
+            # Each sub-trajectory is weighed by lambda ** (k - 1), k being its length.
+            # Now we need to divide each column by n + (n-1) lambda +...+ 1*lambda^{n-1}
+            # where n is the length of the trajectory corresponding to that column
+            # We can do it the ugly way, or using the cool identity:
+            # https://www.wolframalpha.com/input?i=sum%28%28n-i%29+*+lambda+%5Ei%2C+i%3D0..n%29
+            L = self.lamda
+            per_trajectory_denom = (
+                1.0
+                / (1 - L) ** 2
+                * (L * (L ** is_done.double() - 1) + (1 - L) * is_done.double())
+            ).float()
+            contributions = (
+                (L ** (lengths - 1).double()).float()
+                / per_trajectory_denom
+                / n_trajectories
+            )
 
         else:
             raise ValueError(f"Unknown weighting method {self.weighting}")
 
-        flat_contributions = contributions[~flattening_mask]
-        assert (
-            flat_contributions.sum() - 1.0
-        ).abs() < 1e-5, f"{flat_contributions.sum()}"
-        losses = flat_contributions * all_scores[~flattening_mask].pow(2)
-        return losses.sum()
+        return contributions
+
+    def calculate_weighted_loss(
+        self,
+        trajectories: Trajectories,
+        log_pf_trajectories_cum: CumulativeLogProbsTensor,
+        log_pb_trajectories_cum: CumulativeLogProbsTensor,
+        log_state_flows: LogStateFlowsTensor,
+        log_rewards: TT["n_trajectories", torch.float],
+        sub_lengths: SubTrajectoriesIndexTensor,
+        starts: SubTrajectoriesIndexTensor,
+        statistics: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[TT[0, float], TT[0, float]]:
+        """Calculates the contribution of the given sub-trajectories to the loss.
+
+        Returns:
+            - the weighted sum of the squared scores of the sub-trajectories.
+            - the sum of their weights, which sums to 1 over all sub-trajectories.
+        """
+        scores, flattening_mask = self.calculate_scores(
+            trajectories,
+            log_pf_trajectories_cum,
+            log_pb_trajectories_cum,
+            log_state_flows,
+            log_rewards,
+            sub_lengths,
+            starts,
+        )
+        contributions = self.get_contributions(trajectories, sub_lengths, statistics)
+        contributions = contributions * ~flattening_mask
+
+        # The scores of sub-trajectories that do not exist can be infinite or NaN.
+        scores = torch.where(flattening_mask, 0.0, scores)
+        return (contributions * scores.pow(2)).sum(), contributions.sum()
+
+    def loss(self, env: Env, trajectories: Trajectories) -> TT[0, float]:
+        """Sub-trajectory balance loss.
+
+        All sub-trajectories are scored at once, or, if `chunk_size` is set, in chunks
+        of sub-trajectory lengths whose contributions are accumulated.
+
+        Raises:
+            ValueError: if the weighting method is unknown.
+            AssertionError: if the weights of the sub-trajectories do not sum to 1.
+        """
+        inputs = self.get_cumulative_logprobs_and_flows(env, trajectories)
+        statistics = self.get_batch_statistics(trajectories)
+        max_length = trajectories.max_length
+        device = trajectories.when_is_done.device
+        chunk_size = max_length if self.chunk_size is None else self.chunk_size
+
+        loss, total_contributions = 0.0, 0.0
+        for min_sub_length in range(1, max_length + 1, chunk_size):
+            sub_lengths, starts = self.get_sub_trajectories_indices(
+                max_length,
+                min_sub_length=min_sub_length,
+                max_sub_length=min(min_sub_length + chunk_size - 1, max_length),
+                device=device,
+            )
+            if chunk_size < max_length:
+                # Only the inputs of the chunk are kept for the backward pass.
+                chunk_loss, chunk_contributions = checkpoint(
+                    self.calculate_weighted_loss,
+                    trajectories,
+                    *inputs,
+                    sub_lengths,
+                    starts,
+                    statistics,
+                    use_reentrant=False,
+                )
+            else:
+                chunk_loss, chunk_contributions = self.calculate_weighted_loss(
+                    trajectories, *inputs, sub_lengths, starts, statistics
+                )
+            loss = loss + chunk_loss
+            total_contributions = total_contributions + chunk_contributions
+
+        if self.distributed:
+            # The weights are those of the global batch: they sum to 1 over all ranks,
+            # and the loss is scaled for the averaging of the losses of the ranks.
+            total_contributions = dist_utils.all_reduce(
+                torch.as_tensor(total_contributions), group=self.process_group
+            )
+            loss = loss * dist_utils.get_world_size(self.process_group)
+        assert (total_contributions - 1.0).abs() < 1e-5, f"{total_contributions}"
+        return loss
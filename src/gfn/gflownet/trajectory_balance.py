@@ -11,6 +11,7 @@ from gfn.containers import Trajectories
 from gfn.env import Env
 from gfn.gflownet.base import TrajectoryBasedGFlowNet
 from gfn.modules import GFNModule
+from gfn.utils import distributed as dist_utils
 
 
 class TBGFlowNet(TrajectoryBasedGFlowNet):
@@ -54,7 +55,7 @@ class TBGFlowNet(TrajectoryBasedGFlowNet):
         """
         del env  # unused
         _, _, scores = self.get_trajectories_scores(trajectories)
-        loss = (scores + self.logZ).pow(2).mean()
+        loss = self.batch_mean((scores + self.logZ).pow(2))
         if torch.isnan(loss):
             raise ValueError("loss is nan")
 
@@ -94,7 +95,16 @@ class LogPartitionVarianceGFlowNet(TrajectoryBasedGFlowNet):
         """
         del env  # unused
         _, _, scores = self.get_trajectories_scores(trajectories)
-        loss = (scores - scores.mean()).pow(2).mean()
+        # The gradients through the mean sum to 0: it needs no differentiable
+        # reduction over ranks.
+        mean = scores.mean()
+        if self.distributed:
+            mean = dist_utils.all_reduce(
+                torch.stack((scores.sum(), scores.new_tensor(scores.numel()))),
+                group=self.process_group,
+            )
+            mean = mean[0] / mean[1]
+        loss = self.batch_mean((scores - mean).pow(2))
         if torch.isnan(loss):
             raise ValueError("loss is NaN.")
 
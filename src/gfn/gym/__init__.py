@@ -1,3 +1,4 @@
 from gfn.gym.box import Box
 from gfn.gym.discrete_ebm import DiscreteEBM
 from gfn.gym.hypergrid import HyperGrid
+from gfn.gym.vectorized import VectorizedEnv
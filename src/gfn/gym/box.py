@@ -12,6 +12,8 @@ from gfn.states import States
 class Box(Env):
     """Box environment, corresponding to the one in Section 4.1 of https://arxiv.org/abs/2301.12594"""
 
+    reward_parameters = ("R0", "R1", "R2")
+
     def __init__(
         self,
         delta: float = 0.1,
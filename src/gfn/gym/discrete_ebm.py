@@ -42,6 +42,8 @@ class IsingModel(EnergyFunction):
 class DiscreteEBM(DiscreteEnv):
     """Environment for discrete energy-based models, based on https://arxiv.org/pdf/2202.01361.pdf"""
 
+    reward_parameters = ("alpha", "energy")
+
     def __init__(
         self,
         ndim: int,
@@ -100,11 +102,16 @@ class DiscreteEBM(DiscreteEnv):
 
     def update_masks(self, states: type[States]) -> None:
         states.set_default_typing()
-        states.forward_masks[..., : self.ndim] = states.tensor == -1
-        states.forward_masks[..., self.ndim : 2 * self.ndim] = states.tensor == -1
-        states.forward_masks[..., -1] = torch.all(states.tensor != -1, dim=-1)
-        states.backward_masks[..., : self.ndim] = states.tensor == 0
-        states.backward_masks[..., self.ndim : 2 * self.ndim] = states.tensor == 1
+        # Only unset coordinates (-1) can be set, to 0 or 1. Exiting is only allowed,
+        # and then mandatory, once all coordinates are set.
+        is_set = states.tensor != -1
+        states.set_nonexit_action_masks(
+            torch.cat((is_set, is_set), dim=-1), allow_exit=False
+        )
+        states.set_exit_masks(torch.all(is_set, dim=-1))
+        states.set_backward_masks(
+            torch.cat((states.tensor == 0, states.tensor == 1), dim=-1)
+        )
 
     def make_random_states_tensor(self, batch_shape: Tuple) -> Tensor:
         return torch.randint(
@@ -138,6 +145,18 @@ class DiscreteEBM(DiscreteEnv):
         )
         return states.tensor
 
+    def fused_step(
+        self, states: States, actions: Actions
+    ) -> TT["batch_shape", "state_shape", torch.float]:
+        is_done = states.is_sink_state | actions.is_exit
+        # Actions in [0, ndim-1] set an index to 0, actions in [ndim, 2*ndim-1] to 1.
+        new_states_tensor = states.tensor.scatter(
+            -1,
+            actions.tensor.fmod(self.ndim).clamp(min=0),
+            (actions.tensor >= self.ndim).to(states.tensor.dtype),
+        )
+        return torch.where(is_done.unsqueeze(-1), self.sf, new_states_tensor)
+
     def backward_step(
         self, states: States, actions: Actions
     ) -> TT["batch_shape", "state_shape", torch.float]:
@@ -16,6 +16,8 @@ from gfn.states import DiscreteStates
 
 
 class HyperGrid(DiscreteEnv):
+    reward_parameters = ("R0", "R1", "R2")
+
     def __init__(
         self,
         ndim: int = 2,
@@ -94,7 +96,7 @@ class HyperGrid(DiscreteEnv):
             states.tensor == self.height - 1,
             allow_exit=True,
         )
-        states.backward_masks = states.tensor != 0
+        states.set_backward_masks(states.tensor != 0)
 
     def make_random_states_tensor(
         self, batch_shape: Tuple[int, ...]
@@ -110,6 +112,18 @@ class HyperGrid(DiscreteEnv):
         new_states_tensor = states.tensor.scatter(-1, actions.tensor, 1, reduce="add")
         return new_states_tensor
 
+    def fused_step(
+        self, states: DiscreteStates, actions: Actions
+    ) -> TT["batch_shape", "state_shape", torch.float]:
+        is_done = states.is_sink_state | actions.is_exit
+        # Exit and dummy actions are clamped to a valid index, and add nothing.
+        new_states_tensor = states.tensor.scatter_add(
+            -1,
+            actions.tensor.clamp(0, self.ndim - 1),
+            (~is_done).unsqueeze(-1).to(states.tensor.dtype),
+        )
+        return torch.where(is_done.unsqueeze(-1), self.sf, new_states_tensor)
+
     def backward_step(
         self, states: DiscreteStates, actions: Actions
     ) -> TT["batch_shape", "state_shape", torch.float]:
@@ -0,0 +1,191 @@
+from copy import copy
+from numbers import Number
+from typing import Any, Sequence
+
+import torch
+import torch.nn as nn
+from torchtyping import TensorType as TT
+
+from gfn.containers import Trajectories
+from gfn.env import Env
+from gfn.samplers import Sampler
+from gfn.states import DiscreteStates, States
+
+
+def _are_equal(values: Sequence[Any]) -> bool:
+    """Returns whether all the values are equal to the first one.
+
+    Tensors are compared elementwise, and modules by their type and state dict.
+    """
+    first = values[0]
+    for value in values[1:]:
+        if value is first:
+            continue
+        if isinstance(first, torch.Tensor) and isinstance(value, torch.Tensor):
+            if not torch.equal(first, value):
+                return False
+        elif isinstance(first, nn.Module) and isinstance(value, nn.Module):
+            first_state, state = first.state_dict(), value.state_dict()
+            if type(first) is not type(value) or first_state.keys() != state.keys():
+                return False
+            if not all(torch.equal(first_state[k], state[k]) for k in first_state):
+                return False
+        elif value != first:
+            return False
+    return True
+
+
+class VectorizedEnv:
+    """Several configurations of an environment, sampled from in a single rollout.
+
+    The environments must only differ by their `reward_parameters`, so that they share
+    their states, actions, and dynamics. A batch of trajectories is then sampled for
+    all the configurations at once, with a shared policy, and the rewards are
+    evaluated with per-row parameters: the scalar reward parameters that differ
+    across configurations are stacked in tensors, with one value per state. Reward
+    parameters that differ but cannot be stacked (e.g. different energy functions)
+    are handled by evaluating the rewards of each configuration separately.
+
+    Attributes:
+        envs: the environments.
+        env: the environment used for the dynamics of the rollouts, i.e. the first one.
+        parameters: the stacked reward parameters that differ across environments,
+            of shape `(n_envs,)`.
+    """
+
+    def __init__(self, envs: Sequence[Env]):
+        """Initializes a vectorized environment.
+
+        Args:
+            envs: the configurations of the environment.
+
+        Raises:
+            ValueError: if the environments do not share their dynamics.
+        """
+        if len(envs) == 0:
+            raise ValueError("At least one environment is required.")
+        self.envs = list(envs)
+        self.env = self.envs[0]
+
+        env_class = type(self.env)
+        reward_parameters = env_class.reward_parameters
+        for env in self.envs[1:]:
+            if type(env) is not env_class:
+                raise ValueError("All environments must be of the same class.")
+            for name, value in env.__dict__.items():
+                if name in reward_parameters or name.startswith("_"):
+                    continue
+                if isinstance(value, (Number, str, torch.Tensor)) and not _are_equal(
+                    [self.env.__dict__.get(name), value]
+                ):
+                    raise ValueError(
+                        f"The environments differ by {name}, which is not a reward "
+                        f"parameter of {env_class.__name__}."
+                    )
+
+        self.parameters: dict[str, TT["n_envs", torch.float]] = {}
+        self._loop_over_envs = False
+        for name in reward_parameters:
+            values = [getattr(env, name) for env in self.envs]
+            if _are_equal(values):
+                continue
+            if all(isinstance(value, Number) for value in values):
+                self.parameters[name] = torch.tensor(
+                    values, dtype=torch.float, device=self.env.device
+                )
+            else:
+                self._loop_over_envs = True
+
+    @property
+    def n_envs(self) -> int:
+        return len(self.envs)
+
+    def get_env_indices(
+        self, n_trajectories: int
+    ) -> TT["n_envs * n_trajectories", torch.long]:
+        """Returns the index of the environment of each row of a vectorized batch."""
+        return torch.arange(self.n_envs, device=self.env.device).repeat_interleave(
+            n_trajectories
+        )
+
+    def log_reward(
+        self, final_states: States, env_indices: TT["batch_shape", torch.long]
+    ) -> TT["batch_shape", torch.float]:
+        """Evaluates the log rewards of states of different environments.
+
+        Args:
+            final_states: the states whose rewards are evaluated.
+            env_indices: the index of the environment of each state.
+        """
+        if self._loop_over_envs:
+            log_rewards = torch.zeros(
+                final_states.batch_shape, dtype=torch.float, device=self.env.device
+            )
+            for i, env in enumerate(self.envs):
+                is_env = env_indices == i
+                log_rewards[is_env] = env.log_reward(final_states[is_env])
+            return log_rewards
+
+        # A shallow copy of the environment, with one value of each parameter per row.
+        env = copy(self.env)
+        for name, values in self.parameters.items():
+            setattr(env, name, values[env_indices])
+        return env.log_reward(final_states)
+
+    def sample_trajectories(
+        self,
+        sampler: Sampler,
+        n_trajectories: int,
+        off_policy: bool = False,
+        **sampler_kwargs,
+    ) -> list[Trajectories]:
+        """Samples trajectories for all the environments, in a single rollout.
+
+        Args:
+            sampler: the sampler of the forward policy shared by the environments.
+            n_trajectories: the number of trajectories per environment.
+            off_policy: whether the trajectories are sampled off policy.
+            sampler_kwargs: keyword arguments passed to `sampler.sample_trajectories`.
+
+        Returns:
+            A list with the `Trajectories` of each environment, attached to it and
+            holding its rewards.
+
+        Raises:
+            ValueError: if the sampler's estimator is a backward policy.
+        """
+        if sampler.estimator.is_backward:
+            raise ValueError("Only forward trajectories can be vectorized.")
+
+        trajectories = sampler.sample_trajectories(
+            self.env,
+            off_policy=off_policy,
+            n_trajectories=self.n_envs * n_trajectories,
+            **sampler_kwargs,
+        )
+        env_indices = self.get_env_indices(n_trajectories)
+        log_rewards = self.log_reward(trajectories.last_states, env_indices)
+
+        all_trajectories = []
+        for i, env in enumerate(self.envs):
+            index = torch.arange(
+                i * n_trajectories, (i + 1) * n_trajectories, device=self.env.device
+            )
+            env_trajectories = trajectories[index]
+            env_trajectories.env = env
+            env_trajectories.states = self._to_env_states(env, env_trajectories.states)
+            env_trajectories.actions = env.Actions(env_trajectories.actions.tensor)
+            env_trajectories._log_rewards = log_rewards[index]
+            all_trajectories.append(env_trajectories)
+        return all_trajectories
+
+    @staticmethod
+    def _to_env_states(env: Env, states: States) -> States:
+        """Wraps the tensors of `states` in the `States` class of `env`."""
+        if isinstance(states, DiscreteStates):
+            return env.States(
+                states.tensor,
+                forward_masks=states.forward_masks,
+                backward_masks=states.backward_masks,
+            )
+        return env.States(states.tensor)
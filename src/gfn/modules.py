@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Optional
+from typing import Dict, List, Optional
 
 import torch
 import torch.nn as nn
@@ -9,6 +9,7 @@ from torchtyping import TensorType as TT
 from gfn.preprocessors import IdentityPreprocessor, Preprocessor
 from gfn.states import DiscreteStates, States
 from gfn.utils.distributions import UnsqueezedCategorical
+from gfn.utils.modules import DiscreteUniform, HeadModule
 
 
 class GFNModule(ABC, nn.Module):
@@ -160,6 +161,20 @@ class DiscretePolicyEstimator(GFNModule):
         else:
             return self.n_actions
 
+    @property
+    def is_uniform(self) -> bool:
+        """Whether the policy is uniform over the allowed actions (see `DiscreteUniform`)."""
+        return isinstance(self.module, DiscreteUniform)
+
+    def uniform_log_probs(self, states: DiscreteStates) -> TT["batch_shape", float]:
+        r"""Returns the log probability of the allowed actions of a uniform policy.
+
+        This is $-\log$ of the number of allowed actions of each state, read from the
+        masks of the states, with no evaluation of the module.
+        """
+        masks = states.backward_masks if self.is_backward else states.forward_masks
+        return -torch.log(masks.sum(dim=-1, dtype=torch.float))
+
     def to_probability_distribution(
         self,
         states: DiscreteStates,
@@ -196,3 +211,124 @@ class DiscretePolicyEstimator(GFNModule):
         # LogEdgeFlows are greedy, as are more P_B.
         else:
             return UnsqueezedCategorical(logits=logits)
+
+
+class MultiHeadEstimator(GFNModule):
+    r"""Estimators of $P_F$, $P_B$ and $\log F$ sharing a trunk, for discrete environments.
+
+    The estimators `pf`, `pb` and `logF` are regular estimators, whose modules are
+    `HeadModule`s on top of the same trunk. They can thus be used separately, e.g.
+    by samplers, while the losses evaluate them together on their common states,
+    with a single pass through the preprocessor and the trunk (see
+    `evaluate_estimators`). Calling the estimator itself returns the outputs of all
+    the heads.
+
+    Attributes:
+        module: the trunk.
+        heads: the heads, keyed by "pf", "pb", and "logF".
+        pf: the estimator of the forward policy.
+        pb: the estimator of the backward policy.
+        logF: the estimator of the log state flows.
+    """
+
+    def __init__(
+        self,
+        module: nn.Module,
+        n_actions: int,
+        preprocessor: Preprocessor | None = None,
+        pf_head: nn.Module | None = None,
+        pb_head: nn.Module | None = None,
+        logF_head: nn.Module | None = None,
+    ):
+        r"""Initializes the estimators.
+
+        Args:
+            module: the trunk, e.g. the torso of a `NeuralNet`. It needs a `hidden_dim`
+                attribute, the dimension of its outputs, unless all heads are given.
+            n_actions: Total number of actions in the Discrete Environment.
+            preprocessor: Preprocessor object.
+            pf_head: the head of $P_F$. Defaults to a linear layer.
+            pb_head: the head of $P_B$. Defaults to a linear layer.
+            logF_head: the head of $\log F$. Defaults to a linear layer.
+        """
+        super().__init__(module, preprocessor)
+        self.n_actions = n_actions
+        heads = {"pf": pf_head, "pb": pb_head, "logF": logF_head}
+        output_dims = {"pf": n_actions, "pb": n_actions - 1, "logF": 1}
+        self.heads = nn.ModuleDict(
+            {
+                name: (
+                    head
+                    if head is not None
+                    else nn.Linear(module.hidden_dim, output_dims[name])
+                )
+                for name, head in heads.items()
+            }
+        )
+        self.pf = DiscretePolicyEstimator(
+            HeadModule(module, self.heads["pf"]), n_actions, self.preprocessor
+        )
+        self.pb = DiscretePolicyEstimator(
+            HeadModule(module, self.heads["pb"]),
+            n_actions,
+            self.preprocessor,
+            is_backward=True,
+        )
+        self.logF = ScalarEstimator(
+            HeadModule(module, self.heads["logF"]), self.preprocessor
+        )
+
+    def expected_output_dim(self) -> int:
+        return self.module.hidden_dim
+
+    def forward(self, states: States) -> Dict[str, TT["batch_shape", "output_dim"]]:
+        features = self.module(self.preprocessor(states))
+        return {name: head(features) for name, head in self.heads.items()}
+
+
+def is_uniform_policy(estimator: GFNModule | None) -> bool:
+    """Whether the estimator is a uniform policy, whose log probabilities are known.
+
+    The losses then compute them from the masks of the states (see
+    `DiscretePolicyEstimator.uniform_log_probs`), instead of evaluating the estimator.
+    """
+    return isinstance(estimator, DiscretePolicyEstimator) and estimator.is_uniform
+
+
+def shares_trunk(*estimators: GFNModule | None) -> bool:
+    """Whether the estimators are heads on the same trunk and preprocessor."""
+    if len(estimators) < 2 or any(
+        estimator is None or not isinstance(estimator.module, HeadModule)
+        for estimator in estimators
+    ):
+        return False
+    first = estimators[0]
+    return all(
+        estimator.module.trunk is first.module.trunk
+        and estimator.preprocessor is first.preprocessor
+        for estimator in estimators[1:]
+    )
+
+
+def evaluate_estimators(
+    states: States, *estimators: GFNModule | None
+) -> List[TT["batch_shape", "output_dim", float] | None]:
+    """Evaluates several estimators on the same states.
+
+    If the estimators share a trunk (see `MultiHeadEstimator`), the states are only
+    preprocessed and passed through the trunk once. Estimators that are None are
+    skipped, and their outputs are None.
+
+    Returns: the outputs of the estimators, in order.
+    """
+    present = [estimator for estimator in estimators if estimator is not None]
+    if not shares_trunk(*present):
+        return [
+            estimator(states) if estimator is not None else None
+            for estimator in estimators
+        ]
+    features = present[0].module.trunk(present[0].preprocessor(states))
+    return [
+        estimator.module.head(features) if estimator is not None else None
+        for estimator in estimators
+    ]
@@ -1,14 +1,17 @@
-from copy import deepcopy
-from typing import List, Optional, Tuple
+from typing import Optional, Tuple
 
 import torch
 from torchtyping import TensorType as TT
 
 from gfn.actions import Actions
 from gfn.containers import Trajectories
+from gfn.containers.trajectories import pad_dim0_to_target
 from gfn.env import Env
 from gfn.modules import GFNModule
-from gfn.states import States, stack_states
+from gfn.states import DiscreteStates, States
+
+# Default length of the rollout buffers, when the trajectory length is not known.
+DEFAULT_BUFFER_LENGTH = 16
 
 
 class Sampler:
@@ -93,10 +96,17 @@ class Sampler:
         states: Optional[States] = None,
         n_trajectories: Optional[int] = None,
         debug_mode: bool = False,
+        max_length: Optional[int] = None,
+        compact_active_set: bool = False,
         **policy_kwargs,
     ) -> Trajectories:
         """Sample trajectories sequentially.
 
+        The states, actions, log probabilities and estimator outputs of the rollout are
+        written in place into buffers of shape `(max_length + 1, n_trajectories, ...)`
+        that are allocated once, and grown geometrically (doubled) when a trajectory
+        runs longer than expected.
+
         Args:
             env: The environment to sample trajectories from.
             off_policy: If True, samples actions such that we skip log probability
@@ -112,6 +122,15 @@ class Sampler:
                 kwargs will be user defined. This can be used to, for example, sample
                 off-policy.
             debug_mode: if True, everything gets calculated.
+            max_length: Expected maximum length of the trajectories, used to size the
+                rollout buffers. Defaults to `DEFAULT_BUFFER_LENGTH`. Trajectories
+                longer than this are supported, at the cost of growing the buffers.
+            compact_active_set: If True, only the trajectories that are still active
+                are kept in the loop. The environment step, the mask update and the
+                reward evaluation then run on this compacted subset, and the results
+                are scattered back into the rollout buffers. This saves the work
+                otherwise spent on finished trajectories, which dominates when
+                trajectory lengths are heavy-tailed.
 
         Returns: A Trajectories object representing the batch of sampled trajectories.
 
@@ -134,16 +153,26 @@ class Sampler:
             n_trajectories = states.batch_shape[0]
 
         device = states.tensor.device
+        is_backward = self.estimator.is_backward
+        buffer_length = max_length if max_length is not None else DEFAULT_BUFFER_LENGTH
+        buffer_length = max(buffer_length, 1)
 
-        dones = (
-            states.is_initial_state
-            if self.estimator.is_backward
-            else states.is_sink_state
-        )
+        dones = states.is_initial_state if is_backward else states.is_sink_state
 
-        trajectories_states: List[States] = [deepcopy(states)]
-        trajectories_actions: List[TT["n_trajectories", torch.long]] = []
-        trajectories_logprobs: List[TT["n_trajectories", torch.float]] = []
+        # Rollout buffers, written in place at each step. Positions that are never
+        # written keep their padding values ($s_f$ or $s_0$, dummy actions, zero log
+        # probabilities, and -inf estimator outputs).
+        trajectories_states = make_states_buffer(
+            env, buffer_length + 1, n_trajectories, is_backward
+        )
+        trajectories_states[0] = states
+        trajectories_actions = env.actions_from_batch_shape(
+            (buffer_length, n_trajectories)
+        )
+        trajectories_logprobs = torch.zeros(
+            (buffer_length, n_trajectories), dtype=torch.float, device=device
+        )
+        all_estimator_outputs = None
         trajectories_dones = torch.zeros(
             n_trajectories, dtype=torch.long, device=device
         )
@@ -152,20 +181,50 @@ class Sampler:
         )
 
         step = 0
-        all_estimator_outputs = []
 
-        while not all(dones):
-            actions = env.actions_from_batch_shape((n_trajectories,))  # Dummy actions.
-            log_probs = torch.full(
-                (n_trajectories,), fill_value=0, dtype=torch.float, device=device
-            )
+        if compact_active_set:
+            # Indices, in the full batch, of the trajectories that are still active.
+            # `states` then only holds the states of these trajectories.
+            active_idx = torch.arange(n_trajectories, device=device)[~dones]
+            states = states[active_idx]
+
+        while True:
+            # Index of the active trajectories in the rollout buffers, and their states.
+            if compact_active_set:
+                idx = active_idx
+                active_states = states
+            else:
+                idx = ~dones
+                active_states = states[idx]
+
+            # The batch shape of the active states is known on the host once they are
+            # gathered, so checking whether all the trajectories are done requires no
+            # additional synchronization with the device.
+            if len(active_states) == 0:
+                break
+
+            if step == buffer_length:
+                # Geometric growth, so that the amortized cost of a step is O(1).
+                buffer_length *= 2
+                trajectories_states = extend_states_buffer(
+                    env, trajectories_states, buffer_length + 1, is_backward
+                )
+                trajectories_actions.extend_with_dummy_actions(buffer_length)
+                trajectories_logprobs = Trajectories.extend_log_probs(
+                    trajectories_logprobs, buffer_length
+                )
+                if all_estimator_outputs is not None:
+                    all_estimator_outputs = pad_dim0_to_target(
+                        all_estimator_outputs, buffer_length
+                    )
+
             # This optionally allows you to retrieve the estimator_outputs collected
             # during sampling. This is useful if, for example, you want to evaluate off
             # policy actions later without repeating calculations to obtain the env
             # distribution parameters.
             valid_actions, actions_log_probs, estimator_outputs = self.sample_actions(
                 env,
-                states[~dones],
+                active_states,
                 save_estimator_outputs=True if save_estimator_outputs else False,
                 calculate_logprobs=False if skip_logprob_calculaion else True,
                 **policy_kwargs,
@@ -173,27 +232,29 @@ class Sampler:
             if estimator_outputs is not None:
                 # Place estimator outputs into a stackable tensor. Note that this
                 # will be replaced with torch.nested.nested_tensor in the future.
-                estimator_outputs_padded = torch.full(
-                    (n_trajectories,) + estimator_outputs.shape[1:],
-                    fill_value=-float("inf"),
-                    dtype=torch.float,
-                    device=device,
-                )
-                estimator_outputs_padded[~dones] = estimator_outputs
-                all_estimator_outputs.append(estimator_outputs_padded)
-
-            actions[~dones] = valid_actions
+                if all_estimator_outputs is None:
+                    all_estimator_outputs = torch.full(
+                        (buffer_length, n_trajectories) + estimator_outputs.shape[1:],
+                        fill_value=-float("inf"),
+                        dtype=torch.float,
+                        device=device,
+                    )
+                all_estimator_outputs[step, idx] = estimator_outputs
+
+            # A view on the current step of the actions buffer, filled with dummy
+            # actions. Writing to it writes to the buffer.
+            actions = trajectories_actions[step]
+            actions[idx] = valid_actions
             if not skip_logprob_calculaion:
                 # When off_policy, actions_log_probs are None.
-                log_probs[~dones] = actions_log_probs
-            trajectories_actions += [actions]
-            trajectories_logprobs += [log_probs]
+                trajectories_logprobs[step, idx] = actions_log_probs
 
-            if self.estimator.is_backward:
-                new_states = env._backward_step(states, actions)
+            # In compact mode, only the active trajectories are stepped.
+            step_actions = valid_actions if compact_active_set else actions
+            if is_backward:
+                new_states = env._backward_step(states, step_actions)
             else:
-                new_states = env._step(states, actions)
-            sink_states_mask = new_states.is_sink_state
+                new_states = env._step(states, step_actions)
 
             # Increment the step, determine which trajectories are finisihed, and eval
             # rewards.
@@ -202,41 +263,319 @@ class Sampler:
             # pad the sink state to every short trajectory, we need to make sure
             # to filter out the already done ones.
             new_dones = (
-                new_states.is_initial_state
-                if self.estimator.is_backward
-                else sink_states_mask
-            ) & ~dones
-            trajectories_dones[new_dones & ~dones] = step
+                new_states.is_initial_state if is_backward else new_states.is_sink_state
+            )
+            if compact_active_set:
+                new_dones_idx = active_idx[new_dones]
+            else:
+                new_dones = new_dones & ~dones
+                new_dones_idx = new_dones
+            trajectories_dones[new_dones_idx] = step
             try:
-                trajectories_log_rewards[new_dones & ~dones] = env.log_reward(
-                    states[new_dones & ~dones]
+                trajectories_log_rewards[new_dones_idx] = env.log_reward(
+                    states[new_dones]
                 )
             except NotImplementedError:
-                trajectories_log_rewards[new_dones & ~dones] = torch.log(
-                    env.reward(states[new_dones & ~dones])
+                trajectories_log_rewards[new_dones_idx] = torch.log(
+                    env.reward(states[new_dones])
                 )
-            states = new_states
-            dones = dones | new_dones
 
-            trajectories_states += [deepcopy(states)]
-
-        trajectories_states = stack_states(trajectories_states)
-        trajectories_actions = env.Actions.stack(trajectories_actions)
-        trajectories_logprobs = torch.stack(trajectories_logprobs, dim=0)
+            if compact_active_set:
+                # Finished trajectories are already padded in the states buffer.
+                trajectories_states[step][active_idx] = new_states
+                states = new_states[~new_dones]
+                active_idx = active_idx[~new_dones]
+            else:
+                states = new_states
+                dones = dones | new_dones
+                trajectories_states[step] = states
 
         # TODO: use torch.nested.nested_tensor(dtype, device, requires_grad).
+        if save_estimator_outputs and all_estimator_outputs is not None:
+            all_estimator_outputs = all_estimator_outputs[:step]
+
+        trajectories = Trajectories(
+            env=env,
+            states=trajectories_states[: step + 1],
+            actions=trajectories_actions[:step],
+            when_is_done=trajectories_dones,
+            is_backward=is_backward,
+            log_rewards=trajectories_log_rewards,
+            log_probs=trajectories_logprobs[:step],
+            estimator_outputs=all_estimator_outputs if save_estimator_outputs else None,
+        )
+
+        return trajectories
+
+    def rollout_step(
+        self,
+        env: Env,
+        states: States,
+        dones: TT["n_trajectories", torch.bool],
+        save_estimator_outputs: bool = False,
+        calculate_logprobs: bool = True,
+        **policy_kwargs: Optional[dict],
+    ) -> Tuple[
+        Actions,
+        Optional[TT["n_trajectories", torch.float]],
+        Optional[TT["n_trajectories", "output_dim", torch.float]],
+        States,
+    ]:
+        """Samples actions for, and steps, a full batch of states with static shapes.
+
+        The estimator is evaluated on all the states of the batch, done states
+        included, so that no tensor has a data-dependent shape. The done states are
+        replaced by $s_0$, with all actions allowed, before being fed to the
+        estimator; their actions are then set to the dummy action, their log
+        probabilities to 0, and their estimator outputs to -inf.
+
+        Args:
+            env: The environment to step.
+            states: A uni-dimensional batch of states.
+            dones: Whether each trajectory is done.
+            save_estimator_outputs: If True, the estimator outputs will be returned.
+            calculate_logprobs: If True, calculates the log probabilities of sampled
+                actions.
+            policy_kwargs: keyword arguments to be passed to the
+                `to_probability_distribution` method of the estimator.
+
+        Returns:
+            A tuple with the sampled actions, their log probabilities (or None), the
+            estimator outputs (or None), and the next states.
+        """
+        estimator_states = replace_done_states(env, states, dones)
+        estimator_output = self.estimator(estimator_states)
+        dist = self.estimator.to_probability_distribution(
+            estimator_states, estimator_output, **policy_kwargs
+        )
+
+        with torch.no_grad():
+            actions_tensor = dist.sample()
+
+        log_probs = None
+        if calculate_logprobs:
+            log_probs = dist.log_prob(actions_tensor).masked_fill(dones, 0.0)
+
+        actions_tensor = torch.where(
+            dones.view(dones.shape + (1,) * len(env.action_shape)),
+            env.Actions.dummy_action,
+            actions_tensor,
+        )
+        actions = env.actions_from_tensor(actions_tensor)
+
         if save_estimator_outputs:
-            all_estimator_outputs = torch.stack(all_estimator_outputs, dim=0)
+            estimator_output = estimator_output.masked_fill(
+                dones.view(dones.shape + (1,) * (estimator_output.ndim - 1)),
+                -float("inf"),
+            )
+        else:
+            estimator_output = None
+
+        if self.estimator.is_backward:
+            new_states = env._backward_step(states, actions)
+        else:
+            new_states = env._step(states, actions)
+
+        return actions, log_probs, estimator_output, new_states
+
+    def sample_trajectories_static(
+        self,
+        env: Env,
+        off_policy: bool,
+        max_length: int,
+        states: Optional[States] = None,
+        n_trajectories: Optional[int] = None,
+        debug_mode: bool = False,
+        done_check_interval: int = 8,
+        **policy_kwargs,
+    ) -> Trajectories:
+        """Sample trajectories with a static-shape rollout loop.
+
+        Unlike `sample_trajectories`, no step of the rollout indexes the batch with a
+        data-dependent mask: all the states are passed through `rollout_step` at each
+        step, and the results are written into buffers of shape
+        `(max_length + 1, n_trajectories, ...)` allocated once. Whether all the
+        trajectories are done, which requires reading a value on the host, is only
+        checked every `done_check_interval` steps, and the rewards are evaluated once,
+        on the last states of the trajectories. The step body can thus be compiled
+        once, e.g. with `sampler.rollout_step = torch.compile(sampler.rollout_step)`.
+
+        For the environment step to have static shapes as well, discrete environments
+        implementing `fused_step` should set `use_fused_step`, and actions sampled from
+        masked distributions need no validation (see `Env.set_action_validation`).
+
+        Args:
+            env: The environment to sample trajectories from.
+            off_policy: If True, samples actions such that we skip log probability
+                calculation, and we save the estimator outputs for later use.
+            max_length: The maximum length of the trajectories, i.e. the horizon of
+                the rollout.
+            states: If given, trajectories would start from such states. Otherwise,
+                trajectories are sampled from $s_o$ and n_trajectories must be provided.
+            n_trajectories: If given, a batch of n_trajectories will be sampled all
+                starting from the environment's s_0.
+            debug_mode: if True, everything gets calculated.
+            done_check_interval: The number of steps between two checks of whether all
+                trajectories are done.
+            policy_kwargs: keyword arguments to be passed to the
+                `to_probability_distribution` method of the estimator.
+
+        Returns: A Trajectories object representing the batch of sampled trajectories,
+            identical in layout to the one returned by `sample_trajectories`.
+
+        Raises:
+            AssertionError: When both states and n_trajectories are specified.
+            AssertionError: When states are not linear.
+            ValueError: When some trajectories are not done after `max_length` steps.
+        """
+        save_estimator_outputs = off_policy or debug_mode
+        skip_logprob_calculaion = off_policy and not debug_mode
+
+        if states is None:
+            assert (
+                n_trajectories is not None
+            ), "Either states or n_trajectories should be specified"
+            states = env.reset(batch_shape=(n_trajectories,))
+        else:
+            assert (
+                len(states.batch_shape) == 1
+            ), "States should be a linear batch of states"
+            n_trajectories = states.batch_shape[0]
+
+        device = states.tensor.device
+        is_backward = self.estimator.is_backward
+        dones = states.is_initial_state if is_backward else states.is_sink_state
+        states_dones_shape = (n_trajectories,) + (1,) * len(env.state_shape)
+
+        trajectories_states = make_states_buffer(
+            env, max_length + 1, n_trajectories, is_backward
+        )
+        trajectories_states[0] = states
+        trajectories_actions = env.actions_from_batch_shape(
+            (max_length, n_trajectories)
+        )
+        trajectories_logprobs = torch.zeros(
+            (max_length, n_trajectories), dtype=torch.float, device=device
+        )
+        all_estimator_outputs = None
+        trajectories_dones = torch.zeros(
+            n_trajectories, dtype=torch.long, device=device
+        )
+        # The states from which the trajectories finish, whose rewards are evaluated
+        # at the end of the rollout.
+        last_states_tensor = torch.where(
+            dones.view(states_dones_shape), env.s0, states.tensor
+        )
+
+        step = 0
+        while step < max_length:
+            actions, actions_log_probs, estimator_outputs, new_states = (
+                self.rollout_step(
+                    env,
+                    states,
+                    dones,
+                    save_estimator_outputs=save_estimator_outputs,
+                    calculate_logprobs=not skip_logprob_calculaion,
+                    **policy_kwargs,
+                )
+            )
+            if estimator_outputs is not None:
+                if all_estimator_outputs is None:
+                    all_estimator_outputs = torch.full(
+                        (max_length, n_trajectories) + estimator_outputs.shape[1:],
+                        fill_value=-float("inf"),
+                        dtype=torch.float,
+                        device=device,
+                    )
+                all_estimator_outputs[step] = estimator_outputs
+            trajectories_actions[step] = actions
+            if actions_log_probs is not None:
+                trajectories_logprobs[step] = actions_log_probs
+
+            step += 1
+            new_dones = (
+                new_states.is_initial_state if is_backward else new_states.is_sink_state
+            ) & ~dones
+            trajectories_dones.masked_fill_(new_dones, step)
+            last_states_tensor = torch.where(
+                new_dones.view(states_dones_shape), states.tensor, last_states_tensor
+            )
+            dones = dones | new_dones
+            states = new_states
+            trajectories_states[step] = states
+
+            if step % done_check_interval == 0 and dones.all():
+                break
+
+        if not dones.all():
+            raise ValueError(
+                f"Some trajectories are not done after max_length={max_length} steps."
+            )
+
+        # Drops the steps after the last trajectory is done.
+        length = int(trajectories_dones.max()) if n_trajectories > 0 else 0
+        last_states = env.States(last_states_tensor)
+        try:
+            log_rewards = env.log_reward(last_states)
+        except NotImplementedError:
+            log_rewards = torch.log(env.reward(last_states))
+        trajectories_log_rewards = torch.where(
+            trajectories_dones > 0, log_rewards.to(torch.float), 0.0
+        )
+
+        if all_estimator_outputs is not None:
+            all_estimator_outputs = all_estimator_outputs[:length]
 
         trajectories = Trajectories(
             env=env,
-            states=trajectories_states,
-            actions=trajectories_actions,
+            states=trajectories_states[: length + 1],
+            actions=trajectories_actions[:length],
             when_is_done=trajectories_dones,
-            is_backward=self.estimator.is_backward,
+            is_backward=is_backward,
             log_rewards=trajectories_log_rewards,
-            log_probs=trajectories_logprobs,
+            log_probs=trajectories_logprobs[:length],
             estimator_outputs=all_estimator_outputs if save_estimator_outputs else None,
         )
 
         return trajectories
+
+
+def replace_done_states(
+    env: Env, states: States, dones: TT["batch_shape", torch.bool]
+) -> States:
+    """Returns a copy of `states` in which done states are replaced by $s_0$.
+
+    For discrete states, all actions are allowed in the replaced states, so that
+    distributions over the actions of the full batch are well defined.
+    """
+    tensor = torch.where(
+        dones.view(dones.shape + (1,) * len(env.state_shape)), env.s0, states.tensor
+    )
+    if isinstance(states, DiscreteStates):
+        return env.States(
+            tensor,
+            forward_masks=states.forward_masks | dones.unsqueeze(-1),
+            backward_masks=states.backward_masks | dones.unsqueeze(-1),
+        )
+    return env.States(tensor)
+
+
+def make_states_buffer(
+    env: Env, length: int, n_trajectories: int, is_backward: bool = False
+) -> States:
+    """Allocates a `(length, n_trajectories)` States buffer for a rollout.
+
+    The buffer is filled with the padding state of the rollout's direction, i.e. $s_f$
+    for forward trajectories, and $s_0$ for backward trajectories.
+    """
+    return env.States.from_batch_shape((length, n_trajectories), sink=not is_backward)
+
+
+def extend_states_buffer(
+    env: Env, buffer: States, length: int, is_backward: bool = False
+) -> States:
+    """Returns a copy of `buffer` extended along the first dimension to `length`."""
+    assert len(buffer.batch_shape) == 2 and length >= buffer.batch_shape[0]
+    new_buffer = make_states_buffer(env, length, buffer.batch_shape[1], is_backward)
+    new_buffer[: buffer.batch_shape[0]] = buffer
+    return new_buffer
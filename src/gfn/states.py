@@ -8,8 +8,10 @@ from typing import Callable, ClassVar, List, Optional, Sequence, cast
 import torch
 from torchtyping import TensorType as TT
 
+from gfn.utils.common import FlagsCacheMixin
 
-class States(ABC):
+
+class States(FlagsCacheMixin, ABC):
     """Base class for states, seen as nodes of the DAG.
 
     For each environment, a States subclass is needed. A `States` object
@@ -39,10 +41,17 @@ class States(ABC):
     (e.g. `[-1, ..., -1]`, or `[-inf, ..., -inf]`, etc...). Which is never processed,
     and is used to pad the batch of states only.
 
+    Indexing a batch of states with a boolean mask, an integer tensor or a list of
+    indices returns a copy of the indexed states, gathered with a single index for
+    all the tensors of the states. Other indices (integers, slices, ...) return true
+    views of the tensors.
+
     Attributes:
         tensor: Tensor representing a batch of states.
         batch_shape: Sizes of the batch dimensions.
         _log_rewards: Stores the log rewards of each state.
+        _flags_cache: Stores the lazily computed `is_initial_state` and
+            `is_sink_state` flags (see `FlagsCacheMixin`).
     """
 
     state_shape: ClassVar[tuple[int, ...]]  # Shape of one state
@@ -66,6 +75,32 @@ class States(ABC):
         self._log_rewards = (
             None  # Useful attribute if we want to store the log-reward of the states
         )
+        self._flags_cache = {}
+
+    def _get_batch_index(
+        self, index: int | Sequence[int] | Sequence[bool] | torch.Tensor
+    ) -> tuple[torch.Tensor, ...] | None:
+        """Converts an index into integer tensors indexing the leading batch dimensions.
+
+        The converted index is shared by all the tensors of the states, so that a
+        boolean mask is only converted (with a host synchronization) once. Returns
+        None for basic indices, which already return views of the tensors, and for
+        indices spanning several dimensions in other ways than a boolean mask.
+        """
+        if isinstance(index, list) and len(index) > 0:
+            if all(isinstance(i, bool) for i in index):
+                index = torch.tensor(index, dtype=torch.bool)
+            elif all(isinstance(i, int) for i in index):
+                index = torch.tensor(index, dtype=torch.long)
+        if not isinstance(index, torch.Tensor) or index.ndim == 0:
+            return None
+        if index.dtype == torch.bool:
+            if tuple(index.shape) != self.batch_shape[: index.ndim]:
+                return None
+            return index.nonzero(as_tuple=True)
+        if index.dtype in (torch.long, torch.int):
+            return (index,)
+        return None
 
     @classmethod
     def from_batch_shape(
@@ -126,14 +161,17 @@ class States(ABC):
     def device(self) -> torch.device:
         return self.tensor.device
 
-    def __getitem__(self, index: int | Sequence[int] | Sequence[bool]) -> States:
+    def __getitem__(
+        self, index: int | Sequence[int] | Sequence[bool] | torch.Tensor
+    ) -> States:
         """Access particular states of the batch."""
-        return self.__class__(
-            self.tensor[index]
-        )  # TODO: Inefficient - this might make a copy of the tensor!
+        batch_index = self._get_batch_index(index)
+        if batch_index is not None:
+            index = batch_index
+        return self.__class__(self.tensor[index])
 
     def __setitem__(
-        self, index: int | Sequence[int] | Sequence[bool], states: States
+        self, index: int | Sequence[int] | Sequence[bool] | torch.Tensor, states: States
     ) -> None:
         """Set particular states of the batch."""
         self.tensor[index] = states.tensor
@@ -236,19 +274,12 @@ class States(ABC):
     @property
     def is_initial_state(self) -> TT["batch_shape", torch.bool]:
         """Return a tensor that is True for states that are $s_0$ of the DAG."""
-        source_states_tensor = self.__class__.s0.repeat(
-            *self.batch_shape, *((1,) * len(self.__class__.state_shape))
-        )
-        return self.compare(source_states_tensor)
+        return self._cached_compare("is_initial_state", self.__class__.s0)
 
     @property
     def is_sink_state(self) -> TT["batch_shape", torch.bool]:
         """Return a tensor that is True for states that are $s_f$ of the DAG."""
-        # TODO: self.__class__.sf == self.tensor -- or something similar?
-        sink_states = self.__class__.sf.repeat(
-            *self.batch_shape, *((1,) * len(self.__class__.state_shape))
-        ).to(self.tensor.device)
-        return self.compare(sink_states)
+        return self._cached_compare("is_sink_state", self.__class__.sf)
 
     @property
     def log_rewards(self) -> TT["batch_shape", torch.float]:
@@ -312,21 +343,26 @@ class DiscreteStates(States, ABC):
         self.set_default_typing()
 
     def clone(self) -> States:
-        """Returns a clone of the current instance."""
+        """Returns a clone of the current instance.
+
+        The masks are cloned as well, so that they can be updated in place.
+        """
         return self.__class__(
             self.tensor.detach().clone(),
-            self.forward_masks,
-            self.backward_masks,
+            self.forward_masks.clone(),
+            self.backward_masks.clone(),
         )
 
     def set_default_typing(self) -> None:
         """A convienience function for default typing of the masks."""
+        # The types are given as strings, which are not evaluated at runtime: building
+        # them would cost more than the rest of the constructor.
         self.forward_masks = cast(
-            TT["batch_shape", "n_actions", torch.bool],
+            'TT["batch_shape", "n_actions", torch.bool]',
             self.forward_masks,
         )
         self.backward_masks = cast(
-            TT["batch_shape", "n_actions - 1", torch.bool],
+            'TT["batch_shape", "n_actions - 1", torch.bool]',
             self.backward_masks,
         )
 
@@ -334,8 +370,11 @@ class DiscreteStates(States, ABC):
         assert self.forward_masks is not None and self.backward_masks is not None
 
     def __getitem__(
-        self, index: int | Sequence[int] | Sequence[bool]
+        self, index: int | Sequence[int] | Sequence[bool] | torch.Tensor
     ) -> DiscreteStates:
+        batch_index = self._get_batch_index(index)
+        if batch_index is not None:
+            index = batch_index
         states = self.tensor[index]
         self._check_both_forward_backward_masks_exist()
         forward_masks = self.forward_masks[index]
@@ -343,7 +382,9 @@ class DiscreteStates(States, ABC):
         return self.__class__(states, forward_masks, backward_masks)
 
     def __setitem__(
-        self, index: int | Sequence[int] | Sequence[bool], states: DiscreteStates
+        self,
+        index: int | Sequence[int] | Sequence[bool] | torch.Tensor,
+        states: DiscreteStates,
     ) -> None:
         super().__setitem__(index, states)
         self._check_both_forward_backward_masks_exist()
@@ -395,7 +436,9 @@ class DiscreteStates(States, ABC):
         self.forward_masks = _extend(self.forward_masks, required_first_dim)
         self.backward_masks = _extend(self.backward_masks, required_first_dim)
 
-    # The helper methods are convenience functions for common mask operations.
+    # The helper methods are convenience functions for common mask operations. They
+    # write in place into the existing masks, on the device of the states, without
+    # host synchronizations.
     def set_nonexit_action_masks(self, cond, allow_exit: bool):
         """Masks denoting disallowed actions according to cond, appending the exit mask.
 
@@ -409,13 +452,8 @@ class DiscreteStates(States, ABC):
             allow_exit: sets whether exiting can happen at any point in the
                 trajectory - if so, it should be set to True.
         """
-        # Resets masks in place to prevent side-effects across steps.
-        self.forward_masks[:] = True
-        if allow_exit:
-            exit_idx = torch.zeros(self.batch_shape + (1,)).to(cond.device)
-        else:
-            exit_idx = torch.ones(self.batch_shape + (1,)).to(cond.device)
-        self.forward_masks[torch.cat([cond, exit_idx], dim=-1).bool()] = False
+        torch.logical_not(cond, out=self.forward_masks[..., :-1])
+        self.forward_masks[..., -1] = allow_exit
 
     def set_exit_masks(self, batch_idx):
         """Sets forward masks such that the only allowable next action is to exit.
@@ -426,13 +464,19 @@ class DiscreteStates(States, ABC):
             batch_idx: A Boolean index along the batch dimension, along which to
                 enforce exits.
         """
-        self.forward_masks[batch_idx, :] = torch.cat(
-            [
-                torch.zeros((torch.sum(batch_idx),) + self.s0.shape),
-                torch.ones((torch.sum(batch_idx),) + (1,)),
-            ],
-            dim=-1,
-        ).bool()
+        self.forward_masks[..., :-1].masked_fill_(batch_idx.unsqueeze(-1), False)
+        self.forward_masks[..., -1].masked_fill_(batch_idx, True)
+
+    def set_backward_masks(self, cond):
+        """Sets backward masks such that the allowed backward actions are given by cond.
+
+        A convenience function for common mask operations.
+
+        Args:
+            cond: a boolean of shape (batch_shape,) + (n_actions - 1,), which denotes
+                which backward actions are allowed.
+        """
+        self.backward_masks.copy_(cond)
 
     def init_forward_masks(self, set_ones: bool = True):
         """Initalizes forward masks.
@@ -444,10 +488,12 @@ class DiscreteStates(States, ABC):
                 they are initalized to all zeros.
         """
         shape = self.batch_shape + (self.n_actions,)
-        if set_ones:
-            self.forward_masks = torch.ones(shape).bool()
+        if tuple(self.forward_masks.shape) == shape:
+            self.forward_masks.fill_(set_ones)
         else:
-            self.forward_masks = torch.zeros(shape).bool()
+            self.forward_masks = torch.full(
+                shape, set_ones, dtype=torch.bool, device=self.tensor.device
+            )
 
 
 def stack_states(states: List[States]):
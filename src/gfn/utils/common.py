@@ -1,4 +1,6 @@
 import random
+import weakref
+from abc import ABC, abstractmethod
 
 import numpy as np
 import torch
@@ -15,3 +17,59 @@ def set_seed(seed: int, performance_mode: bool = False) -> None:
     if not performance_mode:
         torch.backends.cudnn.deterministic = True
         torch.backends.cudnn.benchmark = False
+
+
+class FlagsCacheMixin(ABC):
+    """Caches flags obtained by comparing all the elements of `self.tensor` to one.
+
+    This is used by `States` and `Actions`, e.g. for `is_sink_state` or `is_dummy`. The
+    cached flags are invalidated when `self.tensor` is replaced, or modified in place,
+    which is tracked by the version counter of the tensor. The cached flags are shared
+    by all the callers, and are also invalidated when modified in place. The cache
+    holds weak references, and is dropped when copying or pickling.
+
+    Attributes:
+        _flags_cache: Maps the names of the flags to the flags and their version, along
+            with a reference to the tensor they were computed from, and its version.
+    """
+
+    tensor: torch.Tensor
+
+    @abstractmethod
+    def compare(self, other: torch.Tensor) -> torch.Tensor:
+        """Compares all the elements of `self.tensor` to `other`."""
+
+    def __getstate__(self) -> dict:
+        """Drops the flags cache, which holds weak references, when copying/pickling."""
+        state = vars(self).copy()
+        state.pop("_flags_cache", None)
+        return state
+
+    def _cached_compare(self, key: str, element: torch.Tensor) -> torch.Tensor:
+        """Compares all elements of the batch to a single one, caching the result.
+
+        The single element is broadcast against `self.tensor` instead of being
+        repeated. The returned tensor is shared with the cache and the other callers,
+        and should not be modified in place: doing so recomputes the flags at the next
+        call, but the other callers still see the modification.
+
+        Args:
+            key: Name of the cache entry.
+            element: Tensor of the shape of one element of the batch to compare to.
+        """
+        tensor = self.tensor
+        cache = vars(self).setdefault("_flags_cache", {})
+        cacheable = not tensor.is_inference()  # No version counter in inference mode.
+        if cacheable and key in cache:
+            tensor_ref, version, flags, flags_version = cache[key]
+            if (
+                tensor_ref() is tensor
+                and version == tensor._version
+                and flags_version == flags._version
+            ):
+                return flags
+
+        flags = self.compare(element.to(tensor.device))
+        if cacheable:
+            cache[key] = (weakref.ref(tensor), tensor._version, flags, flags._version)
+        return flags
@@ -0,0 +1,93 @@
+"""Helpers for data-parallel training with `torch.distributed`.
+
+The losses of GFlowNets in distributed mode (see `GFlowNet.distribute`) are scaled so
+that the average of the per-rank losses, which is what `DistributedDataParallel`, or
+`average_gradients`, differentiates, is the loss of the global batch. All helpers
+fall back to their single-process behaviour when `torch.distributed` is not
+initialized.
+"""
+
+from typing import Optional
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+ProcessGroup = Optional["dist.ProcessGroup"]
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_world_size(group: ProcessGroup = None) -> int:
+    return dist.get_world_size(group) if is_distributed() else 1
+
+
+def get_rank(group: ProcessGroup = None) -> int:
+    return dist.get_rank(group) if is_distributed() else 0
+
+
+def all_reduce(
+    tensor: torch.Tensor, op: str = "sum", group: ProcessGroup = None
+) -> torch.Tensor:
+    """Returns the reduction of `tensor` over all ranks, without gradients.
+
+    Args:
+        tensor: the tensor to reduce, of the same shape on all ranks.
+        op: "sum" or "max".
+        group: the process group.
+    """
+    tensor = tensor.detach().clone()
+    if is_distributed():
+        reduce_op = {"sum": dist.ReduceOp.SUM, "max": dist.ReduceOp.MAX}[op]
+        dist.all_reduce(tensor, op=reduce_op, group=group)
+    return tensor
+
+
+def get_shard_size(n: int, group: ProcessGroup = None) -> int:
+    """Returns the number of the `n` elements of a global batch held by this rank."""
+    world_size, rank = get_world_size(group), get_rank(group)
+    return n // world_size + (rank < n % world_size)
+
+
+def mean(values: torch.Tensor, group: ProcessGroup = None) -> torch.Tensor:
+    """The mean of the values of all ranks, scaled for gradient averaging.
+
+    The returned value is the sum of the local values, divided by the global number
+    of values and multiplied by the world size, so that averaging it (or its
+    gradients) over ranks yields the global mean, even for shards of unequal sizes.
+    """
+    if not is_distributed():
+        return values.mean()
+    n_values = all_reduce(
+        torch.tensor(values.numel(), device=values.device), group=group
+    )
+    return values.sum() * get_world_size(group) / n_values
+
+
+def broadcast_parameters(
+    module: nn.Module, src: int = 0, group: ProcessGroup = None
+) -> None:
+    """Copies the parameters and buffers of `module` on rank `src` to all ranks."""
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            dist.broadcast(tensor.data, src=src, group=group)
+
+
+def average_gradients(module: nn.Module, group: ProcessGroup = None) -> None:
+    """Averages the gradients of the parameters of `module` over all ranks.
+
+    This is what `DistributedDataParallel` does during the backward pass, for
+    training loops that do not wrap the GFlowNet in it.
+    """
+    if not is_distributed():
+        return
+    world_size = get_world_size(group)
+    for parameter in module.parameters():
+        if parameter.grad is None:
+            parameter.grad = torch.zeros_like(parameter)
+        dist.all_reduce(parameter.grad, group=group)
+        parameter.grad /= world_size
@@ -135,3 +135,26 @@ class DiscreteUniform(nn.Module):
             preprocessed_states.device
         )
         return out
+
+
+class HeadModule(nn.Module):
+    """A head on top of a trunk, which may be shared with other heads.
+
+    Estimators whose modules are `HeadModule`s with the same trunk can be evaluated
+    together, with a single pass through the trunk (see
+    `gfn.modules.evaluate_estimators`).
+
+    Attributes:
+        trunk: the shared module, e.g. the torso of a `NeuralNet`.
+        head: the module applied to the outputs of the trunk.
+    """
+
+    def __init__(self, trunk: nn.Module, head: nn.Module) -> None:
+        super().__init__()
+        self.trunk = trunk
+        self.head = head
+
+    def forward(
+        self, preprocessed_states: TT["batch_shape", "input_dim", float]
+    ) -> TT["batch_shape", "output_dim", float]:
+        return self.head(self.trunk(preprocessed_states))
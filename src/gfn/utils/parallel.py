@@ -0,0 +1,354 @@
+"""Parallel training, with rollout workers running in separate processes.
+
+The workers are forked from the learner process, so that the environment and the
+estimator need not be picklable. They sample trajectories with their own copy of the
+estimator, whose weights are periodically synchronized with the learner's through
+shared memory, and send them to the learner through a queue. The tensors of the
+trajectories are moved to shared memory rather than pickled.
+"""
+
+import queue
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+import torch.multiprocessing as mp
+
+from gfn.containers import ReplayBuffer, Trajectories
+from gfn.env import Env
+from gfn.gflownet import GFlowNet, PFBasedGFlowNet, TrajectoryBasedGFlowNet
+from gfn.modules import GFNModule
+from gfn.samplers import Sampler
+
+# How often, in seconds, blocked workers and learners check whether they should stop.
+POLL_INTERVAL = 0.1
+
+
+def _rollout_worker(
+    rank: int,
+    env: Env,
+    estimator: GFNModule,
+    shared_state: Dict[str, torch.Tensor],
+    version: Any,
+    lock: Any,
+    trajectories_queue: Any,
+    stop_event: Any,
+    n_trajectories: int,
+    n_threads: int,
+    seed: Optional[int],
+    sampler_kwargs: Dict[str, Any],
+) -> None:
+    """Samples trajectories with the latest published weights, until stopped."""
+    torch.set_num_threads(n_threads)
+    if seed is not None:
+        torch.manual_seed(seed + rank)
+    sampler = Sampler(estimator=estimator)
+    local_version = -1
+    while not stop_event.is_set():
+        if version.value != local_version:
+            with lock:
+                estimator.load_state_dict(shared_state)
+                local_version = version.value
+
+        # The estimator outputs are recomputed by the learner, with gradients.
+        with torch.no_grad():
+            trajectories = sampler.sample_trajectories(
+                env, off_policy=True, n_trajectories=n_trajectories, **sampler_kwargs
+            )
+        trajectories.estimator_outputs = None
+        message = (local_version, trajectories.to_shared())
+
+        while not stop_event.is_set():
+            try:
+                trajectories_queue.put(message, timeout=POLL_INTERVAL)
+                break
+            except queue.Full:
+                continue
+
+
+class ParallelSampler:
+    """Samples trajectories in worker processes.
+
+    Each trajectories batch is tagged with the version of the weights it was sampled
+    with. The learner publishes new weights with `sync_weights`, and batches sampled
+    with weights more than `max_staleness` versions old are dropped by `get`.
+
+    Trajectories are sampled off policy (see `Sampler.sample_trajectories`), and
+    without their estimator outputs: neither the log probabilities nor the estimator
+    outputs computed by the workers carry gradients.
+
+    Attributes:
+        env: the environment of the learner, against which trajectories are rebuilt.
+        estimator: the estimator of the learner, whose weights are published.
+        version: the version of the latest published weights.
+        n_dropped: the number of batches dropped for being too stale.
+    """
+
+    def __init__(
+        self,
+        env: Env,
+        estimator: GFNModule,
+        n_workers: int,
+        n_trajectories: int,
+        max_staleness: Optional[int] = None,
+        queue_size: Optional[int] = None,
+        n_threads: int = 1,
+        seed: Optional[int] = None,
+        **sampler_kwargs,
+    ):
+        """Initializes the sampler. The workers are started by `start`.
+
+        Args:
+            env: the environment to sample trajectories from.
+            estimator: the estimator of the policy.
+            n_workers: the number of worker processes.
+            n_trajectories: the number of trajectories of each batch.
+            max_staleness: the maximum number of weight versions a batch can lag
+                behind the latest ones. If None, no batch is dropped.
+            queue_size: the maximum number of batches waiting in the queue, after
+                which workers block. Defaults to `2 * n_workers`.
+            n_threads: the number of torch threads of each worker.
+            seed: if given, worker `i` is seeded with `seed + i`.
+            sampler_kwargs: keyword arguments passed to `Sampler.sample_trajectories`,
+                e.g. the exploration parameters of the policy.
+        """
+        self.env = env
+        self.estimator = estimator
+        self.n_workers = n_workers
+        self.n_trajectories = n_trajectories
+        self.max_staleness = max_staleness
+        self.n_threads = n_threads
+        self.seed = seed
+        self.sampler_kwargs = sampler_kwargs
+        self.n_dropped = 0
+
+        # Fork, so that the environment and the estimator are inherited by workers.
+        self._context = mp.get_context("fork")
+        self._lock = self._context.Lock()
+        self._version = self._context.Value("l", 0)
+        self._queue = self._context.Queue(
+            maxsize=queue_size if queue_size is not None else 2 * n_workers
+        )
+        self._stop_event = self._context.Event()
+        self._shared_state = {
+            key: val.detach().clone().share_memory_()
+            for key, val in estimator.state_dict().items()
+        }
+        self._workers: List[Any] = []
+
+    @property
+    def version(self) -> int:
+        return self._version.value
+
+    def sync_weights(self) -> None:
+        """Publishes the current weights of the estimator to the workers."""
+        with self._lock:
+            for key, val in self.estimator.state_dict().items():
+                self._shared_state[key].copy_(val)
+            self._version.value += 1
+
+    def start(self) -> None:
+        """Starts the worker processes."""
+        if self._workers:
+            raise RuntimeError("The workers are already started.")
+        self._stop_event.clear()
+        for rank in range(self.n_workers):
+            worker = self._context.Process(
+                target=_rollout_worker,
+                args=(
+                    rank,
+                    self.env,
+                    self.estimator,
+                    self._shared_state,
+                    self._version,
+                    self._lock,
+                    self._queue,
+                    self._stop_event,
+                    self.n_trajectories,
+                    self.n_threads,
+                    self.seed,
+                    self.sampler_kwargs,
+                ),
+                daemon=True,
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self) -> None:
+        """Stops the worker processes, and discards the batches left in the queue."""
+        self._stop_event.set()
+        for worker in self._workers:
+            # Workers only exit once the batches they sent are read from the pipe.
+            while worker.is_alive():
+                self._drain()
+                worker.join(timeout=POLL_INTERVAL)
+        self._workers = []
+        # The tensors of the batches still in the queue were shared by the workers,
+        # and cannot be received anymore.
+        self._queue.close()
+        self._queue = self._context.Queue(maxsize=self._queue._maxsize)
+
+    def _drain(self) -> None:
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                return
+            except (OSError, EOFError):
+                # The batch was sent by a worker that has exited, or is exiting.
+                continue
+
+    def get(self, timeout: Optional[float] = None) -> Trajectories:
+        """Returns the next batch of trajectories that is not too stale.
+
+        Args:
+            timeout: the maximum time to wait for a batch, in seconds.
+
+        Raises:
+            TimeoutError: if no batch is received before the timeout.
+            RuntimeError: if the workers are not running.
+        """
+        waited = 0.0
+        while True:
+            if not self._workers or not all(w.is_alive() for w in self._workers):
+                raise RuntimeError("The rollout workers are not running.")
+            try:
+                version, shared = self._queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                waited += POLL_INTERVAL
+                if timeout is not None and waited >= timeout:
+                    raise TimeoutError("No trajectories received from the workers.")
+                continue
+            if (
+                self.max_staleness is not None
+                and self.version - version > self.max_staleness
+            ):
+                self.n_dropped += 1
+                continue
+            return Trajectories.from_shared(self.env, shared)
+
+    def __enter__(self) -> "ParallelSampler":
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+
+class ParallelTrainer:
+    """Trains a GFlowNet on trajectories sampled by worker processes.
+
+    The learner loop is the usual one (`to_training_samples`, an optional replay
+    buffer, `loss`, `backward`, and an optimizer step), but the trajectories are
+    sampled concurrently by a `ParallelSampler`, to which the weights of the policy
+    are published every `sync_interval` iterations.
+
+    As the trajectories do not carry gradients, GFlowNets using $P_F$ must be off
+    policy: the estimator outputs of trajectories are recomputed by the learner, and
+    transitions-based losses reevaluate $P_F$.
+    """
+
+    def __init__(
+        self,
+        env: Env,
+        gflownet: GFlowNet,
+        optimizer: torch.optim.Optimizer,
+        n_workers: int,
+        n_trajectories: int,
+        replay_buffer: Optional[ReplayBuffer] = None,
+        n_training_samples: Optional[int] = None,
+        sync_interval: int = 1,
+        max_staleness: Optional[int] = None,
+        n_threads: int = 1,
+        seed: Optional[int] = None,
+        **sampler_kwargs,
+    ):
+        """Initializes the trainer.
+
+        Args:
+            env: the environment to sample trajectories from.
+            gflownet: the GFlowNet to train.
+            optimizer: the optimizer of the GFlowNet's parameters.
+            n_workers: the number of worker processes.
+            n_trajectories: the number of trajectories sampled by a worker, and used
+                per training iteration.
+            replay_buffer: if given, the training samples are added to it, and the
+                loss is computed on `n_training_samples` objects sampled from it.
+            n_training_samples: the number of objects sampled from the replay buffer.
+                Defaults to `n_trajectories`.
+            sync_interval: the number of iterations between two weight publications.
+            max_staleness: see `ParallelSampler`.
+            n_threads: the number of torch threads of each worker.
+            seed: see `ParallelSampler`.
+            sampler_kwargs: keyword arguments passed to `Sampler.sample_trajectories`.
+
+        Raises:
+            ValueError: if the GFlowNet uses $P_F$ and is not off policy.
+        """
+        if isinstance(gflownet, PFBasedGFlowNet):
+            if not gflownet.off_policy:
+                raise ValueError(
+                    "Trajectories sampled by workers carry no gradients: the GFlowNet "
+                    "must be off policy."
+                )
+            estimator = gflownet.pf
+        else:
+            estimator = gflownet.logF
+        self.env = env
+        self.gflownet = gflownet
+        self.optimizer = optimizer
+        self.replay_buffer = replay_buffer
+        self.n_training_samples = (
+            n_training_samples if n_training_samples is not None else n_trajectories
+        )
+        self.sync_interval = sync_interval
+        self.sampler = ParallelSampler(
+            env,
+            estimator,
+            n_workers=n_workers,
+            n_trajectories=n_trajectories,
+            max_staleness=max_staleness,
+            n_threads=n_threads,
+            seed=seed,
+            **sampler_kwargs,
+        )
+
+    def train(
+        self,
+        n_iterations: int,
+        callback: Optional[Callable[[int, Trajectories, float], None]] = None,
+    ) -> List[float]:
+        """Runs the training loop.
+
+        Args:
+            n_iterations: the number of training iterations.
+            callback: if given, called after each iteration with the iteration, the
+                trajectories received from the workers, and the loss.
+
+        Returns:
+            The losses of the training iterations.
+        """
+        losses = []
+        with self.sampler:
+            for iteration in range(n_iterations):
+                trajectories = self.sampler.get()
+                training_samples = self.gflownet.to_training_samples(trajectories)
+                if self.replay_buffer is not None:
+                    with torch.no_grad():
+                        self.replay_buffer.add(training_samples)
+                    training_samples = self.replay_buffer.sample(
+                        self.n_training_samples
+                    )
+                if isinstance(self.gflownet, TrajectoryBasedGFlowNet):
+                    self.gflownet.recompute_estimator_outputs(training_samples)
+
+                self.optimizer.zero_grad()
+                loss = self.gflownet.loss(self.env, training_samples)
+                loss.backward()
+                self.optimizer.step()
+                losses.append(loss.item())
+
+                if (iteration + 1) % self.sync_interval == 0:
+                    self.sampler.sync_weights()
+                if callback is not None:
+                    callback(iteration, trajectories, losses[-1])
+        return losses
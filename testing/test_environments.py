@@ -4,6 +4,7 @@ import torch
 
 from gfn.env import NonValidActionsError
 from gfn.gym import Box, DiscreteEBM, HyperGrid
+from gfn.states import DiscreteStates
 
 
 # Utilities.
@@ -294,6 +295,216 @@ def test_states_getitem(ndim: int, env_name: str):
     )
 
 
+@pytest.mark.parametrize("env_name", ["HyperGrid", "DiscreteEBM", "Box"])
+def test_states_cached_flags(env_name: str):
+    if env_name == "HyperGrid":
+        env = HyperGrid(ndim=2, height=8)
+    elif env_name == "DiscreteEBM":
+        env = DiscreteEBM(ndim=2)
+    elif env_name == "Box":
+        env = Box(delta=0.1)
+    else:
+        raise ValueError(f"Unknown env_name {env_name}")
+
+    states = env.reset(batch_shape=(2, 3))
+    assert states.is_initial_state.all() and not states.is_sink_state.any()
+    # Repeated accesses hit the cache.
+    assert states.is_sink_state is states.is_sink_state
+
+    # In-place modifications of the tensor invalidate the cached flags.
+    states.tensor[0, 1] = env.sf
+    assert states.is_sink_state.sum() == 1 and states.is_sink_state[0, 1]
+    assert states.is_initial_state.sum() == 5
+
+    # As does replacing the tensor.
+    states.tensor = env.sf.repeat(2, 3, 1)
+    assert states.is_sink_state.all() and not states.is_initial_state.any()
+
+    # Copies do not carry the cache.
+    assert states.clone().is_sink_state.all()
+
+    # Flags modified in place by a caller are recomputed.
+    states.is_sink_state[0] = False
+    assert states.is_sink_state.all()
+
+
+@pytest.mark.parametrize("env_name", ["HyperGrid", "DiscreteEBM", "Box"])
+def test_states_advanced_indexing(env_name: str):
+    if env_name == "HyperGrid":
+        env = HyperGrid(ndim=2, height=8)
+    elif env_name == "DiscreteEBM":
+        env = DiscreteEBM(ndim=2)
+    elif env_name == "Box":
+        env = Box(delta=0.1)
+    else:
+        raise ValueError(f"Unknown env_name {env_name}")
+
+    states = env.reset(batch_shape=(4, 3), random=True)
+    mask = torch.tensor([True, False, True, True])
+    mask_2d = mask.unsqueeze(-1).repeat(1, 3)
+    index = torch.tensor([2, 0])
+    for get_item in (
+        lambda x: x[mask],
+        lambda x: x[mask][index],
+        lambda x: x[[3, 1]],
+        lambda x: x[mask_2d],
+    ):
+        item = get_item(states)
+        expected = get_item(states.tensor)
+        assert item.batch_shape == expected.shape[: -len(env.state_shape)]
+        assert torch.equal(item.tensor, expected)
+
+    if isinstance(states, DiscreteStates):
+        item = states[mask][index]
+        assert torch.equal(item.forward_masks, states.forward_masks[mask][index])
+        assert torch.equal(item.backward_masks, states.backward_masks[mask][index])
+
+    # Basic indices return true views.
+    assert states[1:3].tensor.data_ptr() == states.tensor[1:].data_ptr()
+
+    # Other indices return copies, which are not modified with the indexed states.
+    tensor = states.tensor
+    item, expected = states[mask], states.tensor[mask].clone()
+    tensor[0] = env.sf
+    assert torch.equal(item.tensor, expected)
+    if isinstance(states, DiscreteStates):
+        item = states[mask][index]
+        expected = states.forward_masks[mask][index].clone()
+        states.forward_masks[:] = False
+        assert torch.equal(item.forward_masks, expected)
+
+
+def test_discrete_states_mask_helpers():
+    env = HyperGrid(ndim=2, height=4)
+    states = env.reset(batch_shape=(3,))
+    forward_masks = states.forward_masks
+
+    cond = torch.tensor([[False, True], [False, False], [True, True]])
+    states.set_nonexit_action_masks(cond, allow_exit=False)
+    assert torch.equal(states.forward_masks[:, :-1], ~cond)
+    assert not states.forward_masks[:, -1].any()
+
+    states.set_exit_masks(torch.tensor([True, False, False]))
+    assert torch.equal(
+        states.forward_masks,
+        torch.tensor([[False, False, True], [True, True, False], [False] * 3]),
+    )
+
+    states.set_backward_masks(cond)
+    assert torch.equal(states.backward_masks, cond)
+
+    states.init_forward_masks(set_ones=False)
+    assert not states.forward_masks.any()
+    # The masks are updated in place.
+    assert states.forward_masks is forward_masks
+
+    # Clones do not share their masks.
+    clone = states.clone()
+    clone.init_forward_masks(set_ones=True)
+    assert not states.forward_masks.any()
+
+
+@pytest.mark.parametrize("env_name", ["HyperGrid", "DiscreteEBM"])
+def test_fused_step(env_name: str):
+    torch.manual_seed(0)
+    env = HyperGrid(ndim=3, height=4) if env_name == "HyperGrid" else DiscreteEBM(3)
+
+    # Rolls out random valid actions with both paths, until all states are sinks.
+    states = env.reset(batch_shape=(16,))
+    while not states.is_sink_state.all():
+        probs = states.forward_masks.float()
+        probs[states.is_sink_state] = 1.0
+        actions_tensor = torch.multinomial(probs, 1)
+        actions_tensor[states.is_sink_state] = -1
+        actions = env.Actions(actions_tensor)
+
+        env.use_fused_step = False
+        expected = env._step(states, actions)
+        env.use_fused_step = True
+        forward_masks = states.forward_masks.clone()
+        new_states = env._step(states, actions)
+        # The parent masks are copied, not updated in place.
+        assert torch.equal(states.forward_masks, forward_masks)
+
+        assert torch.equal(new_states.tensor, expected.tensor)
+        assert torch.equal(new_states.forward_masks, expected.forward_masks)
+        assert torch.equal(new_states.backward_masks, expected.backward_masks)
+        states = new_states
+
+    # Invalid actions are detected, unless validation is skipped.
+    states = env.reset(batch_shape=(2,))
+    states.forward_masks[:, 0] = False
+    actions = env.Actions(torch.zeros((2, 1), dtype=torch.long))
+    with pytest.raises(NonValidActionsError):
+        env._step(states, actions)
+    env.set_action_validation("never")
+    env._step(states, actions)
+
+
+@pytest.mark.parametrize("use_fused_step", [False, True])
+def test_action_validation_policy(use_fused_step: bool):
+    env = HyperGrid(ndim=2, height=4)
+    env.use_fused_step = use_fused_step
+
+    # The exit action is not valid for the first state: only the first one is masked.
+    states = env.reset(batch_shape=(4,))
+    states.forward_masks[0, -1] = False
+    actions = env.Actions.make_exit_actions((4,))
+    with pytest.raises(NonValidActionsError):
+        env._step(states, actions)
+
+    env.set_action_validation("never")
+    env._step(states, actions)
+
+    # Validation happens at the first of every 2 steps.
+    env.set_action_validation("sampled", every_n_steps=2)
+    with pytest.raises(NonValidActionsError):
+        env._step(states, actions)
+    env._step(states, actions)
+    with pytest.raises(NonValidActionsError):
+        env._step(states, actions)
+
+    # With a fraction of the batch, the invalid action is only sometimes detected.
+    env.set_action_validation("sampled", fraction=0.25)
+    n_errors = 0
+    for _ in range(40):
+        try:
+            env._step(states, actions)
+        except NonValidActionsError:
+            n_errors += 1
+    assert 0 < n_errors < 40
+
+    # Backward steps follow the same policy.
+    states = env.states_from_tensor(torch.tensor([[1, 0]]))
+    actions = env.Actions(torch.tensor([[1]]))
+    env.set_action_validation()
+    with pytest.raises(NonValidActionsError):
+        env._backward_step(states, actions)
+    env.set_action_validation("never")
+    env._backward_step(states, actions)
+
+    with pytest.raises(ValueError):
+        env.set_action_validation("sometimes")
+
+
+@pytest.mark.parametrize("env_name", ["HyperGrid", "Box"])
+def test_actions_cached_flags(env_name: str):
+    env = HyperGrid(ndim=2, height=8) if env_name == "HyperGrid" else Box(delta=0.1)
+
+    actions = env.actions_from_batch_shape((2, 3))
+    assert actions.is_dummy.all() and not actions.is_exit.any()
+    assert actions.is_dummy is actions.is_dummy
+
+    # Writing through __setitem__ invalidates the cached flags.
+    actions[0] = env.Actions.make_exit_actions((3,))
+    assert actions.is_exit.sum() == 3 and actions.is_dummy.sum() == 3
+
+    # As does extending the actions.
+    actions.extend(env.Actions.make_exit_actions((2, 1)))
+    assert actions.is_exit.shape == (2, 4)
+    assert actions.is_exit.sum() == 5 and actions.is_dummy.sum() == 3
+
+
 def test_get_grid():
     HEIGHT = 8
     NDIM = 2
@@ -1,15 +1,28 @@
-from gfn.containers import Trajectories
+import pytest
+import torch
+import torch.multiprocessing as mp
+
+from gfn.containers import ReplayBuffer, Trajectories
 from gfn.containers.base import Container
-from gfn.gflownet import FMGFlowNet, TBGFlowNet
-from gfn.gym import Box
+from gfn.gflownet import (
+    DBGFlowNet,
+    FMGFlowNet,
+    LogPartitionVarianceGFlowNet,
+    SubTBGFlowNet,
+    TBGFlowNet,
+)
+from gfn.gym import Box, HyperGrid
 from gfn.gym.helpers.box_utils import (
     BoxPBEstimator,
     BoxPBNeuralNet,
     BoxPFEstimator,
     BoxPFNeuralNet,
 )
-from gfn.modules import DiscretePolicyEstimator
+from gfn.modules import DiscretePolicyEstimator, ScalarEstimator
 from gfn.states import States
+from gfn.utils import NeuralNet
+from gfn.utils import distributed as dist_utils
+from gfn.utils.parallel import ParallelTrainer
 
 
 def test_trajectory_based_gflownet_generic():
@@ -95,3 +108,188 @@ def test_pytorch_inheritance():
     assert hasattr(
         fmgflownet.state_dict(), "__dict__"
     ), "Expected gflownet to have indexable state_dict() method inherited from nn.Module"
+
+
+@pytest.mark.parametrize("gflownet_name", ["TB", "DB", "FM"])
+@pytest.mark.parametrize("use_replay_buffer", [False, True])
+def test_parallel_trainer(gflownet_name: str, use_replay_buffer: bool):
+    if gflownet_name == "FM" and use_replay_buffer:
+        pytest.skip("ReplayBuffer does not keep the log rewards of terminating states.")
+    env = HyperGrid(ndim=2, height=4)
+    input_dim = env.preprocessor.output_dim
+    pf_estimator = DiscretePolicyEstimator(
+        NeuralNet(input_dim=input_dim, output_dim=env.n_actions),
+        env.n_actions,
+        preprocessor=env.preprocessor,
+    )
+    pb_estimator = DiscretePolicyEstimator(
+        NeuralNet(input_dim=input_dim, output_dim=env.n_actions - 1),
+        env.n_actions,
+        is_backward=True,
+        preprocessor=env.preprocessor,
+    )
+    if gflownet_name == "TB":
+        gflownet = TBGFlowNet(pf=pf_estimator, pb=pb_estimator, off_policy=True)
+        objects_type = "trajectories"
+    elif gflownet_name == "DB":
+        logF = ScalarEstimator(
+            NeuralNet(input_dim=input_dim, output_dim=1),
+            preprocessor=env.preprocessor,
+        )
+        gflownet = DBGFlowNet(pf_estimator, pb_estimator, logF, off_policy=True)
+        objects_type = "transitions"
+    else:
+        gflownet = FMGFlowNet(pf_estimator)
+        objects_type = "states"
+    replay_buffer = (
+        ReplayBuffer(env, objects_type=objects_type, capacity=32)
+        if use_replay_buffer
+        else None
+    )
+
+    # The learner's updates reach the workers, which keep sampling valid trajectories.
+    optimizer = torch.optim.Adam(gflownet.parameters(), lr=1e-2)
+    received = []
+    trainer = ParallelTrainer(
+        env,
+        gflownet,
+        optimizer,
+        n_workers=2,
+        n_trajectories=8,
+        replay_buffer=replay_buffer,
+        max_staleness=1,
+        seed=0,
+        epsilon=0.1,
+    )
+    losses = trainer.train(
+        6, callback=lambda iteration, trajectories, loss: received.append(trajectories)
+    )
+    assert len(losses) == 6 and all(torch.isfinite(torch.tensor(losses)))
+    assert trainer.sampler.version == 6
+    for trajectories in received:
+        assert trajectories.env is env and trajectories.n_trajectories == 8
+        assert trajectories.states[-1].is_sink_state.all()
+        assert torch.equal(
+            trajectories.log_rewards, env.log_reward(trajectories.last_states)
+        )
+
+    if gflownet_name == "TB":
+        with pytest.raises(ValueError):
+            gflownet.off_policy = False
+            ParallelTrainer(env, gflownet, optimizer, n_workers=2, n_trajectories=8)
+
+
+def _distributed_loss_worker(rank, init_method, env, gflownet, samples, results):
+    torch.distributed.init_process_group(
+        "gloo", init_method=init_method, rank=rank, world_size=2
+    )
+    try:
+        if rank == 1:
+            with torch.no_grad():
+                for parameter in gflownet.parameters():
+                    parameter.add_(1.0)
+        gflownet.distribute()
+        parameters = torch.cat([p.detach().flatten() for p in gflownet.parameters()])
+
+        # Rank 0 holds the first shard, and rank 1 the last one.
+        shard_size = gflownet.get_shard_size(len(samples))
+        start = 0 if rank == 0 else len(samples) - shard_size
+        samples = samples[torch.arange(start, start + shard_size)]
+        if isinstance(samples, Trajectories):
+            gflownet.recompute_estimator_outputs(samples)
+
+        loss = gflownet.loss(env, samples)
+        loss.backward()
+        dist_utils.average_gradients(gflownet)
+        loss = dist_utils.all_reduce(loss) / 2
+        gradients = torch.cat([p.grad.flatten() for p in gflownet.parameters()])
+        results.put(
+            (rank, shard_size, parameters.tolist(), loss.item(), gradients.tolist())
+        )
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+@pytest.mark.parametrize(
+    "gflownet_name",
+    ["TB", "LogPartitionVariance", "SubTB_equal", "SubTB_geometric", "DB"],
+)
+def test_distributed_loss(gflownet_name: str, tmp_path):
+    torch.manual_seed(0)
+    env = HyperGrid(ndim=2, height=4)
+    input_dim = env.preprocessor.output_dim
+    pf_estimator = DiscretePolicyEstimator(
+        NeuralNet(input_dim=input_dim, output_dim=env.n_actions),
+        env.n_actions,
+        preprocessor=env.preprocessor,
+    )
+    pb_estimator = DiscretePolicyEstimator(
+        NeuralNet(input_dim=input_dim, output_dim=env.n_actions - 1),
+        env.n_actions,
+        is_backward=True,
+        preprocessor=env.preprocessor,
+    )
+    logF = ScalarEstimator(
+        NeuralNet(input_dim=input_dim, output_dim=1), preprocessor=env.preprocessor
+    )
+    if gflownet_name == "TB":
+        gflownet = TBGFlowNet(
+            pf_estimator, pb_estimator, off_policy=True, init_logZ=1.0
+        )
+    elif gflownet_name == "LogPartitionVariance":
+        gflownet = LogPartitionVarianceGFlowNet(
+            pf_estimator, pb_estimator, off_policy=True
+        )
+    elif gflownet_name.startswith("SubTB"):
+        gflownet = SubTBGFlowNet(
+            pf_estimator,
+            pb_estimator,
+            logF,
+            off_policy=True,
+            weighting=gflownet_name.split("_")[1],
+        )
+    else:
+        gflownet = DBGFlowNet(pf_estimator, pb_estimator, logF, off_policy=True)
+
+    # An odd number of trajectories, of different lengths, split in unequal shards.
+    with torch.no_grad():
+        trajectories = gflownet.sample_trajectories(
+            env, n_samples=7, sample_off_policy=True
+        )
+    samples = gflownet.to_training_samples(trajectories)
+    if isinstance(samples, Trajectories):
+        gflownet.recompute_estimator_outputs(samples)
+    loss = gflownet.loss(env, samples)
+    loss.backward()
+    parameters = torch.cat([p.detach().flatten() for p in gflownet.parameters()])
+    gradients = torch.cat([p.grad.flatten() for p in gflownet.parameters()])
+    gflownet.zero_grad(set_to_none=True)
+    if isinstance(samples, Trajectories):
+        samples.estimator_outputs = samples.estimator_outputs.detach()
+
+    context = mp.get_context("fork")
+    results = context.Queue()
+    init_method = f"file://{tmp_path / 'store'}"
+    workers = [
+        context.Process(
+            target=_distributed_loss_worker,
+            args=(rank, init_method, env, gflownet, samples, results),
+        )
+        for rank in range(2)
+    ]
+    for worker in workers:
+        worker.start()
+    worker_results = [results.get(timeout=60) for _ in workers]
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+
+    n_samples = len(samples)
+    assert sorted(result[1] for result in worker_results) == [
+        n_samples // 2,
+        n_samples - n_samples // 2,
+    ]
+    for _, _, worker_parameters, worker_loss, worker_gradients in worker_results:
+        assert torch.equal(torch.tensor(worker_parameters), parameters)
+        assert torch.allclose(torch.tensor(worker_loss), loss, atol=1e-5)
+        assert torch.allclose(torch.tensor(worker_gradients), gradients, atol=1e-5)
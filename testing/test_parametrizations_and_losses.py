@@ -18,7 +18,7 @@ from gfn.gym.helpers.box_utils import (
     BoxPFEstimator,
     BoxPFNeuralNet,
 )
-from gfn.modules import DiscretePolicyEstimator, ScalarEstimator
+from gfn.modules import DiscretePolicyEstimator, MultiHeadEstimator, ScalarEstimator
 from gfn.utils.modules import DiscreteUniform, NeuralNet, Tabular
 
 
@@ -62,6 +62,253 @@ def test_FM(env_name: int, ndim: int, module_name: str):
     loss = gflownet.loss(env, states_tuple)
     assert loss >= 0
 
+    # The batched loss matches the edge flows evaluated action by action.
+    states = states_tuple[0]
+    incoming_log_flows = torch.full_like(
+        states.backward_masks, -float("inf"), dtype=torch.float
+    )
+    outgoing_log_flows = log_F_edge(states).masked_fill(
+        ~states.forward_masks, -float("inf")
+    )
+    for action_idx in range(env.n_actions - 1):
+        is_valid = states.backward_masks[:, action_idx]
+        actions = torch.full((int(is_valid.sum()), 1), action_idx)
+        parents = env._backward_step(states[is_valid], env.actions_from_tensor(actions))
+        incoming_log_flows[is_valid, action_idx] = log_F_edge(parents)[:, action_idx]
+    expected_loss = (
+        (
+            torch.logsumexp(incoming_log_flows, dim=-1)
+            - torch.logsumexp(outgoing_log_flows, dim=-1)
+        )
+        .pow(2)
+        .mean()
+    )
+    assert torch.allclose(gflownet.flow_matching_loss(env, states), expected_loss)
+
+
+@pytest.mark.parametrize("gflownet_name", ["DB", "ModifiedDB"])
+def test_DB_reuses_estimator_outputs(gflownet_name: str):
+    env = HyperGrid(ndim=2, height=4)
+    pf = DiscretePolicyEstimator(
+        NeuralNet(input_dim=env.preprocessor.output_dim, output_dim=env.n_actions),
+        env.n_actions,
+        preprocessor=env.preprocessor,
+    )
+    pb = DiscretePolicyEstimator(
+        NeuralNet(input_dim=env.preprocessor.output_dim, output_dim=env.n_actions - 1),
+        env.n_actions,
+        preprocessor=env.preprocessor,
+        is_backward=True,
+    )
+    if gflownet_name == "DB":
+        logF = ScalarEstimator(
+            NeuralNet(input_dim=env.preprocessor.output_dim, output_dim=1),
+            preprocessor=env.preprocessor,
+        )
+        gflownet = DBGFlowNet(pf=pf, pb=pb, logF=logF, off_policy=True)
+    else:
+        gflownet = ModifiedDBGFlowNet(pf=pf, pb=pb, off_policy=True)
+
+    trajectories = gflownet.sample_trajectories(
+        env, sample_off_policy=True, n_samples=10
+    )
+    transitions = gflownet.to_training_samples(trajectories)
+    n_pf_calls = []
+    pf.module.register_forward_hook(lambda *args: n_pf_calls.append(1))
+
+    loss = gflownet.loss(env, transitions)
+    n_calls_with_outputs = len(n_pf_calls)
+    transitions.estimator_outputs = None
+    expected_loss = gflownet.loss(env, transitions)
+    assert len(n_pf_calls) == 2 * n_calls_with_outputs + 1
+    assert torch.allclose(loss, expected_loss)
+
+    # Outputs detached from the graph are recomputed, so that PF is trained.
+    transitions = gflownet.to_training_samples(trajectories)
+    transitions.estimator_outputs = transitions.estimator_outputs.detach()
+    gflownet.loss(env, transitions).backward()
+    assert all(p.grad is not None for p in pf.parameters())
+
+
+@pytest.mark.parametrize("gflownet_name", ["DB", "ForwardLookingDB", "ModifiedDB"])
+@pytest.mark.parametrize("off_policy", [False, True])
+def test_DB_trajectory_layout(gflownet_name: str, off_policy: bool):
+    env = HyperGrid(ndim=2, height=4)
+    pf = DiscretePolicyEstimator(
+        NeuralNet(input_dim=env.preprocessor.output_dim, output_dim=env.n_actions),
+        env.n_actions,
+        preprocessor=env.preprocessor,
+    )
+    pb = DiscretePolicyEstimator(
+        NeuralNet(input_dim=env.preprocessor.output_dim, output_dim=env.n_actions - 1),
+        env.n_actions,
+        preprocessor=env.preprocessor,
+        is_backward=True,
+    )
+    logF = ScalarEstimator(
+        NeuralNet(input_dim=env.preprocessor.output_dim, output_dim=1),
+        preprocessor=env.preprocessor,
+    )
+    if gflownet_name == "ModifiedDB":
+        gflownet = ModifiedDBGFlowNet(
+            pf=pf, pb=pb, off_policy=off_policy, trajectory_layout=True
+        )
+    else:
+        gflownet = DBGFlowNet(
+            pf=pf,
+            pb=pb,
+            logF=logF,
+            off_policy=off_policy,
+            forward_looking=gflownet_name == "ForwardLookingDB",
+            trajectory_layout=True,
+        )
+
+    trajectories = gflownet.sample_trajectories(
+        env, sample_off_policy=off_policy, n_samples=10
+    )
+    assert gflownet.to_training_samples(trajectories) is trajectories
+    n_states = int((~trajectories.states.is_sink_state).sum())
+    n_logF_evaluations = []
+    logF.module.register_forward_hook(
+        lambda module, inputs, output: n_logF_evaluations.append(len(output))
+    )
+
+    # The scores match those computed from the transitions, in the same order.
+    transitions = trajectories.to_transitions()
+    if gflownet_name == "ModifiedDB":
+        scores = gflownet.get_trajectories_scores(trajectories)
+        expected_scores = gflownet.get_scores(transitions)
+    else:
+        outputs = gflownet.get_trajectories_scores(env, trajectories)
+        assert sum(n_logF_evaluations) == n_states
+        expected_outputs = gflownet.get_scores(env, transitions)
+        # The interior states are evaluated twice from the transitions.
+        assert sum(n_logF_evaluations) == n_states + 2 * n_states - len(trajectories)
+        for output, expected_output in zip(outputs[:2], expected_outputs[:2]):
+            assert torch.allclose(output, expected_output)
+        scores, expected_scores = outputs[2], expected_outputs[2]
+    assert torch.allclose(scores, expected_scores, atol=1e-6)
+    assert torch.allclose(
+        gflownet.loss(env, trajectories), gflownet.loss(env, transitions)
+    )
+
+
+@pytest.mark.parametrize(
+    "gflownet_name", ["DB", "DB_trajectory_layout", "ModifiedDB", "SubTB"]
+)
+def test_multi_head_estimator(gflownet_name: str):
+    env = HyperGrid(ndim=2, height=4)
+    trunk = NeuralNet(
+        input_dim=env.preprocessor.output_dim, output_dim=1, hidden_dim=16
+    ).torso
+    estimator = MultiHeadEstimator(trunk, env.n_actions, preprocessor=env.preprocessor)
+    outputs = estimator(env.reset(batch_shape=3))
+    assert outputs["pf"].shape == (3, env.n_actions)
+    assert outputs["pb"].shape == (3, env.n_actions - 1)
+    assert outputs["logF"].shape == (3, 1)
+
+    # The same heads, evaluated separately.
+    pf, pb, logF = (
+        DiscretePolicyEstimator(
+            torch.nn.Sequential(trunk, estimator.heads["pf"]),
+            env.n_actions,
+            preprocessor=env.preprocessor,
+        ),
+        DiscretePolicyEstimator(
+            torch.nn.Sequential(trunk, estimator.heads["pb"]),
+            env.n_actions,
+            preprocessor=env.preprocessor,
+            is_backward=True,
+        ),
+        ScalarEstimator(
+            torch.nn.Sequential(trunk, estimator.heads["logF"]),
+            preprocessor=env.preprocessor,
+        ),
+    )
+
+    def make_gflownet(pf, pb, logF):
+        if gflownet_name == "ModifiedDB":
+            return ModifiedDBGFlowNet(pf=pf, pb=pb, off_policy=True)
+        if gflownet_name == "SubTB":
+            return SubTBGFlowNet(pf=pf, pb=pb, logF=logF, off_policy=True)
+        return DBGFlowNet(
+            pf=pf,
+            pb=pb,
+            logF=logF,
+            off_policy=True,
+            trajectory_layout=gflownet_name == "DB_trajectory_layout",
+        )
+
+    gflownet = make_gflownet(estimator.pf, estimator.pb, estimator.logF)
+    expected_gflownet = make_gflownet(pf, pb, logF)
+    trajectories = gflownet.sample_trajectories(
+        env, sample_off_policy=True, n_samples=10
+    )
+    training_samples = gflownet.to_training_samples(trajectories)
+    n_trunk_calls = []
+    trunk.register_forward_hook(lambda *args: n_trunk_calls.append(1))
+
+    loss = gflownet.loss(env, training_samples)
+    n_shared_calls = len(n_trunk_calls)
+    expected_loss = expected_gflownet.loss(env, training_samples)
+    assert n_shared_calls < len(n_trunk_calls) - n_shared_calls
+    assert torch.allclose(loss, expected_loss)
+
+
+@pytest.mark.parametrize(
+    "gflownet_name", ["TB", "DB", "DB_trajectory_layout", "ModifiedDB", "SubTB"]
+)
+def test_uniform_pb(gflownet_name: str):
+    env = HyperGrid(ndim=2, height=4)
+    pf = DiscretePolicyEstimator(
+        NeuralNet(input_dim=env.preprocessor.output_dim, output_dim=env.n_actions),
+        env.n_actions,
+        preprocessor=env.preprocessor,
+    )
+    logF = ScalarEstimator(
+        NeuralNet(input_dim=env.preprocessor.output_dim, output_dim=1),
+        preprocessor=env.preprocessor,
+    )
+    pb_module = DiscreteUniform(env.n_actions - 1)
+    pb = DiscretePolicyEstimator(
+        pb_module, env.n_actions, preprocessor=env.preprocessor, is_backward=True
+    )
+    # The same policy, evaluated through its distribution.
+    expected_pb = DiscretePolicyEstimator(
+        torch.nn.Sequential(pb_module),
+        env.n_actions,
+        preprocessor=env.preprocessor,
+        is_backward=True,
+    )
+    assert pb.is_uniform and not expected_pb.is_uniform
+
+    def make_gflownet(pb):
+        if gflownet_name == "TB":
+            return TBGFlowNet(pf=pf, pb=pb, off_policy=True)
+        if gflownet_name == "ModifiedDB":
+            return ModifiedDBGFlowNet(pf=pf, pb=pb, off_policy=True)
+        if gflownet_name == "SubTB":
+            return SubTBGFlowNet(pf=pf, pb=pb, logF=logF, off_policy=True)
+        return DBGFlowNet(
+            pf=pf,
+            pb=pb,
+            logF=logF,
+            off_policy=True,
+            trajectory_layout=gflownet_name == "DB_trajectory_layout",
+        )
+
+    gflownet, expected_gflownet = make_gflownet(pb), make_gflownet(expected_pb)
+    trajectories = gflownet.sample_trajectories(
+        env, sample_off_policy=True, n_samples=10
+    )
+    training_samples = gflownet.to_training_samples(trajectories)
+    n_pb_calls = []
+    pb_module.register_forward_hook(lambda *args: n_pb_calls.append(1))
+
+    loss = gflownet.loss(env, training_samples)
+    assert len(n_pb_calls) == 0
+    assert torch.allclose(loss, expected_gflownet.loss(env, training_samples))
+
 
 @pytest.mark.parametrize("preprocessor_name", ["Identity", "KHot"])
 @pytest.mark.parametrize("env_name", ["HyperGrid", "DiscreteEBM", "Box"])
@@ -317,3 +564,74 @@ def test_subTB_vs_TB(
             env, trajectories
         )  # LogZ is default 0.0.
         assert (tb_loss - subtb_loss).abs() < 1e-4
+
+
+@pytest.mark.parametrize("ndim", [2, 3])
+@pytest.mark.parametrize("env_name", ["HyperGrid", "DiscreteEBM", "Box"])
+def test_subTB_vs_DB(env_name: str, ndim: int):
+    env, pf, pb, logF, gflownet = PFBasedGFlowNet_with_return(
+        env_name=env_name,
+        ndim=ndim,
+        module_name="NeuralNet",
+        tie_pb_to_pf=False,
+        gflownet_name="SubTB",
+        sub_tb_weighting="DB",
+        forward_looking=False,
+        zero_logF=False,
+    )
+
+    trajectories = gflownet.sample_trajectories(
+        env, sample_off_policy=False, n_samples=10
+    )
+    scores, flattening_masks = gflownet.get_scores(env, trajectories)
+    assert len(scores) == trajectories.max_length
+    for i, (score, flattening_mask) in enumerate(zip(scores, flattening_masks)):
+        assert score.shape == (trajectories.max_length - i, len(trajectories))
+        assert score.shape == flattening_mask.shape
+
+    subtb_loss = gflownet.loss(env, trajectories)
+    db_loss = DBGFlowNet(pf=pf, pb=pb, logF=logF, off_policy=False).loss(
+        env, trajectories.to_transitions()
+    )
+    assert (db_loss - subtb_loss).abs() < 1e-4
+
+
+@pytest.mark.parametrize(
+    "weighting",
+    [
+        "equal",
+        "TB",
+        "DB",
+        "ModifiedDB",
+        "geometric",
+        "equal_within",
+        "geometric_within",
+    ],
+)
+@pytest.mark.parametrize("env_name", ["HyperGrid", "DiscreteEBM", "Box"])
+def test_subTB_chunked(env_name: str, weighting: str):
+    if env_name != "HyperGrid" and weighting == "ModifiedDB":
+        pytest.skip("ModifiedDB not implemented for DiscreteEBM or Box")
+    env, pf, pb, logF, gflownet = PFBasedGFlowNet_with_return(
+        env_name=env_name,
+        ndim=3,
+        module_name="NeuralNet",
+        tie_pb_to_pf=False,
+        gflownet_name="SubTB",
+        sub_tb_weighting=weighting,
+        forward_looking=False,
+        zero_logF=False,
+    )
+    trajectories = gflownet.sample_trajectories(
+        env, sample_off_policy=False, n_samples=10
+    )
+    parameters = list(logF.parameters())
+
+    loss = gflownet.loss(env, trajectories)
+    (grad,) = torch.autograd.grad(loss, parameters[0])
+    for chunk_size in [1, 2]:
+        gflownet.chunk_size = chunk_size
+        chunked_loss = gflownet.loss(env, trajectories)
+        (chunked_grad,) = torch.autograd.grad(chunked_loss, parameters[0])
+        assert (loss - chunked_loss).abs() < 1e-4
+        assert torch.allclose(grad, chunked_grad, atol=1e-5)
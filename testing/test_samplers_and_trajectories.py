@@ -1,10 +1,22 @@
+import functools
+import os
 from typing import Literal
 
 import pytest
+import torch
 
-from gfn.containers import Trajectories
-from gfn.containers.replay_buffer import ReplayBuffer
-from gfn.gym import Box, DiscreteEBM, HyperGrid
+from gfn.containers import Prefetcher, Trajectories, Transitions
+from gfn.containers.base import load_columns
+from gfn.containers.replay_buffer import (
+    DeduplicatedReplayBuffer,
+    PrioritizedReplayBuffer,
+    ReplayBuffer,
+    SumTree,
+    sample_distinct_indices,
+)
+from gfn.gflownet import TBGFlowNet
+from gfn.gym import Box, DiscreteEBM, HyperGrid, VectorizedEnv
+from gfn.gym.discrete_ebm import IsingModel
 from gfn.gym.helpers.box_utils import (
     BoxPBEstimator,
     BoxPBNeuralNet,
@@ -218,3 +230,744 @@ def test_replay_buffer(
         replay_buffer.add(training_objects)
     except Exception as e:
         raise ValueError(f"Error while testing {env_name}") from e
+
+
+@pytest.mark.parametrize("env_name", ["HyperGrid", "DiscreteEBM", "Box"])
+@pytest.mark.parametrize("objects", ["trajectories", "transitions"])
+def test_replay_buffer_circular(
+    env_name: str,
+    objects: Literal["trajectories", "transitions"],
+):
+    trajectories, *_ = trajectory_sampling_with_return(
+        env_name,
+        preprocessor_name="Identity",
+        delta=0.1,
+        n_components=1,
+        n_components_s0=1,
+    )
+    env = trajectories.env
+    training_objects = (
+        trajectories if objects == "trajectories" else trajectories.to_transitions()
+    )
+    capacity = 7
+    replay_buffer = ReplayBuffer(env, capacity=capacity, objects_type=objects)
+
+    # Batches of varying sizes wrap around the storage, the buffer must then contain
+    # the `capacity` most recently added objects.
+    added = torch.arange(0)
+    for batch_size in (3, 5, 1, 9, 2):
+        index = (len(added) + torch.arange(batch_size)) % len(training_objects)
+        replay_buffer.add(training_objects[index])
+        added = torch.cat((added, index))
+        assert len(replay_buffer) == min(len(added), capacity)
+
+    expected = training_objects[added[-capacity:]]
+    stored = replay_buffer.training_objects[
+        (replay_buffer._index + torch.arange(capacity)) % capacity
+    ]
+    if objects == "trajectories":
+        assert torch.equal(stored.when_is_done, expected.when_is_done)
+        assert torch.equal(stored.states.tensor, expected.states.tensor)
+        assert torch.equal(stored.log_probs, expected.log_probs)
+    else:
+        assert torch.equal(stored.states.tensor, expected.states.tensor)
+        assert torch.equal(stored.next_states.tensor, expected.next_states.tensor)
+        assert torch.equal(stored.actions.tensor, expected.actions.tensor)
+    assert torch.equal(stored.log_rewards, expected.log_rewards)
+    assert len(replay_buffer.sample(4)) == 4
+
+
+@pytest.mark.parametrize("capacity", [1, 5, 8])
+def test_sum_tree(capacity: int):
+    sum_tree = SumTree(capacity)
+    priorities = torch.arange(capacity, dtype=torch.float) % 3
+    if capacity == 1:
+        priorities += 1
+    sum_tree.update(torch.arange(capacity), priorities)
+    assert torch.isclose(sum_tree.total, priorities.sum().double())
+
+    torch.manual_seed(0)
+    n_samples = 20000
+    index = sum_tree.sample(n_samples)
+    frequencies = torch.bincount(index, minlength=capacity) / n_samples
+    assert torch.all(frequencies[priorities == 0] == 0)
+    assert torch.allclose(frequencies, priorities / priorities.sum(), atol=0.02)
+
+
+@pytest.mark.parametrize("size", [0, 5, 40, 100_000])
+def test_sample_distinct_indices(size: int):
+    torch.manual_seed(0)
+    for n_samples in (1, 3, 10, 1000):
+        index = sample_distinct_indices(size, n_samples)
+        assert len(index) == min(n_samples, size)
+        assert len(index.unique()) == len(index)
+        assert torch.all((index >= 0) & (index < size))
+
+    # Indices are drawn uniformly, including with the rejection of duplicates.
+    if size == 40:
+        n_draws = 10_000
+        index = torch.cat([sample_distinct_indices(size, 3) for _ in range(n_draws)])
+        frequencies = torch.bincount(index, minlength=size) / n_draws
+        assert torch.allclose(frequencies, torch.full((size,), 3 / size), atol=0.02)
+
+
+@pytest.mark.parametrize("env_name", ["HyperGrid", "DiscreteEBM", "Box"])
+@pytest.mark.parametrize("priority", ["reward", "loss"])
+def test_prioritized_replay_buffer(
+    env_name: str,
+    priority: Literal["reward", "loss"],
+):
+    trajectories, *_ = trajectory_sampling_with_return(
+        env_name,
+        preprocessor_name="Identity",
+        delta=0.1,
+        n_components=1,
+        n_components_s0=1,
+    )
+    replay_buffer = PrioritizedReplayBuffer(
+        trajectories.env,
+        capacity=4,
+        objects_type="trajectories",
+        priority=priority,
+    )
+    replay_buffer.add(trajectories)
+    sampled = replay_buffer.sample(10)
+    assert len(sampled) == 10
+
+    if priority == "reward":
+        with pytest.raises(ValueError):
+            replay_buffer.update_priorities(torch.ones(10))
+    else:
+        replay_buffer.update_priorities(torch.ones(10))
+        # Only the first stored object keeps a non-negligible priority.
+        replay_buffer.update_priorities(
+            torch.tensor([1.0, 0.0, 0.0, 0.0]), index=torch.arange(4)
+        )
+        replay_buffer.sample(10)
+        assert torch.all(replay_buffer.last_sampled_index == 0)
+
+
+@pytest.mark.parametrize("env_name", ["HyperGrid", "DiscreteEBM", "Box"])
+@pytest.mark.parametrize("objects", ["trajectories", "states"])
+@pytest.mark.parametrize("eviction", ["fifo", "reward"])
+def test_deduplicated_replay_buffer(
+    env_name: str,
+    objects: Literal["trajectories", "states"],
+    eviction: Literal["fifo", "reward"],
+):
+    trajectories, *_ = trajectory_sampling_with_return(
+        env_name,
+        preprocessor_name="Identity",
+        delta=0.1,
+        n_components=1,
+        n_components_s0=1,
+    )
+    terminating_states = trajectories.last_states
+    _, unique_index = torch.unique(
+        terminating_states.tensor, dim=0, return_inverse=True
+    )
+    n_unique = int(unique_index.max()) + 1
+    if objects == "trajectories":
+        training_objects = trajectories
+    else:
+        training_objects = (
+            trajectories.to_non_initial_intermediary_and_terminating_states()
+        )
+
+    replay_buffer = DeduplicatedReplayBuffer(
+        trajectories.env, capacity=10, objects_type=objects, eviction=eviction
+    )
+    replay_buffer.add(training_objects)
+    replay_buffer.add(training_objects)
+    size = (
+        replay_buffer._size
+        if objects == "trajectories"
+        else replay_buffer._terminating_size
+    )
+    assert size == n_unique
+    assert len(torch.unique(replay_buffer._keys[:size])) == n_unique
+    sampled = replay_buffer.sample(3)
+    if objects == "states":
+        assert sampled[1].log_rewards is not None
+
+    # Only the terminating states with the highest log-rewards are kept.
+    if eviction == "reward" and n_unique > 1:
+        replay_buffer = DeduplicatedReplayBuffer(
+            trajectories.env, capacity=1, objects_type=objects, eviction=eviction
+        )
+        replay_buffer.add(training_objects)
+        assert replay_buffer._log_rewards[0] == trajectories.log_rewards.max()
+
+
+@pytest.mark.parametrize("env_name", ["HyperGrid", "DiscreteEBM", "Box"])
+@pytest.mark.parametrize("objects", ["trajectories", "transitions"])
+@pytest.mark.parametrize("mmap", [False, True])
+def test_container_save_load(
+    env_name: str,
+    objects: Literal["trajectories", "transitions"],
+    mmap: bool,
+    tmp_path,
+    monkeypatch,
+):
+    trajectories, *_ = trajectory_sampling_with_return(
+        env_name,
+        preprocessor_name="Identity",
+        delta=0.1,
+        n_components=1,
+        n_components_s0=1,
+    )
+    env = trajectories.env
+    container = (
+        trajectories if objects == "trajectories" else trajectories.to_transitions()
+    )
+    empty = Trajectories(env) if objects == "trajectories" else Transitions(env)
+
+    # Appending twice the same objects writes them to the same chunk, appending
+    # objects of a different shape starts a new chunk.
+    first, second = container[[0, 1]], container[[2, 3, 4]]
+    container.save(str(tmp_path), append=True)
+    container.save(str(tmp_path), append=True)
+    second.save(str(tmp_path), append=True)
+    first.save(str(tmp_path), append=True)
+    expected = container[torch.cat((torch.arange(len(container)),) * 2)]
+    expected.extend(second)
+    expected.extend(first)
+
+    loaded = empty
+    loaded.load(str(tmp_path), mmap=mmap)
+    assert len(loaded) == len(expected)
+    assert loaded.is_backward == expected.is_backward
+    assert torch.equal(loaded.states.tensor, expected.states.tensor)
+    assert torch.equal(loaded.actions.tensor, expected.actions.tensor)
+    assert torch.equal(loaded.log_rewards, expected.log_rewards)
+    assert torch.equal(loaded.log_probs, expected.log_probs)
+    if env_name != "Box":
+        assert torch.equal(loaded.states.forward_masks, expected.states.forward_masks)
+
+    # Overwriting the saved objects.
+    first.save(str(tmp_path))
+    loaded.load(str(tmp_path), mmap=mmap)
+    assert torch.equal(loaded.states.tensor, first.states.tensor)
+    n_files = len(os.listdir(tmp_path))
+
+    # A save interrupted before its header is written leaves the previous rows.
+    def interrupt(*args):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(os, "replace", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        second.save(str(tmp_path))
+    with pytest.raises(KeyboardInterrupt):
+        second.save(str(tmp_path), append=True)
+    monkeypatch.undo()
+    loaded.load(str(tmp_path), mmap=mmap)
+    assert torch.equal(loaded.states.tensor, first.states.tensor)
+    assert torch.equal(loaded.actions.tensor, first.actions.tensor)
+
+    # The files of the interrupted saves, and of the overwritten rows, are deleted
+    # once a save completes.
+    first.save(str(tmp_path))
+    assert len(os.listdir(tmp_path)) == n_files
+
+
+def _add_to_shared_log_rewards(objects_type, env_fn, shared_queue, done_queue):
+    """Rebuilds shared objects in another process, and modifies them in place."""
+    objects_class = Trajectories if objects_type == "trajectories" else Transitions
+    objects = objects_class.from_shared(env_fn(), shared_queue.get())
+    objects.log_rewards.add_(1.0)
+    done_queue.put(len(objects))
+
+
+@pytest.mark.parametrize("env_name", ["HyperGrid", "DiscreteEBM", "Box"])
+@pytest.mark.parametrize("objects", ["trajectories", "transitions"])
+def test_container_shared_memory(
+    env_name: str, objects: Literal["trajectories", "transitions"]
+):
+    trajectories, *_ = trajectory_sampling_with_return(
+        env_name,
+        preprocessor_name="Identity",
+        delta=0.1,
+        n_components=1,
+        n_components_s0=1,
+    )
+    env = trajectories.env
+    container = (
+        trajectories if objects == "trajectories" else trajectories.to_transitions()
+    )
+    container._log_rewards = container.log_rewards.detach().clone()
+
+    # The shared representation does not reference the env, and is rebuilt
+    # without copies.
+    shared = container.to_shared()
+    columns, attributes = shared
+    assert all(tensor.is_shared() for tensor in columns.values())
+    assert all(isinstance(val, (bool, int, float)) for val in attributes.values())
+    rebuilt = container.__class__.from_shared(env, shared)
+    assert rebuilt.env is env and rebuilt.is_backward == container.is_backward
+    assert rebuilt.states.tensor.data_ptr() == container.states.tensor.data_ptr()
+    assert torch.equal(rebuilt.actions.tensor, container.actions.tensor)
+
+    # Another process, with its own env, writes to the same memory.
+    if env_name != "HyperGrid":
+        return
+    context = torch.multiprocessing.get_context("spawn")
+    shared_queue, done_queue = context.Queue(), context.Queue()
+    process = context.Process(
+        target=_add_to_shared_log_rewards,
+        args=(
+            objects,
+            functools.partial(HyperGrid, ndim=2, height=8),
+            shared_queue,
+            done_queue,
+        ),
+    )
+    process.start()
+    expected = container.log_rewards + 1.0
+    shared_queue.put(shared)
+    assert done_queue.get(timeout=60) == len(container)
+    process.join()
+    assert torch.equal(container.log_rewards, expected)
+
+
+@pytest.mark.parametrize("env_name", ["HyperGrid", "DiscreteEBM", "Box"])
+def test_transitions_estimator_outputs(env_name: str):
+    trajectories, *_ = trajectory_sampling_with_return(
+        env_name,
+        preprocessor_name="Identity",
+        delta=0.1,
+        n_components=1,
+        n_components_s0=1,
+    )
+    env = trajectories.env
+    transitions = trajectories.to_transitions()
+    estimator_outputs = transitions.estimator_outputs
+    assert torch.equal(
+        estimator_outputs,
+        trajectories.estimator_outputs[~trajectories.actions.is_dummy],
+    )
+
+    index = torch.tensor([0, 2])
+    subset = transitions[index]
+    assert torch.equal(subset.estimator_outputs, estimator_outputs[index])
+    subset.extend(transitions)
+    assert torch.equal(
+        subset.estimator_outputs,
+        torch.cat((estimator_outputs[index], estimator_outputs)),
+    )
+    empty = Transitions(env)
+    empty.extend(transitions)
+    assert empty.estimator_outputs is estimator_outputs
+
+    replay_buffer = ReplayBuffer(
+        env, objects_type="transitions", capacity=len(transitions) + 2
+    )
+    with torch.no_grad():
+        replay_buffer.add(transitions)
+    stored = replay_buffer.training_objects[torch.arange(len(transitions))]
+    assert torch.equal(stored.estimator_outputs, estimator_outputs)
+    assert "estimator_outputs" in stored.get_columns()
+    assert replay_buffer.sample(3).estimator_outputs.shape[0] == 3
+
+
+@pytest.mark.parametrize("objects", ["trajectories", "transitions"])
+def test_prefetcher(objects: Literal["trajectories", "transitions"]):
+    trajectories, *_ = trajectory_sampling_with_return(
+        "HyperGrid",
+        preprocessor_name="Identity",
+        delta=0.1,
+        n_components=1,
+        n_components_s0=1,
+    )
+    host_env = trajectories.env
+    training_objects = (
+        trajectories if objects == "trajectories" else trajectories.to_transitions()
+    )
+    replay_buffer = ReplayBuffer(host_env, capacity=16, objects_type=objects)
+    replay_buffer.add(training_objects)
+
+    sampled = []
+
+    def sample_fn():
+        sampled.append(replay_buffer.sample(4))
+        return sampled[-1]
+
+    # The batches are attached to the training env, and staged one batch ahead.
+    env = HyperGrid(ndim=2, height=8)
+    prefetcher = Prefetcher(sample_fn, env)
+    for i, batch in zip(range(3), prefetcher):
+        assert len(sampled) == i + 2
+        assert batch.env is env and len(batch) == 4
+        assert torch.equal(batch.states.tensor, sampled[i].states.tensor)
+        assert torch.equal(batch.actions.tensor, sampled[i].actions.tensor)
+        assert torch.equal(batch.log_rewards, sampled[i].log_rewards)
+        assert batch.states.tensor.device == env.device
+
+    # Batches of the training env are returned as they are.
+    prefetcher = Prefetcher(sample_fn, host_env)
+    assert prefetcher.get() is sampled[-2]
+
+    states_buffer = ReplayBuffer(host_env, capacity=16, objects_type="states")
+    states_buffer.add(trajectories.to_non_initial_intermediary_and_terminating_states())
+    with pytest.raises(TypeError):
+        Prefetcher(lambda: states_buffer.sample(4), env).get()
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires CUDA")
+@pytest.mark.parametrize("objects", ["trajectories", "transitions"])
+def test_prefetcher_cuda(objects: Literal["trajectories", "transitions"], monkeypatch):
+    trajectories, *_ = trajectory_sampling_with_return(
+        "HyperGrid",
+        preprocessor_name="Identity",
+        delta=0.1,
+        n_components=1,
+        n_components_s0=1,
+    )
+    host_env = trajectories.env
+    training_objects = (
+        trajectories if objects == "trajectories" else trajectories.to_transitions()
+    )
+    replay_buffer = ReplayBuffer(host_env, capacity=16, objects_type=objects)
+    replay_buffer.add(training_objects)
+
+    sampled = []
+
+    def sample_fn():
+        sampled.append(replay_buffer.sample(4))
+        return sampled[-1]
+
+    # Records the copy events, and those waited for before reusing pinned buffers.
+    created, synchronized = [], []
+
+    class RecordingEvent(torch.cuda.Event):
+        def __init__(self, *args, **kwargs):
+            super().__init__()
+            created.append(self)
+
+        def synchronize(self):
+            synchronized.append(self)
+            super().synchronize()
+
+    monkeypatch.setattr(torch.cuda, "Event", RecordingEvent)
+
+    env = HyperGrid(ndim=2, height=8, device_str="cuda")
+    prefetcher = Prefetcher(sample_fn, env)
+    batches = [prefetcher.get() for _ in range(6)]
+    torch.cuda.synchronize()
+
+    # The batches match the contents of the buffer, on the device, even after the
+    # pinned buffers they were copied from have been reused.
+    for batch, host_batch in zip(batches, sampled):
+        assert batch.env is env
+        assert batch.states.tensor.device.type == "cuda"
+        assert torch.equal(batch.states.tensor.cpu(), host_batch.states.tensor)
+        assert torch.equal(batch.actions.tensor.cpu(), host_batch.actions.tensor)
+        assert torch.equal(batch.log_rewards.cpu(), host_batch.log_rewards)
+
+    # Two sets of pinned buffers are used in turn, and a set is only overwritten once
+    # the copy of the batch staged from it two batches earlier has completed.
+    assert len(created) == len(sampled) == 7
+    assert synchronized == created[:-2]
+    for pinned in prefetcher._pinned:
+        assert pinned and all(buffer.is_pinned() for buffer in pinned.values())
+
+
+@pytest.mark.parametrize("objects", ["trajectories", "transitions", "states"])
+def test_replay_buffer_save_load(
+    objects: Literal["trajectories", "transitions", "states"],
+    tmp_path,
+):
+    trajectories, *_ = trajectory_sampling_with_return(
+        "HyperGrid",
+        preprocessor_name="Identity",
+        delta=0.1,
+        n_components=1,
+        n_components_s0=1,
+    )
+    env = trajectories.env
+    if objects == "trajectories":
+        training_objects = trajectories
+    elif objects == "transitions":
+        training_objects = trajectories.to_transitions()
+    else:
+        training_objects = (
+            trajectories.to_non_initial_intermediary_and_terminating_states()
+        )
+
+    replay_buffer = ReplayBuffer(env, capacity=7, objects_type=objects)
+    for _ in range(3):
+        replay_buffer.add(training_objects)
+    replay_buffer.save(str(tmp_path))
+
+    for mmap in (False, True):
+        loaded = ReplayBuffer(env, capacity=7, objects_type=objects)
+        loaded.load(str(tmp_path), mmap=mmap)
+        assert len(loaded) == len(replay_buffer)
+        sampled = loaded.sample(3)
+        assert len(sampled[0] if objects == "states" else sampled) == 3
+        # The oldest objects are overwritten first, both buffers hold the same
+        # objects in the same chronological order.
+        loaded.add(training_objects)
+        replay_buffer.add(training_objects)
+        loaded_objects = loaded.training_objects[(loaded._index + torch.arange(7)) % 7]
+        stored_objects = replay_buffer.training_objects[
+            (replay_buffer._index + torch.arange(7)) % 7
+        ]
+        if objects != "states":
+            loaded_objects, stored_objects = (
+                loaded_objects.states,
+                stored_objects.states,
+            )
+        assert torch.equal(loaded_objects.tensor, stored_objects.tensor)
+        replay_buffer.load(str(tmp_path))
+
+
+@pytest.mark.parametrize("objects", ["trajectories", "transitions", "states"])
+def test_replay_buffer_incremental_save(
+    objects: Literal["trajectories", "transitions", "states"],
+    tmp_path,
+):
+    trajectories, *_ = trajectory_sampling_with_return(
+        "HyperGrid",
+        preprocessor_name="Identity",
+        delta=0.1,
+        n_components=1,
+        n_components_s0=1,
+    )
+    env = trajectories.env
+    if objects == "trajectories":
+        training_objects = trajectories
+    elif objects == "transitions":
+        training_objects = trajectories.to_transitions()
+    else:
+        training_objects = (
+            trajectories.to_non_initial_intermediary_and_terminating_states()
+        )
+
+    def get_batch(i):
+        index = torch.arange(3 * i, 3 * i + 3)
+        if objects == "states":
+            return tuple(states[index % len(states)] for states in training_objects)
+        return training_objects[index % len(training_objects)]
+
+    def get_tensor(buffer):
+        """The tensor of the stored objects, from the oldest to the most recent."""
+        size = len(buffer)
+        stored = buffer.training_objects[
+            (buffer._index - size + torch.arange(size)) % buffer.capacity
+        ]
+        return stored.tensor if objects == "states" else stored.states.tensor
+
+    def get_n_saved_rows():
+        path = os.path.join(tmp_path, "training_objects")
+        return sum(
+            len(next(iter(columns.values()))) for columns, _ in load_columns(path)
+        )
+
+    # Each save only appends the objects added since the previous one, including
+    # after the circular buffer wraps around, until the saved rows would exceed
+    # twice the capacity.
+    replay_buffer = ReplayBuffer(env, capacity=7, objects_type=objects)
+    for i, n_saved_rows in enumerate((3, 6, 9, 12, 7)):
+        replay_buffer.add(get_batch(i))
+        replay_buffer.save(str(tmp_path))
+        assert get_n_saved_rows() == n_saved_rows
+        loaded = ReplayBuffer(env, capacity=7, objects_type=objects)
+        loaded.load(str(tmp_path))
+        assert torch.equal(get_tensor(loaded), get_tensor(replay_buffer))
+
+    # A loaded buffer appends to the rows it was loaded from.
+    loaded.add(get_batch(5))
+    loaded.save(str(tmp_path))
+    assert get_n_saved_rows() == 10
+    replay_buffer.load(str(tmp_path))
+    assert torch.equal(get_tensor(loaded), get_tensor(replay_buffer))
+
+
+@pytest.mark.parametrize("env_name", ["HyperGrid", "DiscreteEBM", "Box"])
+def test_sampler_buffer_growth(env_name: str):
+    trajectories, _, pf_estimator, _ = trajectory_sampling_with_return(
+        env_name,
+        preprocessor_name="Identity",
+        delta=0.1,
+        n_components=1,
+        n_components_s0=1,
+    )
+    env = trajectories.env
+    sampler = Sampler(estimator=pf_estimator)
+
+    # A buffer of length 1 needs to be grown during the rollout, and must yield the
+    # same trajectories as a buffer that is large enough from the start.
+    all_trajectories = []
+    for max_length in (1, 64):
+        torch.manual_seed(0)
+        all_trajectories.append(
+            sampler.sample_trajectories(
+                env,
+                off_policy=False,
+                n_trajectories=5,
+                debug_mode=True,
+                max_length=max_length,
+            )
+        )
+    small, large = all_trajectories
+    assert small.states.batch_shape == large.states.batch_shape
+    assert torch.equal(small.states.tensor, large.states.tensor)
+    assert torch.equal(small.actions.tensor, large.actions.tensor)
+    assert torch.equal(small.when_is_done, large.when_is_done)
+    assert torch.allclose(small.log_probs, large.log_probs)
+    assert torch.equal(small.estimator_outputs, large.estimator_outputs)
+
+
+@pytest.mark.parametrize("env_name", ["HyperGrid", "DiscreteEBM", "Box"])
+@pytest.mark.parametrize("is_backward", [False, True])
+def test_sampler_compact_active_set(env_name: str, is_backward: bool):
+    trajectories, _, pf_estimator, pb_estimator = trajectory_sampling_with_return(
+        env_name,
+        preprocessor_name="Identity",
+        delta=0.1,
+        n_components=1,
+        n_components_s0=1,
+    )
+    env = trajectories.env
+    sampler = Sampler(estimator=pb_estimator if is_backward else pf_estimator)
+
+    all_trajectories = []
+    for compact_active_set in (False, True):
+        torch.manual_seed(0)
+        states = env.reset(batch_shape=8, random=True) if is_backward else None
+        all_trajectories.append(
+            sampler.sample_trajectories(
+                env,
+                off_policy=False,
+                states=states,
+                n_trajectories=None if is_backward else 8,
+                compact_active_set=compact_active_set,
+            )
+        )
+    full, compact = all_trajectories
+    assert torch.equal(full.states.tensor, compact.states.tensor)
+    assert torch.equal(full.actions.tensor, compact.actions.tensor)
+    assert torch.equal(full.when_is_done, compact.when_is_done)
+    assert torch.allclose(full.log_probs, compact.log_probs)
+    assert torch.allclose(full.log_rewards, compact.log_rewards)
+
+
+@pytest.mark.parametrize("env_name", ["HyperGrid", "DiscreteEBM", "Box"])
+@pytest.mark.parametrize("is_backward", [False, True])
+@pytest.mark.parametrize("use_fused_step", [False, True])
+def test_sampler_static_shapes(env_name: str, is_backward: bool, use_fused_step: bool):
+    if use_fused_step and env_name == "Box":
+        pytest.skip("Box does not implement a fused step.")
+    trajectories, _, pf_estimator, pb_estimator = trajectory_sampling_with_return(
+        env_name,
+        preprocessor_name="Identity",
+        delta=0.1,
+        n_components=1,
+        n_components_s0=1,
+    )
+    env = trajectories.env
+    if use_fused_step:
+        env.use_fused_step = True
+        env.set_action_validation("never")
+    estimator = pb_estimator if is_backward else pf_estimator
+    sampler = Sampler(estimator=estimator)
+
+    torch.manual_seed(0)
+    states = env.reset(batch_shape=8, random=True) if is_backward else None
+    trajectories = sampler.sample_trajectories_static(
+        env,
+        off_policy=False,
+        max_length=256,
+        states=states,
+        n_trajectories=None if is_backward else 8,
+        debug_mode=True,
+        done_check_interval=4,
+    )
+
+    # The trajectories have the layout of those of `sample_trajectories`.
+    is_padding = (
+        trajectories.states.is_initial_state
+        if is_backward
+        else trajectories.states.is_sink_state
+    )
+    assert is_padding[-1].all()
+    assert torch.equal(trajectories.when_is_done, (~is_padding).sum(0))
+    assert torch.equal(trajectories.actions.is_dummy, is_padding[:-1])
+    assert trajectories.log_probs[is_padding[:-1]].eq(0).all()
+    assert trajectories.estimator_outputs[is_padding[:-1]].eq(-float("inf")).all()
+
+    # The log probabilities are those of the actions under the estimator.
+    is_valid = ~is_padding[:-1]
+    valid_states = trajectories.states[:-1][is_valid]
+    dist = estimator.to_probability_distribution(valid_states, estimator(valid_states))
+    log_probs = dist.log_prob(trajectories.actions[is_valid].tensor)
+    assert torch.allclose(trajectories.log_probs[is_valid], log_probs, atol=1e-6)
+
+    if not is_backward:
+        for t in range(trajectories.max_length):
+            next_states = env._step(
+                trajectories.states[t], trajectories.actions[t]
+            ).tensor
+            assert torch.equal(next_states, trajectories.states[t + 1].tensor)
+        assert torch.allclose(
+            trajectories.log_rewards, env.log_reward(trajectories.last_states)
+        )
+
+    # The horizon is fixed.
+    if env_name == "HyperGrid":
+        with pytest.raises(ValueError):
+            sampler.sample_trajectories_static(
+                env,
+                off_policy=False,
+                max_length=1,
+                states=env.reset(batch_shape=8, random=True) if is_backward else None,
+                n_trajectories=None if is_backward else 8,
+            )
+
+
+@pytest.mark.parametrize("env_name", ["HyperGrid", "DiscreteEBM", "Box"])
+def test_vectorized_env(env_name: str):
+    trajectories, _, pf_estimator, pb_estimator = trajectory_sampling_with_return(
+        env_name,
+        preprocessor_name="Identity",
+        delta=0.1,
+        n_components=1,
+        n_components_s0=1,
+    )
+    env = trajectories.env
+    if env_name == "HyperGrid":
+        envs = [
+            HyperGrid(ndim=2, height=8, R0=R0, R1=R1, preprocessor_name="Identity")
+            for R0, R1 in [(0.1, 0.5), (0.01, 0.5), (0.1, 1.0)]
+        ]
+    elif env_name == "DiscreteEBM":
+        envs = [DiscreteEBM(ndim=8, alpha=alpha) for alpha in (1.0, 0.5)]
+        # An energy with different couplings is evaluated separately.
+        envs.append(DiscreteEBM(ndim=8, energy=IsingModel(-torch.eye(8))))
+    else:
+        envs = [Box(delta=0.1, R2=R2) for R2 in (2.0, 4.0)]
+
+    vectorized_env = VectorizedEnv(envs)
+    assert vectorized_env._loop_over_envs == (env_name == "DiscreteEBM")
+    expected_parameters = {"HyperGrid": {"R0", "R1"}, "DiscreteEBM": {"alpha"}}
+    assert set(vectorized_env.parameters) == expected_parameters.get(env_name, {"R2"})
+
+    all_trajectories = vectorized_env.sample_trajectories(
+        Sampler(estimator=pf_estimator), n_trajectories=5
+    )
+    assert len(all_trajectories) == len(envs)
+    gflownet = TBGFlowNet(pf=pf_estimator, pb=pb_estimator, off_policy=False)
+    for env_trajectories, env in zip(all_trajectories, envs):
+        assert env_trajectories.env is env
+        assert env_trajectories.n_trajectories == 5
+        assert isinstance(env_trajectories.states, env.States)
+        assert torch.allclose(
+            env_trajectories.log_rewards,
+            env.log_reward(env_trajectories.last_states),
+        )
+        gflownet.loss(env, env_trajectories)
+
+    # Environments with different dynamics cannot be vectorized.
+    if env_name == "HyperGrid":
+        with pytest.raises(ValueError):
+            VectorizedEnv([env, HyperGrid(ndim=2, height=4)])